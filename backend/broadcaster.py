@@ -0,0 +1,264 @@
+import asyncio
+import json
+import time
+from collections import deque
+
+# Message types map onto the topics clients subscribe to; every message about one customer is
+# also published on that customer's topic, which is what a single CustomerProfile page needs.
+TOPIC_FOR_TYPE = {'new_event': 'events', 'churn_alert': 'alerts', 'kpi_update': 'kpis'}
+DEFAULT_TOPICS = frozenset(TOPIC_FOR_TYPE.values())
+# Never coalesced or dropped; a client that can't keep up with these is disconnected instead
+ALWAYS_DELIVER = frozenset({'churn_alert'})
+
+def customer_topic(user_id):
+    return f"customer:{user_id}"
+
+def message_topics(message):
+    """The topics a processor message is published on."""
+    message_type = message.get('type')
+    topics = [TOPIC_FOR_TYPE.get(message_type, message_type)]
+    payload = message.get('payload')
+    if isinstance(payload, dict) and payload.get('user_id'):
+        topics.append(customer_topic(payload['user_id']))
+    return topics
+
+def parse_topics(value):
+    """Topics from a comma-separated query parameter. None (no parameter) means the default topics."""
+    if value is None:
+        return set(DEFAULT_TOPICS)
+    return {topic.strip() for topic in value.split(',') if topic.strip()}
+
+def encode_frame(message_type, payload_json):
+    """Builds the {"type", "payload"} frame around an already serialized payload."""
+    return '{"type": %s, "payload": %s}' % (json.dumps(message_type), payload_json)
+
+class Subscriber:
+    """
+    One WebSocket client: its topics, what is waiting to be sent to it and the task sending it.
+
+    'churn_alert' frames have their own queue and go out before anything else. Other messages
+    wait in a queue of at most max_queue; once it is full the client is falling behind, and
+    further 'new_event' payloads are held back (up to max_coalesce, oldest dropped first) while
+    'kpi_update' deltas are merged into one. Every coalesce_interval, the queued and held events
+    are sent together as a single 'event_batch' frame, followed by the merged KPIs.
+    """
+
+    def __init__(self, websocket, topics, max_queue=100, max_coalesce=1000, coalesce_interval=0.5):
+        self.websocket = websocket
+        self.topics = set(topics)
+        self.max_queue = max_queue
+        self.max_coalesce = max_coalesce
+        self.coalesce_interval = coalesce_interval
+        self.alerts = deque()
+        # (message_type, frame, payload_json, payload), so queued messages can still be coalesced
+        self.queue = deque()
+        self.held_events = deque()
+        self.held_kpis = None
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.closed = False
+        self._last_flush = time.monotonic()
+
+        self.sent = 0
+        self.coalesced = 0
+        self.batch_frames = 0
+        self.dropped = 0
+
+    def offer(self, message_type, frame, payload_json, payload):
+        if message_type in ALWAYS_DELIVER:
+            self.alerts.append(frame)
+        elif len(self.queue) < self.max_queue:
+            self.queue.append((message_type, frame, payload_json, payload))
+        else:
+            self._hold(message_type, payload_json, payload)
+        self.wakeup.set()
+
+    def _hold(self, message_type, payload_json, payload):
+        self.coalesced += 1
+        if message_type == 'kpi_update':
+            # Deltas carry whole KPI values, so the newest value of each key is all a client needs
+            self.held_kpis = {**(self.held_kpis or {}), **payload}
+            return
+        if len(self.held_events) >= self.max_coalesce:
+            self.held_events.popleft()
+            self.dropped += 1
+        self.held_events.append(payload_json)
+
+    def backlog(self):
+        return len(self.alerts) + len(self.queue)
+
+    def _has_held(self):
+        return bool(self.held_events) or self.held_kpis is not None
+
+    def _coalesce(self):
+        """Replaces the queue and the held messages with one 'event_batch' frame and one merged 'kpi_update'."""
+        events = []
+        kpis = {}
+        for message_type, _, payload_json, payload in self.queue:
+            if message_type == 'new_event':
+                events.append(payload_json)
+            elif message_type == 'kpi_update':
+                kpis.update(payload)
+        events.extend(self.held_events)
+        if kpis or self.held_kpis is not None:
+            self.held_kpis = {**kpis, **(self.held_kpis or {})}
+        self.queue.clear()
+        self.held_events.clear()
+        if events:
+            self.queue.append(('event_batch', encode_frame('event_batch', '[' + ','.join(events) + ']'), None, None))
+            self.batch_frames += 1
+        if self.held_kpis is not None:
+            self.queue.append(('kpi_update', encode_frame('kpi_update', json.dumps(self.held_kpis, default=str)), None, None))
+            self.held_kpis = None
+
+    def next_frame(self):
+        """The frame to send next, or None if nothing is due."""
+        if self.alerts:
+            return self.alerts.popleft()
+        now = time.monotonic()
+        if self._has_held() and (not self.queue or now - self._last_flush >= self.coalesce_interval):
+            self._coalesce()
+            self._last_flush = now
+        return self.queue.popleft()[1] if self.queue else None
+
+    async def run(self, send_timeout):
+        """Sends frames until the client goes away or a send takes longer than send_timeout."""
+        while not self.closed:
+            frame = self.next_frame()
+            if frame is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            await asyncio.wait_for(self.websocket.send_text(frame), send_timeout)
+            self.sent += 1
+
+    def stats(self):
+        return {
+            "topics": sorted(self.topics),
+            "alerts": len(self.alerts),
+            "queued": len(self.queue),
+            "held": len(self.held_events),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "batch_frames": self.batch_frames,
+            "dropped": self.dropped,
+        }
+
+class ConnectionManager:
+    """
+    Fans processor messages out to the /ws/updates clients.
+
+    Each message is serialized once and handed to the subscribers of its topics without waiting
+    on any socket; every client has its own sender task, so a slow dashboard only delays itself.
+    A client whose queue grows past max_backlog (alerts alone can do that) or whose send stalls for
+    send_timeout seconds is disconnected rather than allowed to hold memory without bound.
+    """
+
+    def __init__(self, max_queue=100, max_coalesce=1000, coalesce_interval=0.5, max_backlog=5000, send_timeout=10.0):
+        self.max_queue = max_queue
+        self.max_coalesce = max_coalesce
+        self.coalesce_interval = coalesce_interval
+        self.max_backlog = max_backlog
+        self.send_timeout = send_timeout
+        self.subscribers = set()
+        self._by_topic = {}
+
+        self.published = 0
+        self.deliveries = 0
+        self.disconnected_slow = 0
+
+    def connect(self, websocket, topics=DEFAULT_TOPICS):
+        """Registers an accepted WebSocket and starts its sender task."""
+        subscriber = Subscriber(websocket, (), self.max_queue, self.max_coalesce, self.coalesce_interval)
+        self.subscribers.add(subscriber)
+        self.subscribe(subscriber, topics)
+        subscriber.task = asyncio.create_task(self._send_loop(subscriber))
+        return subscriber
+
+    def _remove(self, subscriber):
+        """Unregisters a client and stops its sender task. Returns False if it was already removed."""
+        if subscriber.closed:
+            return False
+        subscriber.closed = True
+        self.subscribers.discard(subscriber)
+        self.unsubscribe(subscriber, list(subscriber.topics))
+        subscriber.wakeup.set()
+        if subscriber.task is not None and subscriber.task is not asyncio.current_task():
+            subscriber.task.cancel()
+        return True
+
+    async def _close(self, websocket, code):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def disconnect(self, subscriber, code=None):
+        """Unregisters a client; with a close code, also closes its socket (1013: try again later)."""
+        if self._remove(subscriber) and code is not None:
+            await self._close(subscriber.websocket, code)
+
+    def subscribe(self, subscriber, topics):
+        if subscriber.closed:
+            return
+        for topic in topics:
+            subscriber.topics.add(topic)
+            self._by_topic.setdefault(topic, set()).add(subscriber)
+
+    def unsubscribe(self, subscriber, topics):
+        for topic in topics:
+            subscriber.topics.discard(topic)
+            topic_subscribers = self._by_topic.get(topic)
+            if topic_subscribers is not None:
+                topic_subscribers.discard(subscriber)
+                if not topic_subscribers:
+                    del self._by_topic[topic]
+
+    def publish(self, message):
+        """Queues a message for every subscriber of its topics. Returns the number of recipients."""
+        topics = message_topics(message)
+        recipients = set()
+        for topic in topics:
+            recipients.update(self._by_topic.get(topic, ()))
+        self.published += 1
+        if not recipients:
+            return 0
+
+        message_type = message.get('type')
+        payload = message.get('payload')
+        payload_json = json.dumps(payload, default=str)
+        frame = encode_frame(message_type, payload_json)
+        for subscriber in recipients:
+            subscriber.offer(message_type, frame, payload_json, payload)
+            if subscriber.backlog() > self.max_backlog and self._remove(subscriber):
+                print(f"BROADCAST: Disconnecting a client with {subscriber.backlog()} unsent frames.")
+                self.disconnected_slow += 1
+                asyncio.create_task(self._close(subscriber.websocket, 1013))
+        self.deliveries += len(recipients)
+        return len(recipients)
+
+    async def _send_loop(self, subscriber):
+        try:
+            await subscriber.run(self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            print(f"BROADCAST: Disconnecting a client whose send stalled for {self.send_timeout}s.")
+            self.disconnected_slow += 1
+            await self.disconnect(subscriber, code=1013)
+        except Exception:
+            # The socket went away; the endpoint's receive loop notices too
+            await self.disconnect(subscriber)
+
+    def stats(self):
+        return {
+            "clients": len(self.subscribers),
+            "topics": len(self._by_topic),
+            "published": self.published,
+            "deliveries": self.deliveries,
+            "sent": sum(subscriber.sent for subscriber in self.subscribers),
+            "disconnected_slow": self.disconnected_slow,
+            "queued": sum(subscriber.backlog() for subscriber in self.subscribers),
+            "coalesced": sum(subscriber.coalesced for subscriber in self.subscribers),
+            "batch_frames": sum(subscriber.batch_frames for subscriber in self.subscribers),
+        }
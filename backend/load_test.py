@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+import httpx
+import websockets
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+EVENT_TYPES = ['login', 'support_ticket', 'payment_failed', 'feature_usage', 'contract_downgrade']
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+class Client:
+    """
+    One dashboard connection. delay is how long it spends on each frame it receives; rcvbuf, if
+    set, caps its socket's receive buffer like a slow network link would, so the backlog builds
+    up in the server's per-client queue instead of in the kernel.
+    """
+
+    def __init__(self, kind, topics=None, delay=0.0, rcvbuf=0):
+        self.kind = kind
+        self.topics = topics
+        self.delay = delay
+        self.rcvbuf = rcvbuf
+        self.messages = 0
+        self.frames = 0
+        self.batch_frames = 0
+        self.alerts = set()
+        self.foreign = 0
+        self.latencies_ms = []
+        self.closed_code = None
+
+    def record(self, message_type, payload, now):
+        self.messages += 1
+        self.latencies_ms.append((now - payload['timestamp']) * 1000)
+        if message_type == 'churn_alert':
+            self.alerts.add(payload['seq'])
+        if self.topics and self.topics.startswith('customer:') and payload['user_id'] != self.topics[len('customer:'):]:
+            self.foreign += 1
+
+    async def run(self, url, stop):
+        query = '' if self.topics is None else f'?topics={self.topics}'
+        sock = None
+        if self.rcvbuf:
+            address = urlsplit(url)
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+            sock.connect((address.hostname, address.port))
+            sock.setblocking(False)
+        try:
+            # A small client-side queue, so a slow reader pushes back on the server instead of buffering here
+            async with websockets.connect(f'{url}/ws/updates{query}', max_queue=4, sock=sock) as ws:
+                while not stop.is_set():
+                    try:
+                        text = await asyncio.wait_for(ws.recv(), 0.5)
+                    except asyncio.TimeoutError:
+                        continue
+                    now = time.time()
+                    self.frames += 1
+                    frame = json.loads(text)
+                    if frame['type'] == 'event_batch':
+                        self.batch_frames += 1
+                        for payload in frame['payload']:
+                            self.record('new_event', payload, now)
+                    else:
+                        self.record(frame['type'], frame['payload'], now)
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+        except websockets.ConnectionClosed as e:
+            self.closed_code = e.code
+
+async def publish(base_url, rate, duration, batch_size, alert_ratio, customers, seed):
+    """Posts processor-style messages to /api/broadcast-events at rate messages/sec. Returns the alert seqs sent."""
+    rng = random.Random(seed)
+    alerts = set()
+    sent = 0
+    started = time.monotonic()
+    async with httpx.AsyncClient(base_url=base_url, timeout=10.0) as http:
+        while time.monotonic() - started < duration:
+            due = int((time.monotonic() - started) * rate)
+            if sent >= due:
+                await asyncio.sleep(batch_size / rate / 4)
+                continue
+            batch = []
+            for _ in range(min(batch_size, due - sent)):
+                is_alert = rng.random() < alert_ratio
+                payload = {
+                    "user_id": f"LOAD-{rng.randrange(customers):05d}", "event_type": rng.choice(EVENT_TYPES),
+                    "timestamp": time.time(), "seq": sent, "churn_probability": rng.uniform(0.71, 0.99) if is_alert else rng.random() * 0.7,
+                }
+                if is_alert:
+                    alerts.add(sent)
+                batch.append({"type": "churn_alert" if is_alert else "new_event", "payload": payload})
+                sent += 1
+            await http.post('/api/broadcast-events', json=batch)
+    return sent, alerts
+
+def start_server(port):
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port), '--ws', 'ws_protocol:BoundedWebSocketProtocol',
+         '--ws-per-message-deflate', 'false', '--log-level', 'warning'], cwd=BACKEND_DIR
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/api/broadcast-stats', timeout=1.0)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Backend did not start within 30s.")
+
+def summarize(name, clients, alerts_sent, published):
+    if not clients:
+        return
+    latencies = [latency for client in clients for latency in client.latencies_ms]
+    received = sum(client.messages for client in clients) / len(clients)
+    alerts = min(len(alerts_sent & client.alerts) for client in clients)
+    print(f"  {name:<9} {len(clients):>4} clients  {received:>9,.0f} msgs/client of {published:,}  "
+          f"p50={percentile(latencies, 50):>8.1f}ms p99={percentile(latencies, 99):>8.1f}ms  "
+          f"batch frames={sum(client.batch_frames for client in clients):>5}  "
+          f"alerts >= {alerts}/{len(alerts_sent)}  disconnected={sum(client.closed_code is not None for client in clients)}")
+
+async def run(args):
+    base_url = args.url or f'http://127.0.0.1:{args.port}'
+    ws_url = base_url.replace('http', 'ws', 1)
+    clients = (
+        [Client('fast') for _ in range(args.clients)]
+        + [Client('slow', delay=args.slow_delay_ms / 1000, rcvbuf=args.slow_rcvbuf) for _ in range(args.slow_clients)]
+        + [Client('customer', topics=f'customer:LOAD-{i % args.customers:05d}') for i in range(args.customer_clients)]
+    )
+    stop = asyncio.Event()
+    tasks = [asyncio.create_task(client.run(ws_url, stop)) for client in clients]
+    await asyncio.sleep(1.0)
+
+    started = time.monotonic()
+    published, alerts_sent = await publish(
+        base_url, args.rate, args.duration, args.batch_size, args.alert_ratio, args.customers, args.seed
+    )
+    elapsed = time.monotonic() - started
+    await asyncio.sleep(args.drain)
+    async with httpx.AsyncClient(base_url=base_url) as http:
+        stats = (await http.get('/api/broadcast-stats')).json()
+    stop.set()
+    await asyncio.gather(*tasks)
+
+    print(f"Published {published:,} messages ({len(alerts_sent):,} alerts) in {elapsed:.1f}s "
+          f"({published / elapsed:,.0f} msgs/sec) to {len(clients)} clients.")
+    for kind in ('fast', 'slow'):
+        summarize(kind, [client for client in clients if client.kind == kind], alerts_sent, published)
+    customer_clients = [client for client in clients if client.kind == 'customer']
+    if customer_clients:
+        received = sum(client.messages for client in customer_clients)
+        foreign = sum(client.foreign for client in customer_clients)
+        print(f"  customer  {len(customer_clients):>4} clients  {received:,} msgs in total, {foreign} for other customers")
+    print(f"Server: {stats}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the /ws/updates fan-out with fast, slow and per-customer clients.")
+    parser.add_argument("--url", help="A running backend (default: start one on --port).")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--clients", type=int, default=200, help="Clients reading as fast as they can.")
+    parser.add_argument("--slow-clients", type=int, default=20, help="Clients that spend --slow-delay-ms on every frame.")
+    parser.add_argument("--slow-delay-ms", type=float, default=20.0)
+    parser.add_argument("--slow-rcvbuf", type=int, default=4096, help="Receive buffer bytes of the slow clients' sockets (0: OS default).")
+    parser.add_argument("--customer-clients", type=int, default=50, help="Clients subscribed to one customer's topic.")
+    parser.add_argument("--customers", type=int, default=1000, help="Distinct user_ids in the generated messages.")
+    parser.add_argument("--rate", type=float, default=500.0, help="Messages per second.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to publish for.")
+    parser.add_argument("--batch-size", type=int, default=50, help="Messages per POST, as the processor's sender coalesces them.")
+    parser.add_argument("--alert-ratio", type=float, default=0.02)
+    parser.add_argument("--drain", type=float, default=3.0, help="Seconds to keep reading after publishing stops.")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    server = None if args.url else start_server(args.port)
+    try:
+        asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
@@ -0,0 +1,250 @@
+import json
+import os
+import sys
+import threading
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from fastapi import FastAPI, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT_DIR)
+from common.db import Database
+from common.interventions import INTERVENTIONS, fetch_customer_columns, rank_high_risk, summarize_ranking, what_if
+from common.risk_queries import (
+    HIGH_THRESHOLD, fetch_churn_alerts_history, fetch_customer, fetch_daily_churn_trend, fetch_dashboard_kpis,
+    fetch_recent_events, log_intervention,
+)
+from common.scorer import DEFAULT_MODEL_PATH, ChurnScorer
+from common.watchlist import TTLCache, WatchlistEngine
+from broadcaster import ConnectionManager, parse_topics
+
+# Load environment variables from the root .env file
+load_dotenv(dotenv_path=os.path.join(ROOT_DIR, '.env'))
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+CORS_ORIGINS = os.getenv("CORS_ORIGINS", "*").split(',')
+SHAP_SUMMARY_PATH = os.getenv("SHAP_SUMMARY_PATH", os.path.join(ROOT_DIR, 'shap_summary.json'))
+# Seconds a watchlist page, and a total behind "Page x of y", may be served from cache
+WATCHLIST_CACHE_TTL = float(os.getenv("WATCHLIST_CACHE_TTL", "5"))
+WATCHLIST_COUNT_TTL = float(os.getenv("WATCHLIST_COUNT_TTL", "30"))
+# The model the what-if endpoints score with, and how long a bulk ranking is reused
+MODEL_PATH = os.getenv("MODEL_PATH", DEFAULT_MODEL_PATH)
+INTERVENTION_RANKING_TTL = float(os.getenv("INTERVENTION_RANKING_TTL", "300"))
+WHAT_IF_MAX_CUSTOMERS = 10000
+
+manager = ConnectionManager(
+    max_queue=int(os.getenv("WS_MAX_QUEUE", "100")),
+    max_coalesce=int(os.getenv("WS_MAX_COALESCE", "1000")),
+    coalesce_interval=float(os.getenv("WS_COALESCE_INTERVAL", "0.5")),
+    max_backlog=int(os.getenv("WS_MAX_BACKLOG", "5000")),
+    send_timeout=float(os.getenv("WS_SEND_TIMEOUT", "10")),
+)
+
+_db = None
+_watchlist = None
+_scorer = None
+_db_lock = threading.Lock()
+_scorer_lock = threading.Lock()
+_rankings = TTLCache(INTERVENTION_RANKING_TTL, 16)
+
+def get_db():
+    """The shared connection pool, created on first use so the WebSocket side runs without Postgres."""
+    global _db
+    with _db_lock:
+        if _db is None:
+            _db = Database(maxconn=DB_POOL_SIZE)
+    return _db
+
+def get_watchlist():
+    global _watchlist
+    db = get_db()
+    with _db_lock:
+        if _watchlist is None:
+            _watchlist = WatchlistEngine(db, cache_ttl=WATCHLIST_CACHE_TTL, count_ttl=WATCHLIST_COUNT_TTL)
+    return _watchlist
+
+def get_scorer():
+    """The churn model, loaded by the first what-if request rather than at startup."""
+    global _scorer
+    with _scorer_lock:
+        if _scorer is None:
+            _scorer = ChurnScorer(MODEL_PATH)
+    return _scorer
+
+def _unknown_actions(actions):
+    unknown = [action for action in actions if action not in INTERVENTIONS]
+    if unknown:
+        return JSONResponse({"error": f"Unknown actions {unknown}; expected some of {list(INTERVENTIONS)}"}, status_code=400)
+    return None
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    for subscriber in list(manager.subscribers):
+        await manager.disconnect(subscriber, code=1001)
+    if _db is not None:
+        _db.close()
+
+app = FastAPI(title="ChurnPredict Analytics API", lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=CORS_ORIGINS, allow_methods=["*"], allow_headers=["*"])
+
+# --- REST: plain functions, so FastAPI runs them on its thread pool and the event loop keeps broadcasting ---
+
+@app.get("/api/dashboard-kpis")
+def dashboard_kpis():
+    with get_db().connection() as conn:
+        return fetch_dashboard_kpis(conn)
+
+@app.get("/api/churn-trend")
+def churn_trend(days: int = Query(30, ge=1, le=3660), customer_id: Optional[str] = None):
+    """Average churn probability per day, for everyone or one customer, from the daily rollup that outlives the raw predictions."""
+    with get_db().connection() as conn:
+        return fetch_daily_churn_trend(conn, days, customer_id)
+
+@app.get("/api/watchlist")
+def watchlist(page: int = 1, search: str = '', risk: List[str] = Query([]), contract: List[str] = Query([]),
+              cursor: Optional[str] = None):
+    """One page, highest risk first. Pass the previous page's next_cursor as cursor to read the next one."""
+    try:
+        return get_watchlist().get(page, search, risk, contract, after=cursor)
+    except ValueError:
+        return JSONResponse({"error": f"Invalid cursor {cursor!r}"}, status_code=400)
+
+@app.get("/api/watchlist-stats")
+def watchlist_stats():
+    return get_watchlist().stats()
+
+@app.get("/api/customer/{customer_id}")
+def customer(customer_id: str):
+    with get_db().connection() as conn:
+        result = fetch_customer(conn, customer_id)
+    if result is None:
+        return JSONResponse({"error": f"Customer {customer_id} not found"}, status_code=404)
+    return result
+
+@app.post("/api/customer/{customer_id}/log-intervention")
+def customer_log_intervention(customer_id: str, body: dict):
+    action = body.get('description') or body.get('action_taken')
+    if not action:
+        return JSONResponse({"error": "description is required"}, status_code=400)
+    with get_db().transaction() as conn:
+        with conn.cursor() as cursor:
+            return log_intervention(cursor, customer_id, action, body.get('agent') or 'System')
+
+@app.get("/api/customer/{customer_id}/interventions")
+def customer_interventions(customer_id: str, action: List[str] = Query([])):
+    """The customer's churn probability under each candidate action (all of them unless ?action= picks some)."""
+    error = _unknown_actions(action)
+    if error is not None:
+        return error
+    scorer = get_scorer()
+    with get_db().connection() as conn:
+        customer_ids, columns = fetch_customer_columns(conn, scorer, [customer_id])
+    if not customer_ids:
+        return JSONResponse({"error": f"Customer {customer_id} not found"}, status_code=404)
+    return what_if(scorer, customer_ids, columns, action)[0]
+
+@app.post("/api/interventions/what-if")
+def interventions_what_if(body: dict):
+    """What-if scores for a set of customers, {"customer_ids": [...], "actions": [...]}, in one model call."""
+    customer_ids = list(body.get('customer_ids') or [])
+    actions = list(body.get('actions') or [])
+    if not customer_ids or len(customer_ids) > WHAT_IF_MAX_CUSTOMERS:
+        return JSONResponse({"error": f"customer_ids must list 1 to {WHAT_IF_MAX_CUSTOMERS} customers"}, status_code=400)
+    error = _unknown_actions(actions)
+    if error is not None:
+        return error
+    scorer = get_scorer()
+    with get_db().connection() as conn:
+        found_ids, columns = fetch_customer_columns(conn, scorer, customer_ids)
+    results = {result['customer_id']: result for result in what_if(scorer, found_ids, columns, actions)}
+    return {
+        "results": [results[customer_id] for customer_id in customer_ids if customer_id in results],
+        "not_found": [customer_id for customer_id in customer_ids if customer_id not in results],
+    }
+
+@app.get("/api/interventions/ranking")
+def interventions_ranking(min_risk: float = Query(HIGH_THRESHOLD, ge=0, le=1), limit: int = Query(100, ge=0, le=5000)):
+    """
+    The best action for every customer scored above min_risk, ranked in bulk. Reused for
+    INTERVENTION_RANKING_TTL seconds, since it scores every high-risk customer.
+    """
+    ranking = _rankings.get(min_risk)
+    if ranking is None:
+        with get_db().connection() as conn:
+            ranking = rank_high_risk(conn, get_scorer(), min_risk)
+        _rankings.put(min_risk, ranking)
+    return {"min_risk": min_risk, **summarize_ranking(ranking, limit)}
+
+@app.get("/api/events/history")
+def events_history(limit: int = Query(50, ge=1, le=500)):
+    with get_db().connection() as conn:
+        return fetch_recent_events(conn, limit)
+
+@app.get("/api/churn-alerts-history")
+def churn_alerts_history(limit: int = Query(500, ge=1, le=5000)):
+    with get_db().connection() as conn:
+        return fetch_churn_alerts_history(conn, limit)
+
+@app.get("/api/shap-summary")
+def shap_summary():
+    """The summary written by calculate_shap.py, or an empty list before it has run."""
+    try:
+        with open(SHAP_SUMMARY_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+# --- Live updates ---
+
+@app.post("/api/broadcast-event")
+async def broadcast_event(request: Request):
+    """Receives one message from the stream processor and fans it out to the subscribed clients."""
+    return {"recipients": manager.publish(await request.json())}
+
+@app.post("/api/broadcast-events")
+async def broadcast_events(request: Request):
+    """Receives a list of messages from the stream processor's coalescing sender."""
+    messages = await request.json()
+    return {"recipients": sum(manager.publish(message) for message in messages)}
+
+@app.get("/api/broadcast-stats")
+async def broadcast_stats():
+    return manager.stats()
+
+@app.websocket("/ws/updates")
+async def websocket_updates(websocket: WebSocket, topics: Optional[str] = None):
+    """
+    Streams processor messages. ?topics=events,alerts,kpis,customer:<id> picks what to receive
+    (all but the customer topics by default), and {"action": "subscribe" | "unsubscribe",
+    "topics": [...]} changes it on a live connection.
+    """
+    await websocket.accept()
+    subscriber = manager.connect(websocket, parse_topics(topics))
+    try:
+        while True:
+            try:
+                control = json.loads(await websocket.receive_text())
+                action, requested = control.get('action'), list(control.get('topics') or [])
+            except (ValueError, AttributeError, TypeError):
+                continue
+            if action == 'subscribe':
+                manager.subscribe(subscriber, requested)
+            elif action == 'unsubscribe':
+                manager.unsubscribe(subscriber, requested)
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: the manager already closed a socket that couldn't keep up
+        pass
+    finally:
+        await manager.disconnect(subscriber)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Per-connection deflate would compress every frame once per client, undoing serialize-once
+    uvicorn.run("main:app", host=os.getenv("HOST", "127.0.0.1"), port=int(os.getenv("PORT", "8000")),
+                ws="ws_protocol:BoundedWebSocketProtocol", ws_per_message_deflate=False)
@@ -0,0 +1,26 @@
+import os
+import socket
+
+from uvicorn.protocols.websockets.websockets_sansio_impl import WebSocketsSansIOProtocol
+
+# Bytes a client's socket may hold before send() waits; 0 leaves the OS defaults
+WS_SEND_BUFFER = int(os.getenv("WS_SEND_BUFFER", "16384"))
+
+class BoundedWebSocketProtocol(WebSocketsSansIOProtocol):
+    """
+    uvicorn's sans-I/O WebSocket protocol (whose send() waits while the transport is paused) with
+    a bounded kernel send buffer and transport write buffer per connection. Left to the OS, the
+    kernel can buffer megabytes for a slow reader, which hides it from the broadcaster's
+    per-client queue and delays its alerts behind everything already buffered.
+
+    Used with: uvicorn main:app --ws ws_protocol:BoundedWebSocketProtocol
+    """
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        if not WS_SEND_BUFFER:
+            return
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, WS_SEND_BUFFER)
+        transport.set_write_buffer_limits(high=WS_SEND_BUFFER)
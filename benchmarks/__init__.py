@@ -0,0 +1 @@
+"""Offline benchmarks for the scoring pipeline. Run with: python -m benchmarks.run"""
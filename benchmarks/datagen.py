@@ -0,0 +1,93 @@
+import argparse
+import os
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from common.scorer import DEFAULT_DATA_PATH, ROOT_DIR
+
+sys.path.append(os.path.join(ROOT_DIR, 'event_simulator'))
+from simulator import BATCH_EVENT_UPDATES, EVENT_TYPES, EVENT_WEIGHTS
+
+DATA_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'data')
+
+def load_seed_data(data_path=DEFAULT_DATA_PATH):
+    """Reads the Telco CSV with TotalCharges cleaned the same way db_setup.py does."""
+    df = pd.read_csv(data_path)
+    df['TotalCharges'] = pd.to_numeric(df['TotalCharges'], errors='coerce').fillna(0.0)
+    return df
+
+def iter_user_chunks(n_rows, seed=0, chunk_size=100000, data_path=DEFAULT_DATA_PATH):
+    """
+    Yields DataFrames of synthetic customers, n_rows in total, with the Telco CSV's columns.
+
+    Rows are resampled from the real data, so the mix of contracts, services and payment methods
+    (and how they occur together) stays realistic. Tenure and charges are jittered, and every row
+    gets a new unique customerID. The same n_rows and seed always produce the same data.
+    """
+    seed_df = load_seed_data(data_path)
+    rng = np.random.default_rng(seed)
+    for start in range(0, n_rows, chunk_size):
+        size = min(chunk_size, n_rows - start)
+        chunk = seed_df.iloc[rng.integers(0, len(seed_df), size)].reset_index(drop=True)
+        chunk['customerID'] = [f"{i:07d}-SYN" for i in range(start, start + size)]
+        chunk['tenure'] = np.clip(chunk['tenure'].to_numpy() + rng.integers(-3, 4, size), 0, 72)
+        monthly = chunk['MonthlyCharges'].to_numpy() * rng.normal(1.0, 0.05, size)
+        chunk['MonthlyCharges'] = np.round(np.clip(monthly, 18.0, 120.0), 2)
+        chunk['TotalCharges'] = np.round(chunk['tenure'] * chunk['MonthlyCharges'] * rng.uniform(0.95, 1.05, size), 2)
+        yield chunk
+
+def generate_users(n_rows, seed=0, data_path=DEFAULT_DATA_PATH):
+    """Returns n_rows synthetic customers as one DataFrame."""
+    return pd.concat(list(iter_user_chunks(n_rows, seed, data_path=data_path)), ignore_index=True)
+
+def users_csv_path(n_rows, seed=0):
+    return os.path.join(DATA_DIR, f"users_{n_rows}_seed{seed}.csv")
+
+def write_users_csv(n_rows, seed=0, path=None):
+    """Writes (or reuses) a synthetic users CSV that db_setup.py --data-path can load. Returns its path."""
+    path = path or users_csv_path(n_rows, seed)
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    for i, chunk in enumerate(iter_user_chunks(n_rows, seed)):
+        chunk.to_csv(tmp_path, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+    os.replace(tmp_path, path)
+    return path
+
+def generate_events(user_ids, n_events, seed=0, start_time=None):
+    """
+    Returns n_events simulator-style events for random users, with strictly increasing timestamps
+    and each user's feature_version counting up from 1, as if applied to freshly loaded users.
+    """
+    rng = np.random.default_rng(seed)
+    start_time = start_time or time.time()
+    users = rng.integers(0, len(user_ids), n_events)
+    types = rng.choice(len(EVENT_TYPES), n_events, p=EVENT_WEIGHTS)
+    versions = defaultdict(int)
+    events = []
+    for i, (user, event_type) in enumerate(zip(users.tolist(), types.tolist())):
+        versions[user] += 1
+        events.append({
+            'event_type': EVENT_TYPES[event_type],
+            'user_id': user_ids[user],
+            'details': BATCH_EVENT_UPDATES[EVENT_TYPES[event_type]][1],
+            'feature_version': versions[user],
+            'timestamp': start_time + i * 1e-3,
+        })
+    return events
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a synthetic Telco-style users CSV for benchmarks and load tests.")
+    parser.add_argument("rows", type=int, help="Number of customers to generate, e.g. 1000000.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Output path (default: benchmarks/data/users_<rows>_seed<seed>.csv).")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    output = write_users_csv(args.rows, args.seed, args.output)
+    print(f"Wrote {args.rows} synthetic users to {output} in {time.monotonic() - started:.1f}s.")
@@ -0,0 +1,426 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from common.event_codec import decode_event, encode_event, encode_json, encode_payload
+from common.scorer import DEFAULT_MODEL_PATH, ROOT_DIR, ChurnScorer
+from common.transport import InMemoryBroker, LocalConsumer, LocalProducer, LogBroker
+from benchmarks.datagen import generate_events, generate_users, load_seed_data
+from benchmarks.standins import FakeDatabase, FakeDatabaseFactory, FakePostgres
+
+sys.path.append(os.path.join(ROOT_DIR, 'stream_processor'))
+import processor
+from feature_store import FeatureStore
+from score_cache import ScoreCache
+from worker_pool import WorkerPool, run_worker_pool
+
+RESULTS_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'results')
+TOPIC = 'user_events_topic'
+
+class NullBroadcaster:
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, message):
+        self.published += 1
+
+class RecordingBroadcaster:
+    """Keeps every message, and sets `done` once `expected` have been published."""
+
+    def __init__(self, expected):
+        self.messages = []
+        self.expected = expected
+        self.done = threading.Event()
+
+    def publish(self, message):
+        self.messages.append(message)
+        if len(self.messages) >= self.expected:
+            self.done.set()
+
+@contextlib.contextmanager
+def _stdout_to_devnull():
+    """Silences stdout at the file descriptor, so worker processes spawned meanwhile stay quiet too."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+def measure(fn, ops, repeat=5, warmup=1):
+    """Times fn() repeat times after warmup calls. fn performs ops operations per call."""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return summarize(timings, ops)
+
+def summarize(timings, ops):
+    """The timing fields of a result from per-call seconds, each covering ops operations."""
+    best = min(timings)
+    return {
+        "ops": ops,
+        "repeat": len(timings),
+        "seconds_min": best,
+        "seconds_median": statistics.median(timings),
+        "us_per_op": best / ops * 1e6,
+        "ops_per_s": ops / best,
+    }
+
+def result(name, params, timing):
+    return {"name": name, "params": params, **timing}
+
+# --- BENCHMARKS ---
+# Each takes the shared context and yields result() dicts.
+
+def bench_predict_proba(ctx):
+    """The pickled pipeline's predict_proba on one-row DataFrames vs whole batches."""
+    X = ctx['features_df']
+    pipeline = ctx['scorer'].pipeline
+    single_rows = [X.iloc[[i]] for i in range(min(200, len(X)))]
+    yield result("predict_proba", {"batch_size": 1},
+                 measure(lambda: [pipeline.predict_proba(row) for row in single_rows], len(single_rows), ctx['repeat']))
+    for batch_size in ctx['batch_sizes']:
+        batch = X.iloc[:batch_size]
+        yield result("predict_proba", {"batch_size": len(batch)},
+                     measure(lambda: pipeline.predict_proba(batch), len(batch), ctx['repeat']))
+
+def bench_scorer(ctx):
+    """common.scorer.ChurnScorer: row-at-a-time, batched rows and columnar batches."""
+    scorer = ctx['scorer']
+    records = ctx['records']
+    single = records[:2000]
+    yield result("scorer.score_row", {"batch_size": 1},
+                 measure(lambda: [scorer.score_row(row) for row in single], len(single), ctx['repeat']))
+    for batch_size in ctx['batch_sizes']:
+        rows = records[:batch_size]
+        buffer = scorer.new_buffer(len(rows))
+        yield result("scorer.score_rows", {"batch_size": len(rows)},
+                     measure(lambda: scorer.score_rows(rows, out=buffer), len(rows), ctx['repeat']))
+        columns = ctx['features_df'].iloc[:batch_size]
+        yield result("scorer.score_columns", {"batch_size": len(columns)},
+                     measure(lambda: scorer.score_columns(columns, out=buffer), len(columns), ctx['repeat']))
+
+def bench_feature_fetch(ctx):
+    """get_user_features (one query + DataFrame build and rename) vs the dict and cached paths."""
+    fake = FakePostgres(ctx['users_df'])
+    conn = fake.connect()
+    user_ids = ctx['user_ids'][:2000]
+    yield result("get_user_features", {"path": "dataframe"},
+                 measure(lambda: [processor.get_user_features(conn, user_id) for user_id in user_ids], len(user_ids), ctx['repeat']))
+    batch_ids = ctx['user_ids'][:500]
+    yield result("get_user_features", {"path": "batch_dicts", "batch_size": len(batch_ids)},
+                 measure(lambda: processor.get_users_features_batch(conn, batch_ids), len(batch_ids), ctx['repeat']))
+    feature_store = FeatureStore(max_size=len(ctx['user_ids']))
+    with contextlib.redirect_stdout(io.StringIO()):
+        feature_store.load(conn)
+    yield result("get_user_features", {"path": "feature_cache", "batch_size": len(batch_ids)},
+                 measure(lambda: feature_store.get_many(conn, batch_ids), len(batch_ids), ctx['repeat']))
+
+def bench_json(ctx):
+    """Event JSON encode/decode as the producer and consumer do it, and the broadcast message encode."""
+    events = ctx['events'][:10000]
+    encoded = [json.dumps(event).encode('utf-8') for event in events]
+    yield result("json.event_encode", {}, measure(lambda: [json.dumps(event).encode('utf-8') for event in events], len(events), ctx['repeat']))
+    yield result("json.event_decode", {}, measure(lambda: [json.loads(data.decode('utf-8')) for data in encoded], len(encoded), ctx['repeat']))
+    messages = [processor.build_broadcast_message(event, 0.5) for event in events]
+    yield result("json.broadcast_encode", {}, measure(lambda: [json.dumps(message) for message in messages], len(messages), ctx['repeat']))
+
+def bench_event_codec(ctx):
+    """
+    What the simulator spends serializing events and the processor spends parsing them and
+    building the events row, JSON (before) versus the binary codec, with the bytes each puts on
+    the wire and in the row's payload column.
+    """
+    events = ctx['events'][:10000]
+    formats = {
+        'json': (encode_json, lambda event: json.dumps(event)),
+        'binary': (encode_event, encode_payload),
+    }
+    for encoding, (serialize, row_payload) in formats.items():
+        encoded = [serialize(event) for event in events]
+        sizes = {
+            "wire_bytes_per_event": sum(map(len, encoded)) / len(encoded),
+            "row_bytes_per_event": sum(len(payload or b'') for payload in map(row_payload, events)) / len(events),
+        }
+        yield {**result("event_codec.produce", {"encoding": encoding},
+                        measure(lambda: [serialize(event) for event in events], len(events), ctx['repeat'])), **sizes}
+        yield {**result("event_codec.consume", {"encoding": encoding},
+                        measure(lambda: [row_payload(decode_event(data)) for data in encoded], len(encoded), ctx['repeat'])),
+               **sizes}
+
+def _new_broker(ctx, run_id):
+    if ctx['transport'] == 'log':
+        return LogBroker(os.path.join(ctx['log_dir'], run_id), num_partitions=8)
+    return InMemoryBroker(num_partitions=8)
+
+def _full_loop(ctx, mode, use_cache, use_score_cache=False):
+    """Produces the events, then consumes, scores and writes them all. Returns the events processed."""
+    events = ctx['events']
+    run_id = f"{mode}-{use_cache}-{use_score_cache}-{time.time_ns()}"
+    broker = _new_broker(ctx, run_id)
+    producer = LocalProducer(broker)
+    for event in events:
+        producer.send(TOPIC, value=event, key=event['user_id'])
+    producer.flush()
+
+    fake = FakePostgres(ctx['users_df'], ctx['db_latency_ms'])
+    db = FakeDatabase(fake)
+    scorer = ctx['scorer']
+    broadcaster = NullBroadcaster()
+    consumer = LocalConsumer(broker, TOPIC, group_id=run_id, enable_auto_commit=(mode == 'single'))
+    feature_store = None
+    score_cache = ScoreCache(max_size=len(ctx['user_ids'])) if use_score_cache else None
+    # The processor prints alerts; keep the cost of formatting them but not the terminal I/O
+    with contextlib.redirect_stdout(io.StringIO()):
+        if use_cache:
+            feature_store = FeatureStore(max_size=len(ctx['user_ids']))
+            with db.connection() as conn:
+                feature_store.load(conn)
+        processed = 0
+        if mode == 'single':
+            while processed < len(events):
+                for records in consumer.poll(timeout_ms=100).values():
+                    for message in records:
+                        broadcast_data = db.run(
+                            processor.handle_event, message.value, scorer, feature_store, None, score_cache
+                        )
+                        if score_cache is not None:
+                            score_cache.commit()
+                        if broadcast_data is not None:
+                            broadcaster.publish(broadcast_data)
+                        processed += 1
+        else:
+            buffer = scorer.new_buffer(ctx['max_batch_size'])
+            while processed < len(events):
+                messages = processor.poll_batch(consumer, ctx['max_batch_size'], 0)
+                for broadcast_data in db.run(
+                    processor.process_batch, messages, scorer, feature_store, buffer, None, score_cache
+                ):
+                    broadcaster.publish(broadcast_data)
+                if score_cache is not None:
+                    score_cache.commit()
+                consumer.commit()
+                processed += len(messages)
+    consumer.close()
+    if ctx['transport'] == 'log':
+        broker.close()
+        shutil.rmtree(os.path.join(ctx['log_dir'], run_id), ignore_errors=True)
+    return processed
+
+def bench_full_loop(ctx):
+    """Produce -> consume -> score -> write -> broadcast over the stand-in broker and database."""
+    for mode, use_cache, use_score_cache in (
+        ('single', False, False), ('single', True, False), ('single', True, True),
+        ('batch', False, False), ('batch', True, False), ('batch', True, True),
+    ):
+        params = {
+            "mode": mode, "feature_cache": use_cache, "transport": ctx['transport'],
+            "events": len(ctx['events']), "db_latency_ms": ctx['db_latency_ms'],
+        }
+        if mode == 'batch':
+            params["max_batch_size"] = ctx['max_batch_size']
+        # Only set when on, so results stay comparable with files from before the score cache
+        if use_score_cache:
+            params["score_cache"] = True
+        yield result("full_loop", params, measure(
+            lambda: _full_loop(ctx, mode, use_cache, use_score_cache), len(ctx['events']), ctx['repeat'], warmup=0
+        ))
+
+def _worker_pool_run(ctx, n_workers, failures=0):
+    """
+    Runs the events through run_worker_pool with n_workers workers, each over its own stand-in
+    database whose first `failures` transactions fail. Checks that every event was broadcast,
+    each user's events in feature_version order, and that every offset was committed.
+    Returns the seconds from the first poll until the pool stopped.
+    """
+    events = ctx['events']
+    run_id = f"pool-{n_workers}-{failures}-{time.time_ns()}"
+    broker = _new_broker(ctx, run_id)
+    producer = LocalProducer(broker)
+    for event in events:
+        producer.send(TOPIC, value=event, key=event['user_id'])
+    producer.flush()
+
+    broadcaster = RecordingBroadcaster(len(events))
+    consumer = LocalConsumer(broker, TOPIC, group_id=run_id, enable_auto_commit=False)
+    pool = WorkerPool(n_workers, DEFAULT_MODEL_PATH, ctx['max_batch_size'],
+                      db_factory=FakeDatabaseFactory(ctx['users_df'], ctx['db_latency_ms'], failures))
+    with _stdout_to_devnull():
+        pool.start()
+        started = time.perf_counter()
+        run_worker_pool(consumer, pool, broadcaster, ctx['max_batch_size'], max_linger_ms=0,
+                        stopping=broadcaster.done)
+        elapsed = time.perf_counter() - started
+
+    problems = []
+    if len(broadcaster.messages) != len(events):
+        problems.append(f"{len(broadcaster.messages)} of {len(events)} events broadcast")
+    last_version = {}
+    for message in broadcaster.messages:
+        payload = message['payload']
+        if payload['feature_version'] <= last_version.get(payload['user_id'], 0):
+            problems.append(f"user {payload['user_id']} broadcast out of order")
+            break
+        last_version[payload['user_id']] = payload['feature_version']
+    for tp in consumer.assignment():
+        if broker.committed(run_id, tp) != broker.end_offset(tp):
+            problems.append(f"{tp} committed {broker.committed(run_id, tp)} of {broker.end_offset(tp)}")
+    if pool.failed_batches < min(failures, 1) * n_workers:
+        problems.append(f"expected every worker to retry, saw {pool.failed_batches} failed batches")
+    consumer.close()
+    if ctx['transport'] == 'log':
+        broker.close()
+        shutil.rmtree(os.path.join(ctx['log_dir'], run_id), ignore_errors=True)
+    if problems:
+        raise RuntimeError(f"worker_pool ({n_workers} workers, {failures} failures): " + "; ".join(problems))
+    return elapsed
+
+def bench_worker_pool(ctx):
+    """The multi-process worker pool end to end, over the stand-in broker and per-worker stand-in databases."""
+    # One untimed run in which every worker's first transaction fails, to cover the retry path
+    _worker_pool_run(ctx, 2, failures=1)
+    for n_workers in ctx['pool_workers']:
+        params = {
+            "workers": n_workers, "transport": ctx['transport'], "events": len(ctx['events']),
+            "db_latency_ms": ctx['db_latency_ms'], "max_batch_size": ctx['max_batch_size'],
+        }
+        # Spawning the workers and loading the model aren't part of the timing
+        timings = [_worker_pool_run(ctx, n_workers) for _ in range(ctx['repeat'])]
+        yield result("worker_pool", params, summarize(timings, len(ctx['events'])))
+
+BENCHMARKS = {
+    "predict_proba": bench_predict_proba,
+    "scorer": bench_scorer,
+    "feature_fetch": bench_feature_fetch,
+    "json": bench_json,
+    "event_codec": bench_event_codec,
+    "full_loop": bench_full_loop,
+    "worker_pool": bench_worker_pool,
+}
+
+# --- RESULTS ---
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def environment():
+    import sklearn
+    import xgboost
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "scikit-learn": sklearn.__version__,
+        "xgboost": xgboost.__version__,
+        "git_commit": _git_commit(),
+    }
+
+def result_key(entry):
+    return f"{entry['name']} {json.dumps(entry['params'], sort_keys=True)}"
+
+def compare(baseline_path, results, threshold):
+    """Prints throughput changes against a previous results file. Returns the regressions beyond threshold."""
+    with open(baseline_path) as f:
+        baseline = {result_key(entry): entry for entry in json.load(f)["results"]}
+    regressions = []
+    print(f"\nComparison with {baseline_path} (regression threshold {threshold:.0%}):")
+    for entry in results:
+        old = baseline.get(result_key(entry))
+        if old is None:
+            continue
+        change = entry["ops_per_s"] / old["ops_per_s"] - 1
+        flag = ""
+        if change < -threshold:
+            flag = "  <-- REGRESSION"
+            regressions.append(result_key(entry))
+        print(f"  {result_key(entry):<90} {old['ops_per_s']:>12,.0f} -> {entry['ops_per_s']:>12,.0f} ops/s ({change:+.1%}){flag}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the scoring pipeline benchmarks without any live services.")
+    parser.add_argument("--rows", type=int, default=0,
+                        help="Synthetic customers to generate (default 0: use the 7,043-row Telco CSV as-is).")
+    parser.add_argument("--events", type=int, default=20000, help="Events pushed through the full-loop benchmark.")
+    parser.add_argument("--batch-sizes", default="100,1000,10000", help="Comma-separated scoring batch sizes.")
+    parser.add_argument("--max-batch-size", type=int, default=500, help="Processor micro-batch size in the full loop.")
+    parser.add_argument("--transport", choices=["memory", "log"], default="memory", help="Broker stand-in for the full loop.")
+    parser.add_argument("--pool-workers", default="1,2", help="Comma-separated worker counts for the worker pool benchmark.")
+    parser.add_argument("--db-latency-ms", type=float, default=0.0, help="Simulated round-trip time per database statement.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed repetitions per benchmark (the fastest is reported).")
+    parser.add_argument("--only", default="", help=f"Comma-separated subset of: {', '.join(BENCHMARKS)}.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Results file (default: benchmarks/results/<timestamp>.json).")
+    parser.add_argument("--compare", default=None, help="Previous results file to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Throughput drop that counts as a regression.")
+    args = parser.parse_args()
+
+    print("Preparing data...")
+    users_df = generate_users(args.rows, args.seed) if args.rows else load_seed_data()
+    features_df = users_df.drop(columns=['customerID', 'Churn'])
+    user_ids = users_df['customerID'].tolist()
+    ctx = {
+        "scorer": ChurnScorer(),
+        "users_df": users_df,
+        "features_df": features_df,
+        "records": features_df.to_dict('records'),
+        "user_ids": user_ids,
+        "events": generate_events(user_ids, args.events, args.seed),
+        "batch_sizes": sorted({min(int(size), len(users_df)) for size in args.batch_sizes.split(',')}),
+        "max_batch_size": args.max_batch_size,
+        "transport": args.transport,
+        "log_dir": os.path.join(RESULTS_DIR, 'event_log'),
+        "db_latency_ms": args.db_latency_ms,
+        "pool_workers": [int(n) for n in args.pool_workers.split(',')],
+        "repeat": args.repeat,
+    }
+
+    selected = [name for name in args.only.split(',') if name] or list(BENCHMARKS)
+    results = []
+    for name in selected:
+        for entry in BENCHMARKS[name](ctx):
+            results.append(entry)
+            print(f"{result_key(entry):<90} {entry['us_per_op']:>10.2f} us/op {entry['ops_per_s']:>14,.0f} ops/s")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            "created_at": datetime.now().isoformat(),
+            "args": vars(args),
+            "dataset_rows": len(users_df),
+            "environment": environment(),
+            "results": results,
+        }, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        regressions = compare(args.compare, results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}.")
+            sys.exit(1)
@@ -0,0 +1,175 @@
+import re
+import time
+from contextlib import contextmanager
+
+import psycopg2
+
+from common.db import PREPARED_STATEMENTS
+
+# Lowercase column names, in the order Postgres returns them for SELECT * FROM users
+USER_COLUMNS = [
+    'customerid', 'gender', 'seniorcitizen', 'partner', 'dependents', 'tenure',
+    'phoneservice', 'multiplelines', 'internetservice', 'onlinesecurity',
+    'onlinebackup', 'deviceprotection', 'techsupport', 'streamingtv',
+    'streamingmovies', 'contract', 'paperlessbilling', 'paymentmethod',
+    'monthlycharges', 'totalcharges', 'feature_version',
+]
+
+_EXECUTE = re.compile(r'^EXECUTE (\w+)')
+_INSERT = re.compile(r'^\s*INSERT INTO (\w+)')
+_LIMIT = re.compile(r'LIMIT\s+(\d+)', re.IGNORECASE)
+
+class FakePostgres:
+    """
+    An in-memory stand-in for the pipeline's Postgres tables: answers the users lookups the
+    processor and feature cache issue and counts the rows inserted into each table, optionally sleeping
+    round_trip_ms per statement to model network latency. It does not model psycopg2's own
+    parameter encoding, so compare stand-in and real-database numbers separately.
+    """
+
+    def __init__(self, users_df, round_trip_ms=0.0):
+        self.round_trip = round_trip_ms / 1000.0
+        frame = users_df[[column for column in users_df.columns if column.lower() in USER_COLUMNS]]
+        # object dtype so values come back as plain Python ints/floats/strs, as psycopg2 returns them
+        # Every user starts at feature_version 0, as db_setup.py loads them
+        frame = frame.rename(columns=str.lower).reindex(columns=USER_COLUMNS, fill_value=0).astype(object)
+        self.users = {row[0]: row for row in frame.itertuples(index=False, name=None)}
+        self.rows_written = {'events': 0, 'predictions': 0}
+        self.statements = 0
+        self.commits = 0
+
+    def connect(self):
+        return FakeConnection(self)
+
+class FakeConnection:
+    encoding = 'UTF8'
+    closed = 0
+
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.db.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+class FakeCursor:
+    """Implements the subset of psycopg2's cursor the processor, feature cache and execute_values use."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rowcount = -1
+        self.itersize = 2000
+        self._rows = []
+        self._mogrified = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        pass
+
+    def mogrify(self, template, args):
+        self._mogrified += 1
+        return repr(tuple(args)).encode('utf-8')
+
+    def execute(self, sql, params=None):
+        db = self.connection.db
+        db.statements += 1
+        if db.round_trip:
+            time.sleep(db.round_trip)
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8', 'replace')
+        if sql.startswith('PREPARE '):
+            return
+        match = _EXECUTE.match(sql)
+        if match:
+            sql = PREPARED_STATEMENTS[match.group(1)]
+
+        self.description = None
+        self._rows = []
+        if 'FROM users WHERE customerID = ANY' in sql:
+            self._select([db.users[user_id] for user_id in params[0] if user_id in db.users])
+        elif 'FROM users WHERE customerID = %s' in sql:
+            row = db.users.get(params[0])
+            self._select([row] if row is not None else [])
+        elif sql.startswith('SELECT * FROM users'):
+            limit = _LIMIT.search(sql)
+            rows = list(db.users.values())
+            self._select(rows[:int(params[0]) if params and limit else len(rows)])
+        else:
+            match = _INSERT.match(sql)
+            if match:
+                self.rowcount = max(1, self._mogrified)
+                db.rows_written[match.group(1)] = db.rows_written.get(match.group(1), 0) + self.rowcount
+        self._mogrified = 0
+
+    def _select(self, rows):
+        self.description = [(column,) for column in USER_COLUMNS]
+        self._rows = rows
+        self.rowcount = len(rows)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def __iter__(self):
+        rows, self._rows = self._rows, []
+        return iter(rows)
+
+class FakeDatabase:
+    """
+    Drop-in for common.db.Database over a FakePostgres. The first `failures` calls to run()
+    raise a lost-connection error before doing any work, to exercise the callers' retry paths.
+    """
+
+    def __init__(self, db, failures=0):
+        self.db = db
+        self._conn = db.connect()
+        self.reconnects = 0
+        self.failures = failures
+
+    @contextmanager
+    def connection(self):
+        yield self._conn
+
+    @contextmanager
+    def transaction(self):
+        yield self._conn
+        self._conn.commit()
+
+    def run(self, work, *args, **kwargs):
+        if self.failures > 0:
+            self.failures -= 1
+            raise psycopg2.OperationalError("injected database failure")
+        with self.transaction() as conn:
+            return work(conn, *args, **kwargs)
+
+    def close(self):
+        pass
+
+class FakeDatabaseFactory:
+    """Picklable db_factory for WorkerPool: every worker process gets its own FakeDatabase."""
+
+    def __init__(self, users_df, round_trip_ms=0.0, failures=0):
+        self.users_df = users_df
+        self.round_trip_ms = round_trip_ms
+        self.failures = failures
+
+    def __call__(self):
+        return FakeDatabase(FakePostgres(self.users_df, self.round_trip_ms), self.failures)
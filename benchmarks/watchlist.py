@@ -0,0 +1,210 @@
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from common.db import get_db_connection
+from common.scorer import ROOT_DIR, ChurnScorer
+from common.watchlist import WatchlistEngine, create_watchlist_indexes, detect_search_mode, fetch_tier_contract_counts
+from benchmarks.datagen import write_users_csv
+from benchmarks.run import RESULTS_DIR, environment
+from db_setup import create_current_risk_table, create_users_table, load_users_copy
+
+load_dotenv(os.path.join(ROOT_DIR, '.env'))
+
+# The benchmark tables live in their own schema, so it can run against a real database
+SCHEMA = 'watchlist_bench'
+CONTRACTS = ['Month-to-month', 'One year', 'Two year']
+
+def use_schema(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(f"SET search_path TO {SCHEMA}, public;")
+    conn.commit()
+
+def prepare(conn, rows, seed, rebuild=False):
+    """Creates users and current_risk with rows synthetic customers scored by the real model, unless they exist."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (f"{SCHEMA}.current_risk",))
+        if cursor.fetchone()[0] and not rebuild:
+            cursor.execute(f"SELECT COUNT(*) FROM {SCHEMA}.current_risk;")
+            if cursor.fetchone()[0] == rows:
+                conn.commit()
+                use_schema(conn)
+                print(f"Reusing {rows:,} customers in schema '{SCHEMA}'.")
+                return
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {SCHEMA};")
+    conn.commit()
+    use_schema(conn)
+
+    with conn.cursor() as cursor:
+        create_users_table(cursor)
+        create_current_risk_table(cursor)
+    conn.commit()
+    data_path = write_users_csv(rows, seed)
+    load_users_copy(conn, data_path, chunk_size=100000)
+
+    print("Scoring customers into current_risk...")
+    scorer = ChurnScorer()
+    rng = np.random.default_rng(seed)
+    now = time.time()
+    started = time.monotonic()
+    with conn.cursor() as cursor:
+        for chunk in pd.read_csv(data_path, chunksize=100000, dtype={'customerID': str}):
+            chunk['TotalCharges'] = pd.to_numeric(chunk['TotalCharges'], errors='coerce').fillna(0.0)
+            probabilities = scorer.score_columns(chunk[scorer.input_columns])
+            timestamps = pd.to_datetime(now - rng.uniform(0, 86400, len(chunk)), unit='s', utc=True)
+            buffer = io.StringIO()
+            pd.DataFrame({
+                'user_id': chunk['customerID'], 'churn_probability': probabilities,
+                'prediction_timestamp': timestamps, 'contract': chunk['Contract'],
+            }).to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cursor.copy_expert(
+                "COPY current_risk (user_id, churn_probability, prediction_timestamp, contract) FROM STDIN WITH (FORMAT csv)", buffer
+            )
+        conn.commit()
+    print(f"Scored {rows:,} customers in {time.monotonic() - started:.1f}s.")
+
+    print("Creating keys and indexes...")
+    with conn.cursor() as cursor:
+        cursor.execute("ALTER TABLE users ADD PRIMARY KEY (customerID);")
+        create_watchlist_indexes(cursor)
+        cursor.execute("ANALYZE users;")
+        cursor.execute("ANALYZE current_risk;")
+    conn.commit()
+
+def sample_ids(conn, n, seed):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT customerID FROM users TABLESAMPLE SYSTEM (1) REPEATABLE (%s) LIMIT %s;", (seed, n))
+        ids = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    return ids
+
+def scenarios(conn, seed):
+    """Named lists of watchlist requests, the filter combinations and searches the page sends."""
+    rng = random.Random(seed)
+    ids = sample_ids(conn, 200, seed)
+    # Search-as-you-type: every prefix of an ID, as the debounced requests see it
+    typing = [{"search": customer_id[:length]} for customer_id in ids[:20] for length in range(1, len(customer_id) + 1)]
+    return {
+        "first_page": [{}],
+        "risk_high_critical": [{"risks": ["High", "Critical"]}],
+        "risk_and_contract": [{"risks": ["High", "Critical"], "contracts": ["Month-to-month"]}],
+        "rare_combination": [{"risks": ["Critical"], "contracts": ["Two year"]}],
+        "low_risk_contract": [{"risks": ["Low"], "contracts": [rng.choice(CONTRACTS)]} for _ in range(5)],
+        "id_search": [{"search": customer_id[:rng.randint(4, len(customer_id))]} for customer_id in ids[:50]],
+        "search_as_you_type": typing,
+        "search_with_filters": [{"search": customer_id[:5], "risks": ["High", "Critical"]} for customer_id in ids[:50]],
+    }
+
+def latency_summary(latencies_ms):
+    latencies_ms = sorted(latencies_ms)
+    return {
+        "requests": len(latencies_ms),
+        "p50_ms": latencies_ms[len(latencies_ms) // 2],
+        "p99_ms": latencies_ms[min(len(latencies_ms) - 1, int(0.99 * len(latencies_ms)))],
+        "max_ms": latencies_ms[-1],
+        "mean_ms": statistics.fmean(latencies_ms),
+    }
+
+def time_requests(fn, requests, repeat):
+    latencies = []
+    for _ in range(repeat):
+        for request in requests:
+            started = time.perf_counter()
+            fn(request)
+            latencies.append((time.perf_counter() - started) * 1000)
+    return latency_summary(latencies)
+
+def bench_filters(conn, engine, search_mode, seed, repeat):
+    """
+    Every scenario's first page through the engine with its caches off, i.e. what a cache miss
+    costs. The (tier, contract) counts are recounted on their own schedule, so they are timed apart.
+    """
+    yield "tier_contract_recount", {}, time_requests(lambda _: fetch_tier_contract_counts(conn), [None], repeat)
+    engine.tier_contract_counts(conn)
+    for name, requests in scenarios(conn, seed).items():
+        yield name, {"search_mode": search_mode}, time_requests(
+            lambda request: engine.fetch(conn, **request, use_cache=False), requests, repeat
+        )
+
+def bench_pagination(conn, engine, pages):
+    """Walks the first pages of the unfiltered list with page numbers (OFFSET) and with next_cursor."""
+    offset_latencies = []
+    for page in range(1, pages + 1):
+        started = time.perf_counter()
+        engine.fetch(conn, page, use_cache=False)
+        offset_latencies.append((time.perf_counter() - started) * 1000)
+    yield "offset_pages", {"pages": pages}, latency_summary(offset_latencies)
+
+    cursor_latencies = []
+    after = None
+    for page in range(1, pages + 1):
+        started = time.perf_counter()
+        result = engine.fetch(conn, page, after=after, use_cache=False)
+        cursor_latencies.append((time.perf_counter() - started) * 1000)
+        after = result['next_cursor']
+    yield "cursor_pages", {"pages": pages}, latency_summary(cursor_latencies)
+
+def bench_traffic(conn, engine, seed, requests_count):
+    """A skewed mix of the scenarios with the cache on: most requests repeat a few popular filter combinations."""
+    rng = random.Random(seed)
+    pool = [request for requests in scenarios(conn, seed).values() for request in requests]
+    weights = [1 / (rank + 1) for rank in range(len(pool))]
+    traffic = rng.choices(pool, weights, k=requests_count)
+    engine.clear()
+    summary = time_requests(lambda request: engine.fetch(conn, **request), traffic, 1)
+    yield "cached_traffic", {"requests": requests_count}, {**summary, **engine.stats()}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks /api/watchlist queries against Postgres on a synthetic customer table.")
+    parser.add_argument("--rows", type=int, default=1000000, help="Customers in the benchmark table.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rebuild", action="store_true", help="Recreate the benchmark schema even if it has --rows customers.")
+    parser.add_argument("--repeat", type=int, default=3, help="Times each scenario's requests are sent.")
+    parser.add_argument("--pages", type=int, default=500, help="Pages walked in the pagination comparison.")
+    parser.add_argument("--requests", type=int, default=5000, help="Requests in the cached traffic mix.")
+    parser.add_argument("--target-p99-ms", type=float, default=50.0, help="Cache-miss p99 every filter scenario must meet.")
+    parser.add_argument("--output", default=None, help="Results file (default: benchmarks/results/watchlist-<timestamp>.json).")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        prepare(conn, args.rows, args.seed, args.rebuild)
+        search_mode = detect_search_mode(conn)
+        engine = WatchlistEngine(None)
+        print(f"Search mode: {search_mode}. Running scenarios...")
+
+        results = []
+        for name, params, summary in [
+            *bench_filters(conn, engine, search_mode, args.seed, args.repeat),
+            *bench_pagination(conn, engine, args.pages),
+            *bench_traffic(conn, engine, args.seed, args.requests),
+        ]:
+            results.append({"name": name, "params": params, **summary})
+            print(f"  {name:<22} {summary['requests']:>6} requests  p50={summary['p50_ms']:>8.2f}ms "
+                  f"p99={summary['p99_ms']:>8.2f}ms  max={summary['max_ms']:>8.2f}ms")
+    finally:
+        conn.close()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = args.output or os.path.join(RESULTS_DIR, f"watchlist-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, 'w') as f:
+        json.dump({"environment": environment(), "rows": args.rows, "search_mode": search_mode, "results": results}, f, indent=2)
+    print(f"Results written to {output}")
+
+    # The recount runs once per count_ttl, and OFFSET pages are only there for comparison
+    slow = [entry['name'] for entry in results
+            if entry['name'] not in ('tier_contract_recount', 'offset_pages') and entry['p99_ms'] > args.target_p99_ms]
+    if slow:
+        print(f"p99 above the {args.target_p99_ms:.0f}ms target: {', '.join(slow)}")
+        sys.exit(1)
@@ -1,86 +1,200 @@
-import pandas as pd
-import shap
-import xgboost as xgb
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import OneHotEncoder
-from sklearn.compose import ColumnTransformer
+import os
 import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from common.scorer import DEFAULT_DATA_PATH, DEFAULT_MODEL_PATH, ROOT_DIR, ChurnScorer
+
+load_dotenv()
+
+DEFAULT_CACHE_DIR = os.path.join(ROOT_DIR, 'ml_model', 'shap_cache')
+DEFAULT_OUTPUT_PATH = 'shap_summary.json'
+DEFAULT_CHUNK_SIZE = 2000
+
+# Each SHAP worker process loads its own copy of the model once
+_worker_scorer = None
+
+def model_hash(model_path=DEFAULT_MODEL_PATH):
+    """Short content hash of the model file. Attributions are only reused for the exact same model."""
+    digest = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+def cache_path_for(model_path=DEFAULT_MODEL_PATH, cache_dir=DEFAULT_CACHE_DIR):
+    return os.path.join(cache_dir, f"shap_{model_hash(model_path)}.npz")
+
+def load_customers(input_columns, source='csv', data_path=DEFAULT_DATA_PATH):
+    """Returns (customer IDs, model input columns) from the Telco CSV or the live 'users' table."""
+    if source == 'csv':
+        df = pd.read_csv(data_path)
+        df['TotalCharges'] = pd.to_numeric(df['TotalCharges'], errors='coerce').fillna(0.0)
+        return df['customerID'].to_numpy(dtype=str), df
+
+    from common.db import get_db_connection
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT * FROM users;")
+            columns = [desc[0] for desc in cursor.description]
+            df = pd.DataFrame(cursor.fetchall(), columns=columns)
+    finally:
+        conn.close()
+    # Postgres folds the unquoted column names to lowercase; map them back to the model's names
+    df = df.rename(columns={column.lower(): column for column in ['customerID'] + input_columns})
+    return df['customerID'].to_numpy(dtype=str), df
+
+def fingerprint_rows(X):
+    """One 64-bit hash per encoded feature row; a customer is re-explained only when theirs changes."""
+    X = np.ascontiguousarray(X)
+    row_bytes = X.view(np.uint8).reshape(len(X), -1)
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(row.tobytes(), digest_size=8).digest(), 'little') for row in row_bytes),
+        dtype=np.uint64, count=len(X),
+    )
+
+def load_cache(path):
+    """Loads a SHAP cache written by save_cache, or returns None if there isn't one."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        return {key: data[key] for key in data.files}
+
+def save_cache(path, cache):
+    """Writes the cache to a temp file and renames it into place, so readers never see a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path, **cache)
+    os.replace(tmp_path, path)
+
+def _init_shap_worker(model_path):
+    """Process-pool initializer: loads the scorer once per worker, single-threaded so workers don't oversubscribe cores."""
+    global _worker_scorer
+    _worker_scorer = ChurnScorer(model_path, nthread=1)
+
+def _contributions_chunk(X):
+    return _worker_scorer.contributions_encoded(X)
 
-def calculate_and_store_shap():
+def compute_contributions(scorer, X, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """SHAP attributions for every row of an encoded matrix, split into chunks across a process pool."""
+    if len(X) == 0:
+        return np.empty((0, scorer.n_features + 1), dtype=np.float32)
+    chunks = [X[start:start + chunk_size] for start in range(0, len(X), chunk_size)]
+    if workers <= 1 or len(chunks) == 1:
+        return np.concatenate([scorer.contributions_encoded(chunk) for chunk in chunks])
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_shap_worker, initargs=(scorer.model_path,)) as pool:
+        return np.concatenate(list(pool.map(_contributions_chunk, chunks)))
+
+def summarize(cache, top_k=10):
+    """Mean absolute attribution per encoded feature over all cached customers, largest first."""
+    importance = np.abs(cache['contributions']).mean(axis=0, dtype=np.float64)
+    order = np.argsort(-importance)[:top_k]
+    return [{"feature": str(cache['feature_names'][i]), "importance": float(importance[i])} for i in order]
+
+def customer_attributions(cache, customer_id, top_k=5):
     """
-    Main function to fetch data from a CSV file, train a model, calculate SHAP values,
-    and store the aggregated results in a JSON file.
+    Returns a customer's top_k features by absolute attribution as [{"feature", "contribution"}]
+    (log-odds; positive pushes towards churn), or None if the customer isn't in the cache.
+    Customer IDs are stored sorted, so this is a binary search rather than a scan.
     """
-    try:
-        # --- MODIFIED STEP 1: Read data from a local CSV file ---
-        # IMPORTANT: Replace with the actual path and name of your CSV file.
-        # The path '../ml_model/' assumes the ml_model folder is outside your backend folder.
-        csv_path = 'E:\churn-dashboard\ml_model\WA_Fn-UseC_-Telco-Customer-Churn.csv' 
-        print(f"Reading user data from {csv_path}...")
-        df = pd.read_csv(csv_path)
-        print(f"Successfully loaded {len(df)} user records from CSV.")
-        
-        # --- Data Cleaning (ensure column names match your CSV) ---
-        # This assumes your CSV has a column named 'TotalCharges' and 'Churn'.
-        # Please verify these names against your actual file.
-        df['TotalCharges'] = pd.to_numeric(df['TotalCharges'], errors='coerce')
-        df.dropna(inplace=True)
-        # The column name 'Churn' might be different in your file.
-        df['Churn_encoded'] = df['Churn'].apply(lambda x: 1 if x == 'Yes' else 0)
-
-        # --- Steps 2-6: Model Training & SHAP Calculation (largely unchanged) ---
-        features_to_use = [col for col in df.columns if col not in ['customerID', 'Churn', 'Churn_encoded']]
-        X = df[features_to_use]
-        y = df['Churn_encoded'] # Use the newly encoded target column
-
-        categorical_features = X.select_dtypes(include=['object']).columns
-        numerical_features = X.select_dtypes(include=['int64', 'float64']).columns
-
-        preprocessor = ColumnTransformer(
-            transformers=[
-                ('num', 'passthrough', numerical_features),
-                ('cat', OneHotEncoder(handle_unknown='ignore'), categorical_features)
-            ])
-
-        X_processed = preprocessor.fit_transform(X)
-        feature_names = list(numerical_features) + \
-                        list(preprocessor.named_transformers_['cat'].get_feature_names_out(categorical_features))
-
-        print("Training XGBoost churn prediction model...")
-        X_train, X_test, y_train, y_test = train_test_split(X_processed, y, test_size=0.2, random_state=42)
-        model = xgb.XGBClassifier(use_label_encoder=False, eval_metric='logloss', random_state=42)
-        model.fit(X_train, y_train)
-        print("Model training complete.")
-
-        print("Calculating SHAP values...")
-        explainer = shap.TreeExplainer(model)
-        shap_values = explainer.shap_values(X_test)
-        
-        shap_df = pd.DataFrame(abs(shap_values), columns=feature_names)
-        mean_shap_values = shap_df.mean().sort_values(ascending=False)
-        
-        # --- Step 7: Store results in a JSON file ---
-        print("Saving SHAP summary to shap_summary.json...")
-        
-        shap_results = [
-            {"feature": feature, "importance": importance} 
-            for feature, importance in mean_shap_values.head(10).items()
-        ]
-
-        # This will save the file in the same directory where you run the script (e.g., inside churn_backend)
-        with open("shap_summary.json", "w") as f:
-            json.dump(shap_results, f, indent=4)
-            
-        print("Successfully saved results to shap_summary.json.")
-
-    except FileNotFoundError:
-        print(f"ERROR: The file was not found at the specified path: {csv_path}")
-        print("Please make sure the file exists and the path is correct.")
-    except KeyError as e:
-        print(f"ERROR: A column name was not found in the CSV file: {e}")
-        print("Please check that the column names in the script match your CSV headers exactly.")
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+    customer_ids = cache['customer_ids']
+    index = int(np.searchsorted(customer_ids, customer_id))
+    if index == len(customer_ids) or customer_ids[index] != customer_id:
+        return None
+    row = cache['contributions'][index]
+    order = np.argsort(-np.abs(row))[:top_k]
+    return [{"feature": str(cache['feature_names'][i]), "contribution": float(row[i])} for i in order]
+
+def calculate_and_store_shap(source='csv', data_path=DEFAULT_DATA_PATH, model_path=DEFAULT_MODEL_PATH,
+                             cache_dir=DEFAULT_CACHE_DIR, output_path=DEFAULT_OUTPUT_PATH,
+                             workers=None, chunk_size=DEFAULT_CHUNK_SIZE, full=False):
+    """
+    Explains the deployed model's predictions for every customer and writes the global top 10 to
+    shap_summary.json for the Analytics page.
+
+    Per-customer attributions are kept in a columnar .npz cache keyed by the model's hash, together
+    with a fingerprint of each customer's encoded features. On later runs only new customers and
+    those whose features changed are recomputed; a new model starts a fresh cache.
+    """
+    workers = workers or os.cpu_count() or 1
+    started = time.monotonic()
+
+    print(f"Loading model from {model_path}...")
+    scorer = ChurnScorer(model_path)
+    cache_path = cache_path_for(model_path, cache_dir)
+
+    print(f"Reading customers from {'the users table' if source == 'users' else data_path}...")
+    customer_ids, columns = load_customers(scorer.input_columns, source, data_path)
+    order = np.argsort(customer_ids, kind='stable')
+    customer_ids = customer_ids[order]
+    X = scorer.encode_columns(columns)[order]
+    fingerprints = fingerprint_rows(X)
+    print(f"Loaded {len(customer_ids)} customers.")
+
+    previous = None if full else load_cache(cache_path)
+    contributions = np.empty((len(customer_ids), scorer.n_features), dtype=np.float32)
+    stale = np.ones(len(customer_ids), dtype=bool)
+    base_value = None
+    if previous is not None and len(previous['customer_ids']):
+        # Match current customers to cached rows (both sorted) and keep those whose features are unchanged
+        cached_ids = previous['customer_ids']
+        positions = np.minimum(np.searchsorted(cached_ids, customer_ids), len(cached_ids) - 1)
+        reusable = (cached_ids[positions] == customer_ids) & (previous['fingerprints'][positions] == fingerprints)
+        contributions[reusable] = previous['contributions'][positions[reusable]]
+        stale = ~reusable
+        base_value = float(previous['base_value'])
+        print(f"Reusing cached attributions for {int(reusable.sum())} customers ({cache_path}).")
+
+    n_stale = int(stale.sum())
+    if n_stale:
+        print(f"Calculating SHAP values for {n_stale} new or changed customers ({workers} workers)...")
+        compute_started = time.monotonic()
+        fresh = compute_contributions(scorer, X[stale], workers, chunk_size)
+        contributions[stale] = fresh[:, :-1]
+        base_value = float(fresh[0, -1])
+        elapsed = time.monotonic() - compute_started
+        print(f"  {n_stale} customers explained in {elapsed:.1f}s ({n_stale / max(elapsed, 1e-9):,.0f} rows/sec).")
+    else:
+        print("No customers changed since the last run.")
+
+    cache = {
+        'model_hash': np.array(model_hash(model_path)),
+        'feature_names': np.array(scorer.feature_names),
+        'base_value': np.array(base_value if base_value is not None else 0.0, dtype=np.float32),
+        'customer_ids': customer_ids,
+        'fingerprints': fingerprints,
+        'contributions': contributions,
+    }
+    if n_stale or previous is None or len(previous['customer_ids']) != len(customer_ids):
+        save_cache(cache_path, cache)
+
+    print(f"Saving SHAP summary to {output_path}...")
+    with open(output_path, "w") as f:
+        json.dump(summarize(cache), f, indent=4)
+    print(f"Successfully saved results to {output_path} in {time.monotonic() - started:.1f}s.")
+    return cache
 
 if __name__ == "__main__":
-    calculate_and_store_shap()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Explain the deployed churn model with SHAP and write shap_summary.json.")
+    parser.add_argument("--source", choices=["csv", "users"], default="csv",
+                        help="Explain the Kaggle CSV (default) or the live 'users' table.")
+    parser.add_argument("--data-path", default=DEFAULT_DATA_PATH, help="CSV to read in 'csv' mode.")
+    parser.add_argument("--model-path", default=DEFAULT_MODEL_PATH)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Where per-customer attributions are cached.")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_PATH, help="Summary JSON path (default: ./shap_summary.json).")
+    parser.add_argument("--workers", type=int, default=None, help="SHAP processes (default: CPU count).")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Rows per SHAP chunk.")
+    parser.add_argument("--full", action="store_true", help="Ignore the cache and recompute every customer.")
+    args = parser.parse_args()
+
+    try:
+        calculate_and_store_shap(args.source, args.data_path, args.model_path, args.cache_dir,
+                                 args.output, args.workers, args.chunk_size, args.full)
+    except FileNotFoundError as e:
+        print(f"ERROR: File not found: {e.filename}")
+        print("Please make sure the model and data files exist and the paths are correct.")
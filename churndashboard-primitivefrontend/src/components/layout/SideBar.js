@@ -4,7 +4,7 @@ import { NavLink } from 'react-router-dom';
 import { useWebSocket } from '../../hooks/useWebSocket';
 
 const Sidebar = () => {
-    const { wsStatus } = useWebSocket();
+    const { wsStatus } = useWebSocket([]);
 
     // --- NEW: Data structure for navigation links ---
     const navItems = [
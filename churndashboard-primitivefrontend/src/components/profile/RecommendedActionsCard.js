@@ -1,11 +1,25 @@
 
-import React, { useState } from 'react';
-import { Lightbulb, Check, Loader2 } from 'lucide-react';
+import React, { useState, useEffect } from 'react';
+import { Lightbulb, Check, Loader2, TrendingDown } from 'lucide-react';
 import { RecommendationRules } from './RecommendationRules';
 
 const RecommendedActionsCard = ({ details }) => {
   const [loggingAction, setLoggingAction] = useState(null);
   const [loggedIndexes, setLoggedIndexes] = useState([]);
+  // The model's churn probability for this customer under each candidate action
+  const [whatIf, setWhatIf] = useState(null);
+  const customerId = details?.customerid || details?.id;
+
+  useEffect(() => {
+    if (!customerId) return;
+    const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
+    fetch(`${API_URL}/api/customer/${customerId}/interventions`)
+      .then(response => response.ok ? response.json() : null)
+      .then(setWhatIf)
+      .catch(() => setWhatIf(null));
+  }, [customerId]);
+
+  const modelActions = (whatIf?.interventions || []).filter(option => option.risk_reduction > 0);
 
   const generateRecommendations = () => {
     if (!details) return ["No data available for recommendations."];
@@ -24,7 +38,7 @@ const RecommendedActionsCard = ({ details }) => {
   const recommendations = generateRecommendations();
 
   const handleLogAction = async (action, index) => {
-    if (!details?.customerid && !details?.id) {
+    if (!customerId) {
       alert('Customer ID not found');
       return;
     }
@@ -69,6 +83,24 @@ const RecommendedActionsCard = ({ details }) => {
         <Lightbulb size={20} className="mr-2 text-yellow-300" />
         Recommended Actions
       </h3>
+      {modelActions.length > 0 && (
+        <ul className="space-y-2 mb-4">
+          {modelActions.map(option => (
+            <li
+              key={option.action}
+              className="bg-green-600/10 p-3 rounded-lg flex justify-between items-center text-sm border-l-4 border-green-500"
+            >
+              <span className="text-white flex items-center">
+                <TrendingDown size={16} className="mr-2 text-green-400" />
+                {option.label}
+              </span>
+              <span className="text-green-300 font-semibold" title="Model-estimated churn probability after this action">
+                {(whatIf.churn_probability * 100).toFixed(0)}% → {(option.churn_probability * 100).toFixed(0)}%
+              </span>
+            </li>
+          ))}
+        </ul>
+      )}
       <ul className="space-y-3 max-h-96 overflow-y-auto scrollbar-thin">
         {recommendations.map((rec, index) => (
           <li
@@ -1,9 +1,14 @@
 import { useState, useEffect } from 'react';
 
-export const useWebSocket = () => {
+// topics limits what the backend sends this page: 'events', 'alerts', 'kpis' and/or
+// 'customer:<id>'. Leave it out for events, alerts and KPIs; pass [] for the connection status only.
+export const useWebSocket = (topics) => {
   const [liveEvent, setLiveEvent] = useState(null);
+  const [liveEventBatch, setLiveEventBatch] = useState(null);
   const [highRiskAlert, setHighRiskAlert] = useState(null);
+  const [kpiUpdate, setKpiUpdate] = useState(null);
   const [wsStatus, setWsStatus] = useState('Connecting...');
+  const topicsKey = topics ? topics.join(',') : null;
 
   useEffect(() => {
     // Get the base API URL from the environment variable
@@ -11,7 +16,8 @@ const apiUrl = process.env.REACT_APP_API_URL || 'http://localhost:8000';
 // Convert the http URL to a ws URL
 const wsUrl = apiUrl.replace(/^http/, 'ws');
 
-const ws = new WebSocket(`${wsUrl}/ws/updates`);
+const query = topicsKey === null ? '' : `?topics=${encodeURIComponent(topicsKey)}`;
+const ws = new WebSocket(`${wsUrl}/ws/updates${query}`);
     ws.onopen = () => setWsStatus('Connected');
     ws.onclose = () => setWsStatus('Disconnected');
     ws.onerror = () => setWsStatus('Error');
@@ -23,8 +29,15 @@ const ws = new WebSocket(`${wsUrl}/ws/updates`);
 
         if (data.type === 'new_event') {
           setLiveEvent(payloadWithId);
+        } else if (data.type === 'event_batch') {
+          // Sent instead of single events while this connection is behind; oldest first
+          const now = Date.now();
+          setLiveEventBatch(data.payload.map((payload, index) => ({ ...payload, id: `${now}-${index}` })));
         } else if (data.type === 'churn_alert') {
           setHighRiskAlert(payloadWithId);
+        } else if (data.type === 'kpi_update') {
+          // Only the KPIs that changed; the processor sends at most one per second
+          setKpiUpdate(data.payload);
         }
       } catch (error) {
         console.error("Error parsing WebSocket message:", error);
@@ -33,8 +46,8 @@ const ws = new WebSocket(`${wsUrl}/ws/updates`);
     
     // Cleanup on component unmount
     return () => ws.close();
-  }, []);
+  }, [topicsKey]);
 
-  return { liveEvent, highRiskAlert, wsStatus };
+  return { liveEvent, liveEventBatch, highRiskAlert, kpiUpdate, wsStatus };
 };
 
@@ -24,7 +24,7 @@ const getRiskBand = (probability) => {
 const Analytics = () => {
     const [alertsHistory, setAlertsHistory] = useState([]);
     const [shapData, setShapData] = useState([]);
-    const { highRiskAlert, wsStatus } = useWebSocket();
+    const { highRiskAlert, wsStatus } = useWebSocket(['alerts']);
     const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
     // Fetch initial history of customer alerts
     useEffect(() => {
@@ -6,7 +6,9 @@ import CustomerDetailsCard from '../components/profile/CustomerDetailsCard';
 import RecentEventsCard from '../components/profile/RecentEventsCard';
 import RecommendedActionsCard from '../components/profile/RecommendedActionsCard';
 import InterventionLog from '../components/profile/InterventionLog';
+import ChurnProbabilityTrend from '../components/dashboard/ChurnProbabilityTrend';
 import Loader from '../components/shared/Loader';
+import { useWebSocket } from '../hooks/useWebSocket';
 
 const CustomerProfile = () => {
     const { customerId } = useParams();
@@ -14,6 +16,8 @@ const CustomerProfile = () => {
     const [loading, setLoading] = useState(true);
     const [error, setError] = useState(null);
     const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
+    // Only this customer's events and alerts
+    const { liveEvent, highRiskAlert } = useWebSocket([`customer:${customerId}`]);
     useEffect(() => {
         const fetchData = async () => {
             try {
@@ -31,10 +35,30 @@ const CustomerProfile = () => {
         fetchData();
     }, [customerId]);
 
+    // Live events carry the customer's new score; show it and prepend the event
+    const applyLiveUpdate = (update) => {
+        if (!update || update.user_id !== customerId) return;
+        setCustomerData(prev => prev && {
+            ...prev,
+            details: { ...prev.details, churn_probability: update.churn_probability },
+            recent_events: [
+                { id: update.id, event_type: update.event_type, event_timestamp: new Date(update.timestamp * 1000).toISOString() },
+                ...(prev.recent_events || []),
+            ].slice(0, 20),
+        });
+    };
+    useEffect(() => applyLiveUpdate(liveEvent), [liveEvent]);
+    useEffect(() => applyLiveUpdate(highRiskAlert), [highRiskAlert]);
+
     if (loading) return <Loader />;
     if (error || !customerData) return <div className="text-red-500"><AlertCircle /> Error loading data.</div>;
 
     const latestPrediction = customerData.details?.churn_probability || 0;
+    // Daily averages from the prediction_daily rollup; days still held raw appear once db_maintenance.py rolls them up
+    const dailyTrend = (customerData.daily_trend || []).map(item => ({
+        time: new Date(item.day).toLocaleDateString('en-IN', { day: '2-digit', month: 'short' }),
+        probability: item.avg_prob,
+    }));
 
 
     return (
@@ -52,6 +76,12 @@ const CustomerProfile = () => {
                 <div className="lg:col-span-2 space-y-8">
                     <RecentEventsCard events={customerData.recent_events} />
                     <InterventionLog logs={customerData.intervention_log} />
+                    {dailyTrend.length > 0 && (
+                        <div className="bg-navy-light p-6 rounded-xl shadow-lg">
+                            <h3 className="text-xl font-bold text-white mb-4">Daily Churn Probability (Last 30 days)</h3>
+                            <ChurnProbabilityTrend data={dailyTrend} />
+                        </div>
+                    )}
 
                 </div>
             </div>
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { Loader2 } from 'lucide-react';
 import PageHeader from '../components/shared/PageHeader';
 import KpiCard from '../components/dashboard/KpiCard';
@@ -7,21 +7,32 @@ import HighVsLowRiskChart from '../components/dashboard/HighVsLowRiskChart';
 import ChurnProbabilityTrend from '../components/dashboard/ChurnProbabilityTrend';
 import { useWebSocket } from '../hooks/useWebSocket';
 
+// Without live KPI updates, alerts trigger a refetch, but at most once per this many ms
+const ALERT_REFETCH_INTERVAL_MS = 5000;
+// The hourly trend isn't part of the live updates, so it is refetched on this timer
+const TREND_REFRESH_MS = 60000;
+
 const Dashboard = () => {
   const [kpis, setKpis] = useState(null);
   const [loading, setLoading] = useState(true);
-  const { highRiskAlert, wsStatus } = useWebSocket();
+  const { highRiskAlert, kpiUpdate, wsStatus } = useWebSocket(['kpis', 'alerts']);
+  const hasLiveKpis = useRef(false);
+  const alertRefetch = useRef(null);
   const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
+
+  const fetchKpis = async () => {
+    const response = await fetch(`${API_URL}/api/dashboard-kpis`);
+    if (!response.ok) {
+      throw new Error('Failed to fetch dashboard KPIs');
+    }
+    return response.json();
+  };
+
   useEffect(() => {
     const fetchData = async () => {
       try {
         setLoading(true);
-        const response = await fetch(`${API_URL}/api/dashboard-kpis`);
-        if (!response.ok) {
-          throw new Error('Failed to fetch dashboard KPIs');
-        }
-        const data = await response.json();
-        setKpis(data);
+        setKpis(await fetchKpis());
       } catch (error) {
         console.error("Failed to fetch KPIs", error);
       } finally {
@@ -29,8 +40,46 @@ const Dashboard = () => {
       }
     };
     fetchData();
+  }, []);
+
+  // Live KPI deltas from the stream processor are merged in place of refetching on every alert
+  useEffect(() => {
+    if (kpiUpdate) {
+      hasLiveKpis.current = true;
+      setKpis(prev => ({ ...prev, ...kpiUpdate }));
+    }
+  }, [kpiUpdate]);
+
+  // Until a kpi_update arrives (e.g. the processor runs with KPI_AGGREGATOR=0), alerts refetch the KPIs
+  useEffect(() => {
+    if (!highRiskAlert || hasLiveKpis.current || alertRefetch.current) {
+      return;
+    }
+    alertRefetch.current = setTimeout(async () => {
+      alertRefetch.current = null;
+      try {
+        setKpis(await fetchKpis());
+      } catch (error) {
+        console.error("Failed to refresh KPIs", error);
+      }
+    }, ALERT_REFETCH_INTERVAL_MS);
   }, [highRiskAlert]);
 
+  useEffect(() => () => clearTimeout(alertRefetch.current), []);
+
+  useEffect(() => {
+    const timer = setInterval(async () => {
+      try {
+        const data = await fetchKpis();
+        // Live updates are fresher than this response for everything but the trend
+        setKpis(prev => (hasLiveKpis.current ? { ...prev, churn_trend: data.churn_trend } : data));
+      } catch (error) {
+        console.error("Failed to refresh the churn trend", error);
+      }
+    }, TREND_REFRESH_MS);
+    return () => clearInterval(timer);
+  }, []);
+
   // 🔹 fallback trend data (in case API doesn't return it)
   const fallbackTrendData = [
     { time: '12:00', probability: 0.12 },
@@ -9,7 +9,7 @@ const LiveFeed = () => {
     const [events, setEvents] = useState([]);
     const [isLoading, setIsLoading] = useState(true);
     const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
-    const { liveEvent, highRiskAlert } = useWebSocket();
+    const { liveEvent, liveEventBatch, highRiskAlert } = useWebSocket(['events', 'alerts']);
 
     // --- Fetch historical events on initial component load ---
     useEffect(() => {
@@ -53,6 +53,13 @@ const LiveFeed = () => {
         }
     }, [liveEvent]);
 
+    useEffect(() => {
+        if (liveEventBatch) {
+            const newEvents = liveEventBatch.map(event => ({ ...event, isHighRisk: false })).reverse();
+            setEvents(prevEvents => [...newEvents, ...prevEvents].slice(0, 100));
+        }
+    }, [liveEventBatch]);
+
     useEffect(() => {
         if (highRiskAlert) {
             const newAlert = { ...highRiskAlert, isHighRisk: true };
@@ -1,4 +1,4 @@
-import React, { useState, useEffect, useCallback } from 'react';
+import React, { useState, useEffect, useCallback, useRef } from 'react';
 import PageHeader from '../components/shared/PageHeader';
 import FilterPanel from '../components/watchlist/FilterPanel';
 import WatchlistTable from '../components/watchlist/WatchlistTable';
@@ -15,9 +15,12 @@ const Watchlist = () => {
         risk: [],
         contract: [],
     });
+    // next_cursor of each page fetched, keyed by the page it starts; reset whenever the filters change
+    const cursors = useRef({});
     const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
     const handleFilterChange = useCallback((name, value) => {
         setFilters(prev => ({ ...prev, [name]: value }));
+        cursors.current = {};
         setPage(1);
     }, []);
 
@@ -29,11 +32,13 @@ const Watchlist = () => {
                 const params = new URLSearchParams({ page, search: filters.searchTerm });
                 filters.risk.forEach(r => params.append('risk', r));
                 filters.contract.forEach(c => params.append('contract', c));
+                if (cursors.current[page]) params.append('cursor', cursors.current[page]);
 
                 const response = await fetch(`${API_URL}/api/watchlist?${params.toString()}`);
                 if (!response.ok) throw new Error('Network response was not ok');
                 const result = await response.json();
                 if (result.error) throw new Error(result.error);
+                if (result.next_cursor) cursors.current[page + 1] = result.next_cursor;
                 setData(result);
             } catch (err) {
                 setError(err.message);
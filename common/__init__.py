@@ -0,0 +1 @@
+"""Code shared by the stream processor, the event simulator and the offline scripts."""
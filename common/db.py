@@ -0,0 +1,187 @@
+import os
+import random
+import re
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+# Errors that mean the connection itself is gone, as opposed to a bad statement
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# name -> SQL with psycopg2 %s placeholders. Components register their hot queries here and run
+# them through execute_prepared, which PREPAREs each one once per connection.
+PREPARED_STATEMENTS = {}
+
+# Server-side prepared statements don't survive a transaction-mode pooler (e.g. PgBouncer or the
+# Supabase pooler on port 6543); set DB_PREPARED_STATEMENTS=0 to send plain statements instead.
+USE_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "1") != "0"
+
+# connection -> names of the statements already prepared on it
+_prepared_on = weakref.WeakKeyDictionary()
+
+def register_statements(statements):
+    """Adds {name: sql} entries to the prepared statement registry."""
+    PREPARED_STATEMENTS.update(statements)
+
+def execute_prepared(cursor, name, params=()):
+    """Executes a registered statement, preparing it on the cursor's connection the first time it is used there."""
+    sql = PREPARED_STATEMENTS[name]
+    if not USE_PREPARED_STATEMENTS:
+        cursor.execute(sql, params)
+        return
+    prepared = _prepared_on.setdefault(cursor.connection, set())
+    if name not in prepared:
+        counter = iter(range(1, sql.count('%s') + 1))
+        cursor.execute(f"PREPARE {name} AS " + re.sub(r'%s', lambda _: f"${next(counter)}", sql.replace('%%', '%')))
+        prepared.add(name)
+    if params:
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
+
+def backoff_delays(base_delay=0.5, max_delay=30.0, max_retries=None):
+    """Yields exponentially growing, jittered retry delays (forever if max_retries is None)."""
+    attempt = 0
+    while max_retries is None or attempt < max_retries:
+        delay = min(max_delay, base_delay * (2 ** attempt))
+        yield delay * random.uniform(0.5, 1.0)
+        attempt += 1
+
+def get_db_connection(dsn=None, max_retries=5):
+    """Opens a single connection to the Supabase PostgreSQL database, retrying with exponential backoff."""
+    dsn = dsn or os.getenv("POSTGRES_URI")
+    if not dsn:
+        raise ValueError("POSTGRES_URI not found in .env file.")
+    delays = backoff_delays(max_retries=max_retries)
+    while True:
+        try:
+            return psycopg2.connect(dsn)
+        except psycopg2.OperationalError as e:
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            print(f"Database connection error: {e}. Retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+class Database:
+    """
+    A thread-safe pool of PostgreSQL connections shared by the processor, simulator and scripts.
+
+    Connections are checked out with connection() or transaction(). Each checkout is health
+    checked (closed connections are replaced, and ones idle longer than health_check_interval
+    are pinged first), new connections are opened with exponential backoff, and run() retries a
+    unit of work on a fresh connection when the old one is lost mid-way.
+    """
+
+    def __init__(self, dsn=None, minconn=1, maxconn=4, health_check_interval=30.0,
+                 base_delay=0.5, max_delay=30.0, max_retries=8):
+        self.dsn = dsn or os.getenv("POSTGRES_URI")
+        if not self.dsn:
+            raise ValueError("POSTGRES_URI not found in .env file.")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.health_check_interval = health_check_interval
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+
+        # ThreadedConnectionPool raises when exhausted; the semaphore makes callers wait instead
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = weakref.WeakKeyDictionary()
+        self.reconnects = 0
+        self._pool = self._create_pool()
+
+    def _create_pool(self):
+        delays = backoff_delays(self.base_delay, self.max_delay, self.max_retries)
+        while True:
+            try:
+                return ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn)
+            except psycopg2.OperationalError as e:
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                print(f"Database connection error: {e}. Retrying in {delay:.1f}s...")
+                time.sleep(delay)
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(conn)
+        if last_used is not None and time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def _checkout(self):
+        delays = backoff_delays(self.base_delay, self.max_delay, self.max_retries)
+        while True:
+            try:
+                conn = self._pool.getconn()
+                if self._is_healthy(conn):
+                    return conn
+                self._pool.putconn(conn, close=True)
+                self.reconnects += 1
+            except CONNECTION_ERRORS as e:
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                print(f"Database connection error: {e}. Retrying in {delay:.1f}s...")
+                time.sleep(delay)
+
+    @contextmanager
+    def connection(self):
+        """Checks out a healthy connection. Uncommitted work is rolled back when it is returned."""
+        self._slots.acquire()
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        finally:
+            if conn is not None:
+                broken = bool(conn.closed)
+                if not broken:
+                    try:
+                        conn.rollback()
+                        self._last_used[conn] = time.monotonic()
+                    except CONNECTION_ERRORS:
+                        broken = True
+                self._pool.putconn(conn, close=broken)
+            self._slots.release()
+
+    @contextmanager
+    def transaction(self):
+        """Checks out a connection and commits everything done with it in one transaction."""
+        with self.connection() as conn:
+            yield conn
+            conn.commit()
+
+    def run(self, work, *args, **kwargs):
+        """
+        Calls work(conn, *args, **kwargs) inside a transaction, retrying with backoff on a fresh
+        connection if the connection is lost. work must be safe to repeat.
+        """
+        delays = backoff_delays(self.base_delay, self.max_delay, self.max_retries)
+        while True:
+            try:
+                with self.transaction() as conn:
+                    return work(conn, *args, **kwargs)
+            except CONNECTION_ERRORS as e:
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                self.reconnects += 1
+                print(f"Database connection lost: {e}. Retrying in {delay:.1f}s...")
+                time.sleep(delay)
+
+    def close(self):
+        """Closes every pooled connection."""
+        self._pool.closeall()
@@ -0,0 +1,213 @@
+import time
+
+import numpy as np
+
+from common.risk_queries import HIGH_THRESHOLD
+
+# Candidate retention actions. Each mirrors one of the churn-decreasing simulator handlers
+# (event_simulator/simulator.py): 'eligible' is its WHERE clause over input columns, 'set' and
+# 'add' are the column changes its UPDATE makes.
+INTERVENTIONS = {
+    'contract_upgrade': {
+        'label': "Move to a one-year contract",
+        'eligible': lambda columns: _values(columns, 'Contract') == 'Month-to-month',
+        'set': {'Contract': 'One year'},
+    },
+    'enable_autopay': {
+        'label': "Enable automatic payments",
+        'eligible': lambda columns: np.array(['(automatic)' not in str(value) for value in columns['PaymentMethod']], dtype=bool),
+        'set': {'PaymentMethod': 'Credit card (automatic)'},
+    },
+    'add_tech_support': {
+        'label': "Add tech support",
+        'eligible': lambda columns: _values(columns, 'TechSupport') == 'No',
+        'set': {'TechSupport': 'Yes'},
+        'add': {'MonthlyCharges': 5.0},
+    },
+}
+
+def _values(columns, column):
+    return np.asarray(columns[column], dtype=object)
+
+def apply_intervention(scorer, encoded, intervention, columns, rows):
+    """
+    Applies an intervention's column changes, in place, to an encoded matrix holding the given rows
+    (a boolean mask) of columns. Changed numeric values are re-encoded from the raw column exactly as
+    encode_columns does, so each counterfactual row matches encoding the changed customer.
+    """
+    categories = dict(scorer.category_lookup)
+    numeric = {column: (index, mean, scale) for column, index, mean, scale in scorer.numeric_columns}
+    for column, value in intervention.get('set', {}).items():
+        if column in categories:
+            lookup = categories[column]
+            encoded[:, list(lookup.values())] = 0.0
+            if value in lookup:
+                encoded[:, lookup[value]] = 1.0
+        else:
+            index, mean, scale = numeric[column]
+            encoded[:, index] = (float(value) - mean) / scale
+    for column, delta in intervention.get('add', {}).items():
+        index, mean, scale = numeric[column]
+        encoded[:, index] = (np.asarray(columns[column], dtype=np.float64)[rows] + delta - mean) / scale
+    return encoded
+
+def score_interventions(scorer, columns, actions=None):
+    """
+    Scores a set of customers as they are and under each candidate action, with one model call.
+
+    columns is columnar data as scorer.encode_columns takes it. The counterfactual rows are the
+    customers' encoded rows with the action's changes applied, for the customers it applies to,
+    stacked under the unchanged rows. Returns (probabilities, {action: probabilities}), with NaN
+    where an action doesn't apply to a customer.
+    """
+    actions = list(actions or INTERVENTIONS)
+    encoded = scorer.encode_columns(columns)
+    n_rows = len(encoded)
+    blocks = [encoded]
+    eligible = {}
+    for action in actions:
+        intervention = INTERVENTIONS[action]
+        eligible[action] = np.asarray(intervention['eligible'](columns), dtype=bool)
+        # Boolean indexing copies, so the unchanged rows stay as they are
+        blocks.append(apply_intervention(scorer, encoded[eligible[action]], intervention, columns, eligible[action]))
+    stacked = np.concatenate(blocks)
+    probabilities = scorer.predict_encoded(stacked) if len(stacked) else np.empty(0, dtype=np.float32)
+
+    results = {}
+    offset = n_rows
+    for action in actions:
+        count = int(eligible[action].sum())
+        scores = np.full(n_rows, np.nan, dtype=np.float32)
+        scores[eligible[action]] = probabilities[offset:offset + count]
+        results[action] = scores
+        offset += count
+    return probabilities[:n_rows], results
+
+def best_interventions(probabilities, results):
+    """
+    Returns (action names, best action index per customer or -1, risk reduction per customer and
+    action): the action that lowers each customer's churn probability the most, if any does.
+    """
+    actions = list(results)
+    if not actions:
+        return actions, np.full(len(probabilities), -1), np.empty((len(probabilities), 0), dtype=np.float32)
+    reductions = probabilities[:, None] - np.column_stack([results[action] for action in actions])
+    best = np.argmax(np.nan_to_num(reductions, nan=-np.inf), axis=1)
+    best_reduction = reductions[np.arange(len(best)), best]
+    best[~(best_reduction > 0)] = -1
+    return actions, best, reductions
+
+def what_if(scorer, customer_ids, columns, actions=None):
+    """The per-customer what-if payload: each applicable action's score and risk reduction, best first."""
+    probabilities, results = score_interventions(scorer, columns, actions)
+    actions, _, reductions = best_interventions(probabilities, results)
+    payload = []
+    for row, customer_id in enumerate(customer_ids):
+        options = [
+            {
+                "action": action,
+                "label": INTERVENTIONS[action]['label'],
+                "churn_probability": float(results[action][row]),
+                "risk_reduction": float(reductions[row, column]),
+            }
+            for column, action in enumerate(actions)
+            if not np.isnan(reductions[row, column])
+        ]
+        options.sort(key=lambda option: option['risk_reduction'], reverse=True)
+        payload.append({
+            "customer_id": customer_id,
+            "churn_probability": float(probabilities[row]),
+            "best_action": options[0]['action'] if options and options[0]['risk_reduction'] > 0 else None,
+            "interventions": options,
+        })
+    return payload
+
+def fetch_customer_columns(conn, scorer, customer_ids):
+    """Returns (customer IDs, input columns) for the given customers, in the order Postgres returns them."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"SELECT customerID, {', '.join(scorer.input_columns)} FROM users WHERE customerID = ANY(%s);",
+            (list(customer_ids),)
+        )
+        rows = cursor.fetchall()
+    conn.commit()
+    return _to_columns(scorer, rows)
+
+def _to_columns(scorer, rows):
+    if not rows:
+        return [], {column: [] for column in scorer.input_columns}
+    values = list(zip(*rows))
+    return list(values[0]), dict(zip(scorer.input_columns, values[1:]))
+
+def iter_high_risk_columns(conn, scorer, min_probability=HIGH_THRESHOLD, chunk_size=50000):
+    """Yields (customer IDs, input columns) chunks for every customer whose current score is above min_probability."""
+    with conn.cursor(name='high_risk_customers') as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(f"""
+            SELECT u.customerID, {', '.join('u.' + column for column in scorer.input_columns)}
+            FROM current_risk cr JOIN users u ON u.customerID = cr.user_id
+            WHERE cr.churn_probability > %s
+        """, (min_probability,))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield _to_columns(scorer, rows)
+    conn.commit()
+
+def rank_high_risk(conn, scorer, min_probability=HIGH_THRESHOLD, actions=None, chunk_size=50000):
+    """
+    Finds the best action for every customer scored above min_probability, one model call per
+    chunk. Returns a dict of NumPy arrays, one entry per customer: customer_id, churn_probability,
+    best_action (None if nothing helps) and risk_reduction, plus the seconds spent reading and scoring.
+    """
+    ids, baseline, best_actions, best_reductions = [], [], [], []
+    timings = {'read': 0.0, 'score': 0.0}
+    started = time.perf_counter()
+    for customer_ids, columns in iter_high_risk_columns(conn, scorer, min_probability, chunk_size):
+        scoring_started = time.perf_counter()
+        timings['read'] += scoring_started - started
+        probabilities, results = score_interventions(scorer, columns, actions)
+        names, best, reductions = best_interventions(probabilities, results)
+        choices = np.array(names + [None], dtype=object)
+        ids.extend(customer_ids)
+        baseline.append(probabilities)
+        best_actions.append(choices[best])
+        best_reductions.append(np.where(best >= 0, reductions[np.arange(len(best)), best], 0.0))
+        started = time.perf_counter()
+        timings['score'] += started - scoring_started
+    return {
+        "customer_id": np.array(ids, dtype=object),
+        "churn_probability": np.concatenate(baseline) if baseline else np.empty(0, dtype=np.float32),
+        "best_action": np.concatenate(best_actions) if best_actions else np.empty(0, dtype=object),
+        "risk_reduction": np.concatenate(best_reductions) if best_reductions else np.empty(0, dtype=np.float32),
+        "timings": timings,
+    }
+
+def summarize_ranking(ranking, top=100):
+    """A JSON-friendly summary of rank_high_risk's result: per-action counts and the top customers by risk reduction."""
+    by_action = {}
+    for action in INTERVENTIONS:
+        chosen = ranking['best_action'] == action
+        count = int(chosen.sum())
+        if count:
+            by_action[action] = {
+                "label": INTERVENTIONS[action]['label'],
+                "customers": count,
+                "mean_risk_reduction": float(ranking['risk_reduction'][chosen].mean()),
+            }
+    order = np.argsort(-ranking['risk_reduction'], kind='stable')[:top]
+    return {
+        "customers": len(ranking['customer_id']),
+        "no_helpful_action": int(sum(action is None for action in ranking['best_action'])),
+        "by_action": by_action,
+        "top": [
+            {
+                "customer_id": ranking['customer_id'][i],
+                "churn_probability": float(ranking['churn_probability'][i]),
+                "best_action": ranking['best_action'][i],
+                "risk_reduction": float(ranking['risk_reduction'][i]),
+            }
+            for i in order.tolist()
+        ],
+    }
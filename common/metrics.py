@@ -0,0 +1,199 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# METRICS_ENABLED=0 turns every timer and observe() call into a no-op
+ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+
+# Log-linear buckets: BUCKETS_PER_OCTAVE per doubling from MIN_VALUE, i.e. ~9% wide, which keeps
+# percentiles within a few percent while recording stays a log2 and a list increment.
+MIN_VALUE = 1e-6
+BUCKETS_PER_OCTAVE = 8
+NUM_BUCKETS = BUCKETS_PER_OCTAVE * 32  # 1us .. ~72 minutes
+
+class Histogram:
+    """A fixed-bucket latency histogram (values in seconds) with count, sum, max and percentiles."""
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        if value <= MIN_VALUE:
+            index = 0
+        else:
+            index = min(NUM_BUCKETS - 1, int(math.log2(value / MIN_VALUE) * BUCKETS_PER_OCTAVE))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-quantile (capped at the observed max)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.max, MIN_VALUE * 2 ** ((index + 1) / BUCKETS_PER_OCTAVE))
+        return self.max
+
+    def summary(self):
+        """Returns count and mean/p50/p95/p99/max in milliseconds."""
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.50) * 1000, 3),
+            "p95_ms": round(self.percentile(0.95) * 1000, 3),
+            "p99_ms": round(self.percentile(0.99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+class Registry:
+    """
+    Named histograms for one process. Recording takes no lock (a lost increment under a
+    thread race is acceptable for monitoring); snapshots and merges do.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name, value):
+        self.histogram(name).observe(value)
+
+    def take(self):
+        """Removes and returns every histogram, e.g. to ship a worker's measurements to its parent."""
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+        return histograms
+
+    def merge(self, histograms):
+        for name, histogram in histograms.items():
+            with self._lock:
+                self._histograms.setdefault(name, Histogram()).merge(histogram)
+
+    def snapshot(self):
+        """Returns {name: summary} for every histogram recorded so far."""
+        with self._lock:
+            return {name: histogram.summary() for name, histogram in sorted(self._histograms.items())}
+
+REGISTRY = Registry()
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+@contextmanager
+def _timer(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(name, time.perf_counter() - started)
+
+def timer(name):
+    """Context manager that records the wall time of its block into the named histogram."""
+    if not ENABLED:
+        return _NULL_TIMER
+    return _timer(name)
+
+def observe(name, seconds):
+    """Records one value (in seconds) into the named histogram."""
+    if ENABLED:
+        REGISTRY.observe(name, seconds)
+
+def observe_lag(name, events, now=None):
+    """Records now - event['timestamp'] for every event that carries a simulator timestamp."""
+    if not ENABLED:
+        return
+    now = now or time.time()
+    histogram = REGISTRY.histogram(name)
+    for event in events:
+        timestamp = event.get('timestamp')
+        if timestamp is not None:
+            histogram.observe(max(0.0, now - timestamp))
+
+def start_log_reporter(interval=30.0, prefix="METRICS"):
+    """Prints a p50/p95/p99 summary of every histogram every interval seconds, from a daemon thread."""
+    if not ENABLED or interval <= 0:
+        return None
+
+    def report():
+        while True:
+            time.sleep(interval)
+            for name, summary in REGISTRY.snapshot().items():
+                print(f"{prefix}: {name} n={summary['count']} p50={summary['p50_ms']}ms "
+                      f"p95={summary['p95_ms']}ms p99={summary['p99_ms']}ms max={summary['max_ms']}ms")
+
+    thread = threading.Thread(target=report, name='metrics-reporter', daemon=True)
+    thread.start()
+    return thread
+
+# Extra JSON endpoints served next to /metrics: path -> zero-argument callable returning the body
+ENDPOINTS = {}
+
+def register_endpoint(path, handler):
+    """Serves handler() as JSON at path on the metrics HTTP server. handler runs on the server's thread."""
+    ENDPOINTS[path.rstrip('/')] = handler
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.rstrip('/')
+        if path == '/metrics':
+            handler = REGISTRY.snapshot
+        elif path in ENDPOINTS:
+            handler = ENDPOINTS[path]
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps(handler(), default=str).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port, host='127.0.0.1'):
+    """
+    Serves the histogram summaries as JSON at http://host:port/metrics from a daemon thread, along
+    with the registered endpoints. It runs with METRICS_ENABLED=0 too, for their sake; /metrics is then empty.
+    """
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    print(f"Metrics available at http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,226 @@
+import json
+
+from psycopg2.extras import execute_values
+
+from common.db import execute_prepared, register_statements
+from common.event_codec import decode_payload
+
+# Risk tiers, matching the dashboard's badges. Tier filters become ranges on churn_probability,
+# so they are served by the same index as the risk ordering.
+CRITICAL_THRESHOLD = 0.85
+HIGH_THRESHOLD = 0.70
+MEDIUM_THRESHOLD = 0.40
+
+RISK_TIER_CONDITIONS = {
+    'Critical': f"cr.churn_probability >= {CRITICAL_THRESHOLD}",
+    'High': f"cr.churn_probability > {HIGH_THRESHOLD} AND cr.churn_probability < {CRITICAL_THRESHOLD}",
+    'Medium': f"cr.churn_probability > {MEDIUM_THRESHOLD} AND cr.churn_probability <= {HIGH_THRESHOLD}",
+    'Low': f"cr.churn_probability <= {MEDIUM_THRESHOLD}",
+}
+
+
+# Only overwrite the stored score with a newer one, so a replayed or late batch can't roll it back.
+# contract is the one the score was computed with; it lets the watchlist filter and count by
+# contract from current_risk's own indexes.
+UPSERT_CURRENT_RISK = """
+    INSERT INTO current_risk (user_id, churn_probability, prediction_timestamp, top_features, contract) VALUES %s
+    ON CONFLICT (user_id) DO UPDATE SET
+        churn_probability = EXCLUDED.churn_probability,
+        prediction_timestamp = EXCLUDED.prediction_timestamp,
+        top_features = EXCLUDED.top_features,
+        contract = COALESCE(EXCLUDED.contract, current_risk.contract)
+    WHERE current_risk.prediction_timestamp <= EXCLUDED.prediction_timestamp
+"""
+
+register_statements({
+    'upsert_current_risk': UPSERT_CURRENT_RISK.replace('VALUES %s', 'VALUES (%s, %s, %s, %s, %s)'),
+})
+
+def risk_tier(probability):
+    """Returns the dashboard tier name for a churn probability."""
+    if probability >= CRITICAL_THRESHOLD:
+        return 'Critical'
+    if probability > HIGH_THRESHOLD:
+        return 'High'
+    if probability > MEDIUM_THRESHOLD:
+        return 'Medium'
+    return 'Low'
+
+def _current_risk_row(user_id, probability, timestamp, top_features, contract=None):
+    return (user_id, probability, timestamp, None if top_features is None else json.dumps(top_features), contract)
+
+def upsert_current_risk(cursor, user_id, probability, timestamp, top_features=None, contract=None):
+    """Records one user's latest score. The caller owns the transaction."""
+    execute_prepared(cursor, 'upsert_current_risk', _current_risk_row(user_id, probability, timestamp, top_features, contract))
+
+def upsert_current_risk_batch(cursor, predictions):
+    """
+    Records the latest score for each user in (user_id, probability, timestamp, top_features[, contract]) tuples.
+    Later tuples win for a repeated user, since one INSERT ... ON CONFLICT can't touch a row twice.
+    Rows go in user_id order so concurrent batches lock rows in the same order. The caller owns the transaction.
+    """
+    latest = {prediction[0]: prediction for prediction in predictions}
+    rows = [_current_risk_row(*latest[user_id]) for user_id in sorted(latest)]
+    if rows:
+        execute_values(cursor, UPSERT_CURRENT_RISK, rows)
+
+def refresh_current_risk_from_predictions(cursor, since=None):
+    """
+    Folds the 'predictions' history (optionally only rows at or after since) into current_risk.
+    Used to seed the table on an existing database and after bulk backfills that bypass the processor.
+    """
+    cursor.execute(f"""
+        INSERT INTO current_risk (user_id, churn_probability, prediction_timestamp, contract)
+        SELECT DISTINCT ON (p.user_id) p.user_id, p.churn_probability, p.prediction_timestamp, u.Contract
+        FROM predictions p
+        LEFT JOIN users u ON u.customerID = p.user_id
+        {'WHERE p.prediction_timestamp >= %s' if since is not None else ''}
+        ORDER BY p.user_id, p.prediction_timestamp DESC
+        ON CONFLICT (user_id) DO UPDATE SET
+            churn_probability = EXCLUDED.churn_probability,
+            prediction_timestamp = EXCLUDED.prediction_timestamp,
+            contract = COALESCE(EXCLUDED.contract, current_risk.contract)
+        WHERE current_risk.prediction_timestamp <= EXCLUDED.prediction_timestamp
+    """, (since,) if since is not None else None)
+    return cursor.rowcount
+
+def _fetch_dicts(cursor):
+    columns = [desc[0] for desc in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def _fetch_events(cursor, user_id=None):
+    """
+    Like _fetch_dicts for a SELECT of events rows with event_data and payload. event_data is
+    rebuilt from the typed columns and payload for rows written since it stopped being filled in.
+    """
+    events = _fetch_dicts(cursor)
+    for event in events:
+        payload = event.pop('payload')
+        if event['event_data'] is None:
+            event['event_data'] = decode_payload(
+                event.get('user_id', user_id), event['event_type'], event['event_timestamp'].timestamp(), payload
+            )
+    return events
+
+def fetch_dashboard_kpis(conn, trend_hours=24):
+    """
+    Returns the /api/dashboard-kpis payload. Tier counts and MRR at risk come from current_risk
+    (one row per customer, however long the history), and the trend from the last trend_hours of
+    predictions through idx_predictions_time.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT
+                (SELECT COUNT(*) FROM users) AS total_active_customers,
+                COUNT(*) FILTER (WHERE {RISK_TIER_CONDITIONS['Critical']}) AS critical_risk_customers,
+                COUNT(*) FILTER (WHERE {RISK_TIER_CONDITIONS['High']}) AS high_risk_customers,
+                COUNT(*) FILTER (WHERE {RISK_TIER_CONDITIONS['Medium']}) AS medium_risk_customers,
+                COUNT(*) FILTER (WHERE {RISK_TIER_CONDITIONS['Low']}) AS low_risk_customers,
+                COALESCE(SUM(u.MonthlyCharges) FILTER (WHERE cr.churn_probability > {HIGH_THRESHOLD}), 0) AS mrr_at_risk,
+                COALESCE(AVG(cr.churn_probability), 0) AS overall_avg_churn_probability
+            FROM current_risk cr
+            JOIN users u ON u.customerID = cr.user_id
+        """)
+        kpis = _fetch_dicts(cursor)[0]
+
+        cursor.execute(f"""
+            SELECT u.Contract AS contract, COUNT(*) AS count
+            FROM current_risk cr
+            JOIN users u ON u.customerID = cr.user_id
+            WHERE cr.churn_probability > {HIGH_THRESHOLD}
+            GROUP BY u.Contract
+            ORDER BY count DESC
+        """)
+        kpis['churn_by_segment'] = _fetch_dicts(cursor)
+
+        cursor.execute("""
+            SELECT date_trunc('hour', prediction_timestamp) AS hour, AVG(churn_probability) AS avg_prob
+            FROM predictions
+            WHERE prediction_timestamp >= NOW() - make_interval(hours => %s)
+            GROUP BY 1
+            ORDER BY 1
+        """, (trend_hours,))
+        kpis['churn_trend'] = _fetch_dicts(cursor)
+    return kpis
+
+def fetch_daily_churn_trend(conn, days=30, user_id=None):
+    """
+    Average churn probability per day over the last days, for everyone or one user, read from the
+    prediction_daily rollup (see db_maintenance.py) rather than the raw history.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT day, SUM(avg_probability * predictions) / SUM(predictions) AS avg_prob, SUM(predictions) AS predictions
+            FROM prediction_daily
+            WHERE day >= CURRENT_DATE - %s {'AND user_id = %s' if user_id else ''}
+            GROUP BY day
+            ORDER BY day
+        """, (days, user_id) if user_id else (days,))
+        return _fetch_dicts(cursor)
+
+def fetch_recent_events(conn, limit=50):
+    """The newest events for /api/events/history; a merge of each partition's time index, newest first."""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT event_id, user_id, event_type, event_timestamp, event_data, payload
+            FROM events ORDER BY event_timestamp DESC LIMIT %s
+        """, (limit,))
+        return _fetch_events(cursor)
+
+def fetch_churn_alerts_history(conn, limit=500):
+    """
+    The customers currently above the alert threshold, most recently scored first, in the shape
+    of the Analytics page's live alerts (tenure, contract_type, monthly_charges).
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT cr.user_id, cr.churn_probability, cr.prediction_timestamp, cr.top_features,
+                   u.tenure, u.Contract AS contract_type, u.MonthlyCharges AS monthly_charges
+            FROM current_risk cr
+            JOIN users u ON u.customerID = cr.user_id
+            WHERE cr.churn_probability > {HIGH_THRESHOLD}
+            ORDER BY cr.prediction_timestamp DESC
+            LIMIT %s
+        """, (limit,))
+        return _fetch_dicts(cursor)
+
+def log_intervention(cursor, customer_id, action_taken, agent_id='System'):
+    """Records an action taken for a customer. Returns the new intervention_log row. The caller owns the transaction."""
+    cursor.execute("""
+        INSERT INTO intervention_log (customer_id, action_taken, agent_id)
+        VALUES (%s, %s, %s)
+        RETURNING log_id, action_taken, log_timestamp, agent_id
+    """, (customer_id, action_taken, agent_id))
+    return _fetch_dicts(cursor)[0]
+
+def fetch_customer(conn, customer_id, events_limit=20, interventions_limit=20, trend_days=30):
+    """Returns the /api/customer/{id} payload, with the customer's daily trend, or None if the customer doesn't exist."""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT u.*, cr.churn_probability, cr.prediction_timestamp, cr.top_features
+            FROM users u
+            LEFT JOIN current_risk cr ON cr.user_id = u.customerID
+            WHERE u.customerID = %s
+        """, (customer_id,))
+        details = _fetch_dicts(cursor)
+        if not details:
+            return None
+
+        cursor.execute("""
+            SELECT event_id, event_type, event_timestamp, event_data, payload
+            FROM events WHERE user_id = %s
+            ORDER BY event_timestamp DESC LIMIT %s
+        """, (customer_id, events_limit))
+        recent_events = _fetch_events(cursor, customer_id)
+
+        cursor.execute("""
+            SELECT log_id, action_taken, log_timestamp, agent_id
+            FROM intervention_log WHERE customer_id = %s
+            ORDER BY log_timestamp DESC LIMIT %s
+        """, (customer_id, interventions_limit))
+        intervention_log = _fetch_dicts(cursor)
+
+    return {
+        "details": details[0], "recent_events": recent_events, "intervention_log": intervention_log,
+        "daily_trend": fetch_daily_churn_trend(conn, trend_days, customer_id),
+    }
@@ -0,0 +1,223 @@
+import os
+import sys
+import joblib
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODEL_PATH = os.path.join(ROOT_DIR, 'ml_model', 'churn_model_xgb.pkl')
+DEFAULT_DATA_PATH = os.path.join(ROOT_DIR, 'ml_model', 'WA_Fn-UseC_-Telco-Customer-Churn.csv')
+
+class ChurnScorer:
+    """
+    Pandas-free inference for the churn pipeline in ml_model/churn_model_xgb.pkl.
+
+    The pickled pipeline is a ColumnTransformer (StandardScaler on the numeric columns,
+    OneHotEncoder on the categorical ones) followed by an XGBClassifier. Running it through
+    predict_proba re-encodes every categorical column on every call, so instead the scaler
+    parameters and one-hot categories are unpacked once into lookup tables, rows are encoded
+    straight into float32 NumPy arrays, and the booster is called with inplace_predict.
+    """
+
+    def __init__(self, model_path=DEFAULT_MODEL_PATH, nthread=None):
+        self.model_path = model_path
+        self.pipeline = joblib.load(model_path)
+
+        preprocessor = self.pipeline.steps[0][1]
+        classifier = self.pipeline.steps[-1][1]
+        self.input_columns = list(preprocessor.feature_names_in_)
+        self.feature_names = [name.split('__', 1)[-1] for name in preprocessor.get_feature_names_out()]
+        self.n_features = len(self.feature_names)
+
+        # Numeric columns: (input column, output index, mean, scale)
+        self.numeric_columns = []
+        # Categorical columns: (input column, {category value: output index})
+        self.category_lookup = []
+
+        offset = 0
+        for name, transformer, columns in preprocessor.transformers_:
+            if name == 'remainder' or transformer == 'drop':
+                continue
+            columns = list(columns)
+            if transformer == 'passthrough':
+                for i, column in enumerate(columns):
+                    self.numeric_columns.append((column, offset + i, 0.0, 1.0))
+                offset += len(columns)
+            elif hasattr(transformer, 'categories_'):
+                if transformer.drop is not None or transformer.handle_unknown != 'ignore':
+                    raise ValueError("Only OneHotEncoder(handle_unknown='ignore') without drop is supported.")
+                for column, categories in zip(columns, transformer.categories_):
+                    lookup = {value: offset + i for i, value in enumerate(categories)}
+                    self.category_lookup.append((column, lookup))
+                    offset += len(categories)
+            elif hasattr(transformer, 'mean_'):
+                mean = transformer.mean_ if transformer.with_mean else np.zeros(len(columns))
+                scale = transformer.scale_ if transformer.with_std else np.ones(len(columns))
+                for i, column in enumerate(columns):
+                    self.numeric_columns.append((column, offset + i, float(mean[i]), float(scale[i])))
+                offset += len(columns)
+            else:
+                raise ValueError(f"Unsupported transformer '{name}': {transformer!r}")
+
+        if offset != self.n_features:
+            raise ValueError(f"Encoded width {offset} does not match the pipeline's {self.n_features} features.")
+
+        # Sums encoded attributions back onto input columns (one-hot groups collapse to their column)
+        self.input_group_matrix = np.zeros((self.n_features, len(self.input_columns)), dtype=np.float32)
+        input_index = {column: i for i, column in enumerate(self.input_columns)}
+        for column, index, _, _ in self.numeric_columns:
+            self.input_group_matrix[index, input_index[column]] = 1.0
+        for column, lookup in self.category_lookup:
+            for index in lookup.values():
+                self.input_group_matrix[index, input_index[column]] = 1.0
+
+        self.booster = classifier.get_booster()
+        if nthread is not None:
+            self.booster.set_param({'nthread': nthread})
+        # Honour early stopping the same way XGBClassifier.predict_proba does
+        try:
+            self.iteration_range = (0, classifier.best_iteration + 1)
+        except AttributeError:
+            self.iteration_range = (0, 0)
+
+    def new_buffer(self, n_rows):
+        """Allocates a zeroed float32 matrix that encode_rows/encode_columns can fill in place."""
+        return np.zeros((n_rows, self.n_features), dtype=np.float32)
+
+    def encode_row(self, features, out=None):
+        """Encodes one feature mapping (model column name -> raw value) into a 1-D float32 array."""
+        if out is None:
+            out = np.zeros(self.n_features, dtype=np.float32)
+        else:
+            out[:] = 0.0
+        for column, index, mean, scale in self.numeric_columns:
+            out[index] = (float(features[column]) - mean) / scale
+        for column, lookup in self.category_lookup:
+            index = lookup.get(features[column])
+            if index is not None:
+                out[index] = 1.0
+        return out
+
+    def encode_rows(self, rows, out=None):
+        """Encodes a sequence of feature mappings into a 2-D float32 matrix (one row each)."""
+        n_rows = len(rows)
+        if out is None:
+            out = self.new_buffer(n_rows)
+        else:
+            out = out[:n_rows]
+            out[:] = 0.0
+        for i, features in enumerate(rows):
+            for column, index, mean, scale in self.numeric_columns:
+                out[i, index] = (float(features[column]) - mean) / scale
+            for column, lookup in self.category_lookup:
+                index = lookup.get(features[column])
+                if index is not None:
+                    out[i, index] = 1.0
+        return out
+
+    def encode_columns(self, columns, out=None):
+        """
+        Encodes columnar data (anything indexable by column name that yields equal-length
+        sequences, e.g. a dict of lists or a DataFrame) into a 2-D float32 matrix.
+        """
+        n_rows = len(columns[self.input_columns[0]])
+        if out is None:
+            out = self.new_buffer(n_rows)
+        else:
+            out = out[:n_rows]
+            out[:] = 0.0
+        row_index = np.arange(n_rows)
+        for column, index, mean, scale in self.numeric_columns:
+            out[:, index] = (np.asarray(columns[column], dtype=np.float64) - mean) / scale
+        for column, lookup in self.category_lookup:
+            codes = np.fromiter((lookup.get(value, -1) for value in columns[column]), dtype=np.int64, count=n_rows)
+            known = codes >= 0
+            out[row_index[known], codes[known]] = 1.0
+        return out
+
+    def predict_encoded(self, X):
+        """Returns the churn probability for each row of an encoded matrix."""
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        return self.booster.inplace_predict(X, iteration_range=self.iteration_range)
+
+    def contributions_encoded(self, X, approx=False):
+        """
+        Returns exact TreeSHAP attributions (log-odds) for each row of an encoded matrix, computed by
+        XGBoost itself: an (n_rows, n_features + 1) float32 array whose last column is the bias term.
+        Each row sums to the model's margin for that row. approx=True uses XGBoost's much cheaper
+        path-based (Saabas) approximation instead, which also sums to the margin.
+        """
+        import xgboost as xgb
+
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        return self.booster.predict(
+            xgb.DMatrix(X, nthread=-1), pred_contribs=True, approx_contribs=approx, iteration_range=self.iteration_range
+        )
+
+    def top_contributions(self, X, top_k=3, approx=False):
+        """
+        Returns, for each row of an encoded matrix, its top_k input columns by absolute attribution
+        as [(column, log-odds contribution)], largest first. A categorical column's attribution is
+        the sum over its one-hot outputs.
+        """
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if len(X) == 0:
+            return []
+        by_column = self.contributions_encoded(X, approx)[:, :-1] @ self.input_group_matrix
+        top = np.argsort(-np.abs(by_column), axis=1)[:, :top_k]
+        return [
+            [(self.input_columns[i], float(row[i])) for i in indices]
+            for row, indices in zip(by_column, top)
+        ]
+
+    def score_row(self, features):
+        """Returns the churn probability for a single feature mapping."""
+        return float(self.predict_encoded(self.encode_row(features))[0])
+
+    def score_rows(self, rows, out=None):
+        """Returns churn probabilities for a sequence of feature mappings."""
+        if not rows:
+            return np.empty(0, dtype=np.float32)
+        return self.predict_encoded(self.encode_rows(rows, out))
+
+    def score_columns(self, columns, out=None):
+        """Returns churn probabilities for columnar data (see encode_columns)."""
+        return self.predict_encoded(self.encode_columns(columns, out))
+
+def check_parity(model_path=DEFAULT_MODEL_PATH, data_path=DEFAULT_DATA_PATH, atol=1e-6):
+    """
+    Scores the full Telco CSV through both the pickled pipeline's predict_proba and
+    ChurnScorer (columnar, row-batch and single-row paths) and checks they agree within atol.
+    Returns the largest absolute difference seen.
+    """
+    import pandas as pd
+
+    df = pd.read_csv(data_path)
+    df['TotalCharges'] = pd.to_numeric(df['TotalCharges'], errors='coerce').fillna(0.0)
+    X = df.drop(['customerID', 'Churn'], axis=1)
+
+    scorer = ChurnScorer(model_path)
+    expected = scorer.pipeline.predict_proba(X)[:, 1]
+
+    records = X.to_dict('records')
+    candidates = {
+        'encode_columns': scorer.score_columns(X),
+        'encode_rows': scorer.score_rows(records),
+        'encode_row': np.array([scorer.score_row(row) for row in records]),
+    }
+
+    max_diff = 0.0
+    for name, probabilities in candidates.items():
+        diff = float(np.max(np.abs(probabilities - expected)))
+        print(f"{name}: max abs difference vs predict_proba over {len(X)} rows = {diff:.3e}")
+        if diff > atol:
+            raise AssertionError(f"{name} differs from predict_proba by {diff:.3e} (tolerance {atol:.1e})")
+        max_diff = max(max_diff, diff)
+    return max_diff
+
+if __name__ == "__main__":
+    # python -m common.scorer [model_path] [data_path]
+    check_parity(*sys.argv[1:3])
+    print("ChurnScorer matches predict_proba.")
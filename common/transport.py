@@ -0,0 +1,749 @@
+import json
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from collections import namedtuple
+
+from common.event_codec import decode_event, event_serializer
+
+try:
+    import fcntl
+except ImportError:  # Windows: the log backend then assumes a single writer process per topic
+    fcntl = None
+
+# Field-compatible with kafka.TopicPartition / kafka.consumer.fetcher.ConsumerRecord, so code
+# written against kafka-python (dict keys, message.value) works with any backend. KafkaConsumer's
+# seek() and commit() insist on kafka's own TopicPartition; go through seek()/commit_offsets() below.
+TopicPartition = namedtuple('TopicPartition', ['topic', 'partition'])
+Record = namedtuple('Record', ['topic', 'partition', 'offset', 'timestamp', 'key', 'value'])
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_LOG_DIR = os.path.join(ROOT_DIR, 'event_log')
+
+def partition_for(key, num_partitions):
+    """Stable key -> partition mapping (the same user always lands on the same partition)."""
+    if key is None:
+        return 0
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return zlib.crc32(key) % num_partitions
+
+def commit_offsets(consumer, offsets):
+    """
+    Commits {TopicPartition: next offset to consume} on any backend. kafka-python wants its own
+    TopicPartition keys and OffsetAndMetadata values, whose fields differ between client versions.
+    """
+    if not offsets:
+        return
+    if isinstance(consumer, LocalConsumer):
+        consumer.commit(offsets)
+        return
+    from kafka.structs import OffsetAndMetadata, TopicPartition as KafkaTopicPartition
+    extra = (None,) * (len(OffsetAndMetadata._fields) - 2)
+    consumer.commit({
+        KafkaTopicPartition(tp[0], tp[1]): OffsetAndMetadata(offset, '', *extra) for tp, offset in offsets.items()
+    })
+
+def seek(consumer, tp, offset):
+    """Moves a consumer's position in a partition on any backend. KafkaConsumer.seek only accepts kafka's TopicPartition."""
+    if isinstance(consumer, LocalConsumer):
+        consumer.seek(tp, offset)
+        return
+    from kafka.structs import TopicPartition as KafkaTopicPartition
+    consumer.seek(KafkaTopicPartition(tp[0], tp[1]), offset)
+
+def subscribe(consumer, topics, listener=None):
+    """
+    Subscribes a consumer on any backend. listener is any object with on_partitions_revoked and
+    on_partitions_assigned; kafka-python only accepts ConsumerRebalanceListener subclasses, so it
+    is wrapped in one for a Kafka consumer.
+    """
+    if listener is not None and not isinstance(consumer, LocalConsumer):
+        from kafka import ConsumerRebalanceListener
+
+        class _KafkaListener(ConsumerRebalanceListener):
+            def on_partitions_revoked(self, revoked):
+                listener.on_partitions_revoked(revoked)
+
+            def on_partitions_assigned(self, assigned):
+                listener.on_partitions_assigned(assigned)
+
+        listener = _KafkaListener()
+    consumer.subscribe(topics, listener=listener)
+
+def is_broker_error(error):
+    """
+    Whether an error came from the transport (an unreachable broker, a failed commit or log I/O)
+    rather than from the events being processed, so retrying the same events may succeed.
+    """
+    if isinstance(error, OSError):
+        return True
+    try:
+        from kafka.errors import KafkaError
+    except ImportError:
+        return False
+    return isinstance(error, KafkaError)
+
+def _event_encoding():
+    """How producers encode events: 'binary' (default) or 'json'. Consumers read both."""
+    return os.getenv("EVENT_ENCODING", "binary")
+
+class _SendResult:
+    """A future for a sent record, so callers can treat every backend like KafkaProducer.send()."""
+
+    def __init__(self, record=None, broker=None):
+        self.record = record
+        self._broker = broker
+
+    def get(self, timeout=None):
+        if self.record is None and self._broker is not None:
+            self._broker.flush()
+        return self.record
+
+    def add_callback(self, callback, *args, **kwargs):
+        callback(*args, self.get(), **kwargs)
+        return self
+
+    def add_errback(self, errback, *args, **kwargs):
+        return self
+
+class InMemoryBroker:
+    """
+    A thread-safe, in-process stand-in for a Kafka cluster: partitioned topics, offsets and
+    consumer groups with partition assignment and rebalancing. Used for tests, benchmarks
+    and running the pipeline in a single process.
+    """
+
+    def __init__(self, num_partitions=8):
+        self.num_partitions = num_partitions
+        self._topics = {}
+        self._committed = {}
+        # group_id -> list of member consumers, in join order
+        self._groups = {}
+        self._cond = threading.Condition()
+
+    def _partitions(self, topic):
+        if topic not in self._topics:
+            self._topics[topic] = [[] for _ in range(self.num_partitions)]
+        return self._topics[topic]
+
+    def append(self, topic, value, key=None, partition=None):
+        with self._cond:
+            partitions = self._partitions(topic)
+            if partition is None:
+                partition = partition_for(key, len(partitions))
+            log = partitions[partition]
+            record = Record(topic, partition, len(log), int(time.time() * 1000), key, value)
+            log.append(record)
+            self._cond.notify_all()
+            return _SendResult(record)
+
+    def flush(self):
+        pass
+
+    def read(self, tp, offset, max_records):
+        with self._cond:
+            return self._partitions(tp.topic)[tp.partition][offset:offset + max_records]
+
+    def end_offset(self, tp):
+        with self._cond:
+            return len(self._partitions(tp.topic)[tp.partition])
+
+    def wait_for_data(self, timeout):
+        with self._cond:
+            self._cond.wait(timeout)
+
+    def committed(self, group_id, tp):
+        with self._cond:
+            return self._committed.get((group_id, tp))
+
+    def commit(self, group_id, offsets):
+        with self._cond:
+            for tp, offset in offsets.items():
+                self._committed[(group_id, tp)] = offset
+
+    def join(self, consumer):
+        with self._cond:
+            self._groups.setdefault(consumer.group_id, []).append(consumer)
+            self._rebalance(consumer.group_id)
+
+    def leave(self, consumer):
+        with self._cond:
+            members = self._groups.get(consumer.group_id, [])
+            if consumer in members:
+                members.remove(consumer)
+                self._rebalance(consumer.group_id)
+
+    def heartbeat(self, consumer):
+        # Membership changes are pushed to every member as they happen
+        pass
+
+    def _rebalance(self, group_id):
+        """Round-robins each subscribed topic's partitions over the group's members."""
+        members = self._groups.get(group_id, [])
+        assignments = {id(member): set() for member in members}
+        topics = sorted({topic for member in members for topic in member.topics})
+        for topic in topics:
+            subscribers = [member for member in members if topic in member.topics]
+            for partition in range(len(self._partitions(topic))):
+                owner = subscribers[partition % len(subscribers)]
+                assignments[id(owner)].add(TopicPartition(topic, partition))
+        for member in members:
+            member._pending_assignment = assignments[id(member)]
+
+# --- APPEND-ONLY LOG FILE BACKEND ---
+
+# offset, timestamp (ms), key length (_NO_KEY for None), value length
+_FRAME_HEADER = struct.Struct('<QqII')
+_NO_KEY = 0xFFFFFFFF
+_OFFSET_SLOT = struct.Struct('<Q')
+
+class _PartitionLog:
+    """
+    One partition's append-only file of length-prefixed frames, read through mmap. Offsets are
+    record ordinals; each frame also stores its own offset so readers can check where they are.
+    """
+
+    # Every INDEX_INTERVAL-th offset's byte position is remembered, so seek() walks at most that many frames
+    INDEX_INTERVAL = 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._map = None
+        self._mapped_size = 0
+        self._index_offsets = [0]
+        self._index_positions = [0]
+        # (next offset, byte position) at the end of the part of the file already scanned
+        self._scanned = (0, 0)
+        # (next offset, byte position) where the last read stopped: the sequential-read fast path
+        self._cursor = (0, 0)
+        self._lock = threading.Lock()
+
+    def _remap(self):
+        size = os.fstat(self._fd).st_size
+        if size > self._mapped_size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+            self._mapped_size = size
+        return self._mapped_size
+
+    def _frame_end(self, pos, size):
+        """Returns (offset, end position) of the complete frame at pos, or None if it isn't fully written yet."""
+        if pos + _FRAME_HEADER.size > size:
+            return None
+        offset, _, key_len, value_len = _FRAME_HEADER.unpack_from(self._map, pos)
+        end = pos + _FRAME_HEADER.size + (0 if key_len == _NO_KEY else key_len) + value_len
+        if end > size:
+            return None
+        return offset, end
+
+    def _scan(self, upto_offset=None):
+        """Extends the scanned region (and the sparse index) to upto_offset, or to the end of the file."""
+        size = self._remap()
+        offset, pos = self._scanned
+        while upto_offset is None or offset < upto_offset:
+            frame = self._frame_end(pos, size)
+            if frame is None:
+                break
+            offset, pos = frame[0] + 1, frame[1]
+            if offset % self.INDEX_INTERVAL == 0:
+                self._index_offsets.append(offset)
+                self._index_positions.append(pos)
+        self._scanned = (offset, pos)
+        return self._scanned
+
+    def _position(self, offset):
+        """Byte position of the frame with the given offset (or of the end of the log, if offset is past it)."""
+        if offset == self._cursor[0]:
+            return self._cursor[1]
+        end_offset, end_pos = self._scan(offset)
+        if offset >= end_offset:
+            return end_pos
+        i = bisect_right(self._index_offsets, offset) - 1
+        current, pos = self._index_offsets[i], self._index_positions[i]
+        while current < offset:
+            current, pos = self._frame_end(pos, self._mapped_size)
+            current += 1
+        return pos
+
+    def end_offset(self):
+        with self._lock:
+            return self._scan()[0]
+
+    def read(self, offset, max_records):
+        """Returns up to max_records (offset, timestamp, key bytes, value bytes) tuples starting at offset."""
+        with self._lock:
+            size = self._remap()
+            if size == 0:
+                return []
+            pos = self._position(offset)
+            frames = []
+            data = self._map
+            header_size = _FRAME_HEADER.size
+            while len(frames) < max_records and pos + header_size <= size:
+                frame_offset, timestamp, key_len, value_len = _FRAME_HEADER.unpack_from(data, pos)
+                start = pos + header_size
+                if key_len == _NO_KEY:
+                    key, key_len = None, 0
+                else:
+                    key = data[start:start + key_len]
+                end = start + key_len + value_len
+                if end > size:
+                    break
+                frames.append((frame_offset, timestamp, key, data[start + key_len:end]))
+                pos = end
+            if frames:
+                self._cursor = (frames[-1][0] + 1, pos)
+            return frames
+
+    def append(self, entries):
+        """Appends (timestamp, key bytes, value bytes) entries in one write. Returns the first offset used."""
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                # Other processes may have appended since we last looked
+                first_offset, pos = self._scan()
+                chunks = []
+                offset = first_offset
+                for timestamp, key, value in entries:
+                    key_len = _NO_KEY if key is None else len(key)
+                    chunks.append(_FRAME_HEADER.pack(offset, timestamp, key_len, len(value)))
+                    if key is not None:
+                        chunks.append(key)
+                    chunks.append(value)
+                    offset += 1
+                data = b''.join(chunks)
+                os.write(self._fd, data)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+            return first_offset
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            os.close(self._fd)
+
+class LogBroker:
+    """
+    A Kafka stand-in backed by append-only, memory-mapped log files, shared between processes
+    through a directory:
+
+        <log_dir>/<topic>/meta.json                    partition count
+        <log_dir>/<topic>/<partition>.log              frames
+        <log_dir>/_groups/<group>/members/<member>     one heartbeat file per live consumer
+        <log_dir>/_groups/<group>/offsets/<topic>      committed offsets, one 8-byte slot per partition
+
+    Sends are buffered per partition and written with one locked append per partition on
+    flush() (or once max_buffer_bytes is reached). Consumers in a group split the partitions
+    round-robin over the members whose heartbeat is fresher than session_timeout. There is no
+    generation fencing, so delivery across a rebalance is at-least-once, as with Kafka.
+    Values are written with common/event_codec.py in the EVENT_ENCODING format by default, and
+    read in either format.
+    """
+
+    def __init__(self, log_dir=DEFAULT_LOG_DIR, num_partitions=8, value_serializer=None,
+                 value_deserializer=decode_event, max_buffer_bytes=1 << 20,
+                 session_timeout=10.0, heartbeat_interval=1.0):
+        self.log_dir = log_dir
+        self.num_partitions = num_partitions
+        self.value_serializer = value_serializer or event_serializer(_event_encoding())
+        self.value_deserializer = value_deserializer
+        self.max_buffer_bytes = max_buffer_bytes
+        self.session_timeout = session_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self._topics = {}
+        self._offset_files = {}
+        self._buffers = {}
+        self._buffered_bytes = 0
+        self._lock = threading.RLock()
+        os.makedirs(log_dir, exist_ok=True)
+
+    def _partitions(self, topic):
+        logs = self._topics.get(topic)
+        if logs is not None:
+            return logs
+        with self._lock:
+            if topic in self._topics:
+                return self._topics[topic]
+            topic_dir = os.path.join(self.log_dir, topic)
+            os.makedirs(topic_dir, exist_ok=True)
+            meta_path = os.path.join(topic_dir, 'meta.json')
+            try:
+                # O_EXCL: the first process to use a topic fixes its partition count
+                fd = os.open(meta_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'partitions': self.num_partitions}, f)
+                num_partitions = self.num_partitions
+            except FileExistsError:
+                num_partitions = None
+                while not num_partitions:
+                    try:
+                        with open(meta_path) as f:
+                            num_partitions = json.load(f)['partitions']
+                    except ValueError:
+                        time.sleep(0.01)  # being written by another process
+            logs = [_PartitionLog(os.path.join(topic_dir, f'{p}.log')) for p in range(num_partitions)]
+            self._topics[topic] = logs
+            return logs
+
+    def append(self, topic, value, key=None, partition=None):
+        logs = self._partitions(topic)
+        if partition is None:
+            partition = partition_for(key, len(logs))
+        key_bytes = key.encode('utf-8') if isinstance(key, str) else key
+        value_bytes = self.value_serializer(value)
+        result = _SendResult(broker=self)
+        with self._lock:
+            entries = self._buffers.setdefault(TopicPartition(topic, partition), [])
+            entries.append((int(time.time() * 1000), key_bytes, value_bytes, key, value, result))
+            self._buffered_bytes += len(value_bytes)
+            if self._buffered_bytes >= self.max_buffer_bytes:
+                self.flush()
+        return result
+
+    def flush(self):
+        """Writes every buffered send to its partition file."""
+        with self._lock:
+            buffers, self._buffers, self._buffered_bytes = self._buffers, {}, 0
+            for tp, entries in buffers.items():
+                first_offset = self._topics[tp.topic][tp.partition].append(
+                    [(timestamp, key_bytes, value_bytes) for timestamp, key_bytes, value_bytes, _, _, _ in entries]
+                )
+                for i, (timestamp, _, _, key, value, result) in enumerate(entries):
+                    result.record = Record(tp.topic, tp.partition, first_offset + i, timestamp, key, value)
+
+    def read(self, tp, offset, max_records):
+        frames = self._partitions(tp.topic)[tp.partition].read(offset, max_records)
+        deserialize = self.value_deserializer
+        return [
+            Record(tp.topic, tp.partition, frame_offset, timestamp,
+                   key.decode('utf-8') if key is not None else None, deserialize(value))
+            for frame_offset, timestamp, key, value in frames
+        ]
+
+    def end_offset(self, tp):
+        return self._partitions(tp.topic)[tp.partition].end_offset()
+
+    def wait_for_data(self, timeout):
+        # Writers may be other processes, so there is nothing to be notified by; poll the files
+        time.sleep(min(timeout, 0.005))
+
+    def _group_dir(self, group_id, *parts):
+        path = os.path.join(self.log_dir, '_groups', group_id, *parts)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _offsets_fd(self, group_id, topic):
+        key = (group_id, topic)
+        fd = self._offset_files.get(key)
+        if fd is None:
+            path = os.path.join(self._group_dir(group_id, 'offsets'), topic)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._offset_files[key] = fd
+        return fd
+
+    def committed(self, group_id, tp):
+        data = os.pread(self._offsets_fd(group_id, tp.topic), _OFFSET_SLOT.size, tp.partition * _OFFSET_SLOT.size)
+        if len(data) < _OFFSET_SLOT.size:
+            return None
+        # Slots hold offset + 1 so that the zeros of a fresh (or sparse) file read as "nothing committed"
+        stored = _OFFSET_SLOT.unpack(data)[0]
+        return stored - 1 if stored else None
+
+    def commit(self, group_id, offsets):
+        # Aligned 8-byte in-place writes: no rename per commit, which costs tens of ms on some filesystems
+        for tp, offset in offsets.items():
+            os.pwrite(self._offsets_fd(group_id, tp.topic), _OFFSET_SLOT.pack(offset + 1), tp.partition * _OFFSET_SLOT.size)
+
+    def _member_path(self, consumer):
+        return os.path.join(self._group_dir(consumer.group_id, 'members'), consumer.member_id)
+
+    def join(self, consumer):
+        consumer.member_id = f'{socket.gethostname()}-{os.getpid()}-{id(consumer)}'
+        consumer._last_heartbeat = 0.0
+        with open(self._member_path(consumer), 'w') as f:
+            json.dump(sorted(consumer.topics), f)
+        self.heartbeat(consumer)
+
+    def leave(self, consumer):
+        if getattr(consumer, 'member_id', None) is None:
+            return
+        try:
+            os.unlink(self._member_path(consumer))
+        except FileNotFoundError:
+            pass
+        consumer.member_id = None
+
+    def heartbeat(self, consumer):
+        """Refreshes the consumer's membership and recomputes its assignment from the live members."""
+        now = time.time()
+        if now - consumer._last_heartbeat < self.heartbeat_interval:
+            return
+        consumer._last_heartbeat = now
+        try:
+            os.utime(self._member_path(consumer))
+        except FileNotFoundError:
+            # Expired by another member after a long stall: rejoin
+            with open(self._member_path(consumer), 'w') as f:
+                json.dump(sorted(consumer.topics), f)
+
+        members_dir = self._group_dir(consumer.group_id, 'members')
+        members = {}
+        for member_id in sorted(os.listdir(members_dir)):
+            path = os.path.join(members_dir, member_id)
+            try:
+                if now - os.stat(path).st_mtime > self.session_timeout:
+                    os.unlink(path)  # a consumer that died without leaving
+                    continue
+                with open(path) as f:
+                    members[member_id] = set(json.load(f))
+            except (FileNotFoundError, ValueError):
+                continue
+
+        assignment = set()
+        for topic in sorted(consumer.topics):
+            subscribers = [member_id for member_id, topics in members.items() if topic in topics]
+            if not subscribers:
+                continue
+            for partition in range(len(self._partitions(topic))):
+                if subscribers[partition % len(subscribers)] == consumer.member_id:
+                    assignment.add(TopicPartition(topic, partition))
+        consumer._pending_assignment = assignment
+
+    def close(self):
+        self.flush()
+        for logs in self._topics.values():
+            for log in logs:
+                log.close()
+        self._topics.clear()
+        for fd in self._offset_files.values():
+            os.close(fd)
+        self._offset_files.clear()
+
+# --- LOCAL PRODUCER AND CONSUMER (for InMemoryBroker and LogBroker) ---
+
+class LocalProducer:
+    """KafkaProducer-compatible producer for an InMemoryBroker or LogBroker."""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def send(self, topic, value=None, key=None, partition=None):
+        return self.broker.append(topic, value, key, partition)
+
+    def flush(self, timeout=None):
+        self.broker.flush()
+
+    def close(self, timeout=None):
+        self.broker.flush()
+
+class LocalConsumer:
+    """
+    KafkaConsumer-compatible consumer for an InMemoryBroker or LogBroker: poll()/iteration,
+    manual or auto commit, seek(), and group membership with ConsumerRebalanceListener-style callbacks.
+    """
+
+    def __init__(self, broker, *topics, group_id=None, enable_auto_commit=True,
+                 auto_offset_reset='earliest', max_poll_records=500, listener=None):
+        self.broker = broker
+        self.group_id = group_id or f"anonymous-{os.getpid()}-{id(self)}"
+        self.enable_auto_commit = enable_auto_commit
+        self.auto_offset_reset = auto_offset_reset
+        self.max_poll_records = max_poll_records
+        self.topics = set()
+        self._listener = listener
+        self._assignment = set()
+        self._pending_assignment = None
+        self._positions = {}
+        self._closed = False
+        if topics:
+            self.subscribe(topics, listener=listener)
+
+    def subscribe(self, topics=(), pattern=None, listener=None):
+        if listener is not None:
+            self._listener = listener
+        self.broker.leave(self)
+        self.topics = set(topics)
+        self.broker.join(self)
+
+    def assignment(self):
+        return set(self._assignment)
+
+    def _apply_pending_assignment(self):
+        pending, self._pending_assignment = self._pending_assignment, None
+        if pending is None or pending == self._assignment:
+            return
+        revoked = self._assignment - pending
+        if revoked and self._listener is not None:
+            self._listener.on_partitions_revoked(revoked)
+        for tp in revoked:
+            self._positions.pop(tp, None)
+        added = pending - self._assignment
+        self._assignment = set(pending)
+        for tp in added:
+            committed = self.broker.committed(self.group_id, tp)
+            if committed is not None:
+                self._positions[tp] = committed
+            elif self.auto_offset_reset == 'earliest':
+                self._positions[tp] = 0
+            else:
+                self._positions[tp] = self.broker.end_offset(tp)
+        if added and self._listener is not None:
+            self._listener.on_partitions_assigned(added)
+
+    def poll(self, timeout_ms=0, max_records=None):
+        """Returns {TopicPartition: [Record]} with up to max_records records in total."""
+        max_records = max_records or self.max_poll_records
+        deadline = time.monotonic() + timeout_ms / 1000.0
+        while True:
+            self.broker.heartbeat(self)
+            self._apply_pending_assignment()
+            result = {}
+            remaining = max_records
+            for tp in sorted(self._assignment):
+                if remaining <= 0:
+                    break
+                records = self.broker.read(tp, self._positions[tp], remaining)
+                if records:
+                    result[tp] = records
+                    self._positions[tp] += len(records)
+                    remaining -= len(records)
+            if result:
+                if self.enable_auto_commit:
+                    self.commit()
+                return result
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return {}
+            self.broker.wait_for_data(timeout)
+
+    def __iter__(self):
+        while not self._closed:
+            for records in self.poll(timeout_ms=1000).values():
+                yield from records
+
+    def position(self, tp):
+        return self._positions[tp]
+
+    def seek(self, tp, offset):
+        self._positions[TopicPartition(*tp)] = offset
+
+    def commit(self, offsets=None):
+        """Commits the given {TopicPartition: offset} (or the current positions) for the group."""
+        if offsets is None:
+            offsets = dict(self._positions)
+        self.broker.commit(self.group_id, {TopicPartition(*tp): getattr(o, 'offset', o) for tp, o in offsets.items()})
+
+    def committed(self, tp):
+        return self.broker.committed(self.group_id, TopicPartition(*tp))
+
+    def close(self, autocommit=True):
+        if self._closed:
+            return
+        if autocommit and self.enable_auto_commit:
+            self.commit()
+        self._closed = True
+        self.broker.leave(self)
+
+# --- KAFKA BACKEND ---
+
+def _kafka_ssl_config():
+    return {
+        'security_protocol': "SSL",
+        'ssl_cafile': os.getenv("KAFKA_SSL_CAFILE", "../ca.pem"),
+        'ssl_certfile': os.getenv("KAFKA_SSL_CERTFILE", "../service.cert"),
+        'ssl_keyfile': os.getenv("KAFKA_SSL_KEYFILE", "../service.key"),
+    }
+
+def create_kafka_producer(service_uri):
+    """Creates a Kafka producer for Aiven."""
+    from kafka import KafkaProducer
+    print("Connecting to Aiven Kafka...")
+    while True:
+        try:
+            producer = KafkaProducer(
+                bootstrap_servers=service_uri,
+                value_serializer=event_serializer(_event_encoding()),
+                key_serializer=lambda k: k.encode('utf-8') if isinstance(k, str) else k,
+                request_timeout_ms=120000,
+                **_kafka_ssl_config()
+            )
+            print("Connected to Aiven Kafka!")
+            return producer
+        except Exception as e:
+            print(f"Failed to connect to Aiven Kafka: {e}. Retrying...")
+            time.sleep(5)
+
+def create_kafka_consumer(service_uri, topic_name, group_id, enable_auto_commit=True):
+    """Creates a Kafka consumer for Aiven with a group_id."""
+    from kafka import KafkaConsumer
+    print("Connecting to Aiven Kafka for stream processing...")
+    while True:
+        try:
+            consumer = KafkaConsumer(
+                topic_name,
+                bootstrap_servers=service_uri,
+                auto_offset_reset='earliest',
+                value_deserializer=decode_event,
+                request_timeout_ms=120000,
+                enable_auto_commit=enable_auto_commit,
+                group_id=group_id,
+                **_kafka_ssl_config()
+            )
+            print("Stream processor connected to Aiven Kafka!")
+            return consumer
+        except Exception as e:
+            print(f"Failed to connect: {e}. Retrying...")
+            time.sleep(5)
+
+# --- BACKEND SELECTION ---
+
+_local_brokers = {}
+
+def get_local_broker(backend):
+    """Returns this process's shared broker for the 'memory' or 'log' backend."""
+    if backend not in _local_brokers:
+        num_partitions = int(os.getenv("TRANSPORT_PARTITIONS", "8"))
+        if backend == 'memory':
+            _local_brokers[backend] = InMemoryBroker(num_partitions)
+        elif backend == 'log':
+            _local_brokers[backend] = LogBroker(os.getenv("TRANSPORT_LOG_DIR", DEFAULT_LOG_DIR), num_partitions)
+        else:
+            raise ValueError(f"Unknown EVENT_TRANSPORT '{backend}'. Use 'kafka', 'log' or 'memory'.")
+    return _local_brokers[backend]
+
+def _selected_backend(backend):
+    return backend or os.getenv("EVENT_TRANSPORT", "kafka")
+
+def create_producer(backend=None):
+    """Creates a producer for the backend named by EVENT_TRANSPORT (kafka, log or memory)."""
+    backend = _selected_backend(backend)
+    if backend == 'kafka':
+        service_uri = os.getenv("AIVEN_SERVICE_URI")
+        if not service_uri:
+            raise ValueError("AIVEN_SERVICE_URI not found in .env file.")
+        return create_kafka_producer(service_uri)
+    return LocalProducer(get_local_broker(backend))
+
+def create_consumer(topic_name, group_id, enable_auto_commit=True, backend=None):
+    """Creates a consumer subscribed to topic_name for the backend named by EVENT_TRANSPORT."""
+    backend = _selected_backend(backend)
+    if backend == 'kafka':
+        service_uri = os.getenv("AIVEN_SERVICE_URI")
+        if not service_uri:
+            raise ValueError("AIVEN_SERVICE_URI not found in .env file.")
+        return create_kafka_consumer(service_uri, topic_name, group_id, enable_auto_commit)
+    consumer = LocalConsumer(get_local_broker(backend), topic_name, group_id=group_id, enable_auto_commit=enable_auto_commit)
+    print(f"Stream processor consuming '{topic_name}' from the local '{backend}' transport.")
+    return consumer
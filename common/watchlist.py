@@ -0,0 +1,317 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+
+from common.risk_queries import RISK_TIER_CONDITIONS, _fetch_dicts
+
+DEFAULT_PAGE_SIZE = 20
+# Searches count their matches up to this many; beyond it the page count is a lower bound
+SEARCH_COUNT_LIMIT = 10000
+
+# Every watchlist page walks current_risk in rank order: the whole table through
+# idx_current_risk_rank, or one contract's customers through idx_current_risk_contract_rank, so
+# a rare contract and tier combination doesn't scan past every other contract's rows. The users
+# indexes serve ID search: a trigram index for substring matches where the pg_trgm extension is
+# available (it is on Supabase), and an upper-cased prefix index that needs no extension.
+WATCHLIST_INDEXES = """
+    CREATE INDEX IF NOT EXISTS idx_current_risk_rank ON current_risk (churn_probability DESC, user_id DESC);
+    CREATE INDEX IF NOT EXISTS idx_current_risk_contract_rank ON current_risk (contract, churn_probability DESC, user_id DESC);
+    CREATE INDEX IF NOT EXISTS idx_users_id_prefix ON users (upper(customerID) text_pattern_ops);
+"""
+TRIGRAM_INDEX = "CREATE INDEX IF NOT EXISTS idx_users_id_trgm ON users USING gin (customerID gin_trgm_ops);"
+
+def create_watchlist_indexes(cursor):
+    """Creates the watchlist's indexes. Returns False if pg_trgm isn't available, so only prefix search is indexed."""
+    cursor.execute(WATCHLIST_INDEXES)
+    cursor.execute("SAVEPOINT watchlist_trigram;")
+    try:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        cursor.execute(TRIGRAM_INDEX)
+    except psycopg2.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT watchlist_trigram;")
+        print(f"pg_trgm is not available ({str(e).splitlines()[0]}); watchlist search will match customer ID prefixes.")
+        return False
+    cursor.execute("RELEASE SAVEPOINT watchlist_trigram;")
+    return True
+
+def detect_search_mode(conn):
+    """'contains' if the trigram index exists, else 'prefix': the widest match an index can serve."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('idx_users_id_trgm') IS NOT NULL;")
+        has_trigram = cursor.fetchone()[0]
+    conn.commit()
+    return 'contains' if has_trigram else 'prefix'
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_condition(search, search_mode='contains'):
+    """The SQL condition and parameter for a customer ID search."""
+    if search_mode == 'prefix':
+        return "upper(u.customerID) LIKE %s", _escape_like(search.upper()) + '%'
+    return "u.customerID ILIKE %s", '%' + _escape_like(search) + '%'
+
+def filter_conditions(search='', risks=(), contracts=(), search_mode='contains'):
+    """Returns (conditions, params) for the watchlist filters."""
+    conditions = []
+    params = []
+    tier_conditions = [f"({RISK_TIER_CONDITIONS[risk]})" for risk in risks if risk in RISK_TIER_CONDITIONS]
+    if tier_conditions:
+        conditions.append(f"({' OR '.join(tier_conditions)})")
+    if contracts:
+        conditions.append("cr.contract = ANY(%s)")
+        params.append(list(contracts))
+    if search:
+        condition, param = search_condition(search, search_mode)
+        conditions.append(condition)
+        params.append(param)
+    return conditions, params
+
+def encode_cursor(row):
+    """Keyset cursor for the row after which the next watchlist page starts."""
+    return f"{row['risk_score']!r}:{row['customerid']}"
+
+def decode_cursor(cursor_value):
+    score, customer_id = cursor_value.split(':', 1)
+    return float(score), customer_id
+
+def fetch_watchlist_page(conn, page=1, page_size=DEFAULT_PAGE_SIZE, search='', risks=(), contracts=(), after=None,
+                         search_mode='contains'):
+    """
+    Returns one page of the watchlist, highest risk first.
+
+    Rows are read in (churn_probability DESC, user_id DESC) order, the order of the rank indexes,
+    so a page costs about page_size index entries. Pass after=next_cursor to continue from the
+    previous page; page numbers still work but skip over (page - 1) * page_size rows. A contract
+    filter becomes one ordered branch per contract, merged with UNION ALL: Postgres can only read
+    idx_current_risk_contract_rank in order for a single contract value.
+    """
+    conditions, params = filter_conditions(search, risks, (), search_mode)
+    offset = 0
+    if after:
+        conditions.append("(cr.churn_probability, cr.user_id) < (%s, %s)")
+        params.extend(decode_cursor(after))
+    else:
+        offset = (max(page, 1) - 1) * page_size
+
+    def select(extra_conditions):
+        where = " AND ".join(conditions + extra_conditions)
+        return f"""
+            SELECT u.customerID AS customerid, cr.churn_probability AS risk_score, u.tenure, u.Contract AS contract,
+                   u.TotalCharges AS totalcharges, u.MonthlyCharges AS monthlycharges, cr.prediction_timestamp
+            FROM current_risk cr
+            JOIN users u ON u.customerID = cr.user_id
+            {f'WHERE {where}' if where else ''}
+            ORDER BY cr.churn_probability DESC, cr.user_id DESC
+        """
+
+    if contracts:
+        contracts = sorted(set(contracts))
+        branches = " UNION ALL ".join(f"({select(['cr.contract = %s'])} LIMIT %s)" for _ in contracts)
+        sql = f"SELECT * FROM ({branches}) page ORDER BY risk_score DESC, customerid DESC LIMIT %s OFFSET %s"
+        query_params = [value for contract in contracts for value in (*params, contract, offset + page_size)]
+    else:
+        sql = f"{select([])} LIMIT %s OFFSET %s"
+        query_params = list(params)
+    with conn.cursor() as cursor:
+        cursor.execute(sql, query_params + [page_size, offset])
+        return _fetch_dicts(cursor)
+
+def count_watchlist(conn, search='', risks=(), contracts=(), search_mode='contains', limit=None):
+    """The number of customers matching the watchlist filters, counting no further than limit if given."""
+    conditions, params = filter_conditions(search, risks, contracts, search_mode)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM current_risk cr
+                JOIN users u ON u.customerID = cr.user_id
+                {where}
+                {'LIMIT %s' if limit else ''}
+            ) matches
+        """, params + ([limit] if limit else []))
+        return cursor.fetchone()[0]
+
+def fetch_tier_contract_counts(conn):
+    """
+    Returns {(risk tier, contract): customers}. The total for any combination of tier and contract
+    filters is a sum of these, so one pass over current_risk (without touching users) serves them all.
+    """
+    tiers = " ".join(f"WHEN {condition} THEN '{tier}'" for tier, condition in RISK_TIER_CONDITIONS.items())
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT CASE {tiers} END AS tier, cr.contract, COUNT(*)
+            FROM current_risk cr
+            GROUP BY 1, 2
+        """)
+        return {(tier, contract): count for tier, contract, count in cursor.fetchall()}
+
+class TTLCache:
+    """A small LRU cache whose entries expire ttl seconds after they were stored. Thread-safe."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if not self.ttl or not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class WatchlistEngine:
+    """
+    Serves /api/watchlist pages, caching recent results for a few seconds.
+
+    The Watchlist page sends a request on every debounced keystroke and filter click, and many
+    users look at the same few filter combinations, so pages are cached for cache_ttl seconds.
+    The total behind "Page x of y" costs far more than a page and changes slowly:
+    - Without a search, it is summed from the customers per (risk tier, contract), which are
+      counted in one pass every count_ttl seconds and shared by every filter combination.
+    - With a search, matches are counted up to SEARCH_COUNT_LIMIT and cached for count_ttl seconds.
+    """
+
+    def __init__(self, db, search_mode=None, page_size=DEFAULT_PAGE_SIZE, cache_ttl=5.0, count_ttl=30.0, max_entries=1024):
+        self.db = db
+        self.search_mode = search_mode
+        self.page_size = page_size
+        self.count_ttl = count_ttl
+        self.pages = TTLCache(cache_ttl, max_entries)
+        self.counts = TTLCache(count_ttl, max_entries)
+        self._tier_contract_counts = None
+        self._tier_contract_counted_at = 0.0
+        self._recounting = threading.Event()
+        self.count_refreshes = 0
+
+    def _filters(self, search, risks, contracts):
+        """A canonical form of the filters, so equivalent requests share cache entries."""
+        search = (search or '').strip()
+        if self.search_mode == 'prefix':
+            search = search.upper()
+        return (
+            search,
+            tuple(sorted({risk for risk in risks if risk in RISK_TIER_CONDITIONS})),
+            tuple(sorted(set(contracts))),
+        )
+
+    def _recount(self, conn):
+        self._tier_contract_counts = fetch_tier_contract_counts(conn)
+        self._tier_contract_counted_at = time.monotonic()
+        self.count_refreshes += 1
+
+    def _recount_in_background(self):
+        try:
+            with self.db.connection() as conn:
+                self._recount(conn)
+        except Exception as e:
+            print(f"WATCHLIST: Recounting customers per tier and contract failed: {e}")
+        finally:
+            self._recounting.clear()
+
+    def tier_contract_counts(self, conn):
+        """
+        The (risk tier, contract) counts. Once they are count_ttl seconds old they are recounted on
+        a background thread from the engine's pool, and the old counts are served until it finishes.
+        """
+        if self._tier_contract_counts is None or self.db is None:
+            if self._tier_contract_counts is None or time.monotonic() - self._tier_contract_counted_at >= self.count_ttl:
+                self._recount(conn)
+        elif time.monotonic() - self._tier_contract_counted_at >= self.count_ttl and not self._recounting.is_set():
+            self._recounting.set()
+            threading.Thread(target=self._recount_in_background, name="watchlist-recount", daemon=True).start()
+        return self._tier_contract_counts
+
+    def count(self, conn, filters, use_cache=True):
+        """Returns (total, capped) for canonical filters; capped means there are more than total."""
+        search, risks, contracts = filters
+        if not search:
+            return sum(
+                count for (tier, contract), count in self.tier_contract_counts(conn).items()
+                if (not risks or tier in risks) and (contract in contracts if contracts else True)
+            ), False
+        total = self.counts.get(filters) if use_cache else None
+        if total is None:
+            total = count_watchlist(conn, search, risks, contracts, self.search_mode, limit=SEARCH_COUNT_LIMIT + 1)
+            self.counts.put(filters, total)
+        return min(total, SEARCH_COUNT_LIMIT), total > SEARCH_COUNT_LIMIT
+
+    def fetch(self, conn, page=1, search='', risks=(), contracts=(), after=None, use_cache=True):
+        """
+        Returns one page as {users, total_pages, total_users, total_capped, next_cursor}, from the
+        cache if it is fresh. use_cache=False skips the page and search count caches.
+        """
+        if self.search_mode is None:
+            self.search_mode = detect_search_mode(conn)
+        filters = self._filters(search, risks, contracts)
+        search, risks, contracts = filters
+        page = max(page, 1)
+        page_key = (filters, after or page)
+        if use_cache:
+            cached = self.pages.get(page_key)
+            if cached is not None:
+                return cached
+
+        users = fetch_watchlist_page(conn, page, self.page_size, search, risks, contracts, after, self.search_mode)
+        total_users, capped = self.count(conn, filters, use_cache)
+        conn.commit()
+
+        result = {
+            "users": users,
+            "total_pages": max(1, math.ceil(total_users / self.page_size)),
+            "total_users": total_users,
+            "total_capped": capped,
+            "next_cursor": encode_cursor(users[-1]) if len(users) == self.page_size else None,
+        }
+        if use_cache:
+            self.pages.put(page_key, result)
+        return result
+
+    def get(self, page=1, search='', risks=(), contracts=(), after=None):
+        """fetch() on a connection from the engine's pool."""
+        with self.db.connection() as conn:
+            return self.fetch(conn, page, search, risks, contracts, after)
+
+    def clear(self):
+        self.pages.clear()
+        self.counts.clear()
+        self._tier_contract_counts = None
+
+    def stats(self):
+        lookups = self.pages.hits + self.pages.misses
+        return {
+            "search_mode": self.search_mode,
+            "page_hits": self.pages.hits,
+            "page_misses": self.pages.misses,
+            "page_hit_rate": self.pages.hits / lookups if lookups else 0.0,
+            "search_count_hits": self.counts.hits,
+            "search_count_misses": self.counts.misses,
+            "tier_contract_recounts": self.count_refreshes,
+            "cached_pages": len(self.pages),
+        }
@@ -0,0 +1,301 @@
+import os
+import re
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from common.db import get_db_connection
+
+load_dotenv()
+
+# Partitioned tables and the timestamp column each is ranged on
+PARTITIONED_TABLES = {
+    'events': 'event_timestamp',
+    'predictions': 'prediction_timestamp',
+}
+
+TABLE_COLUMNS = {
+    'events': """
+        event_id BIGSERIAL, user_id VARCHAR(255), event_type VARCHAR(255),
+        event_timestamp TIMESTAMPTZ NOT NULL, event_data JSONB, payload BYTEA,
+        PRIMARY KEY (event_id, event_timestamp)
+    """,
+    'predictions': """
+        prediction_id BIGSERIAL, user_id VARCHAR(255),
+        churn_probability FLOAT, prediction_timestamp TIMESTAMPTZ NOT NULL, top_features JSONB,
+        PRIMARY KEY (prediction_id, prediction_timestamp)
+    """,
+}
+
+# Created on the partitioned parent, so Postgres adds them to every partition
+TABLE_INDEXES = {
+    'events': """
+        CREATE INDEX IF NOT EXISTS idx_events_time ON events (event_timestamp);
+        CREATE INDEX IF NOT EXISTS idx_events_user_time ON events (user_id, event_timestamp DESC);
+    """,
+    'predictions': """
+        CREATE INDEX IF NOT EXISTS idx_predictions_user_time ON predictions (user_id, prediction_timestamp DESC);
+        CREATE INDEX IF NOT EXISTS idx_predictions_time ON predictions (prediction_timestamp);
+    """,
+}
+
+PARTITION_DAYS_AHEAD = int(os.getenv("PARTITION_DAYS_AHEAD", "7"))
+EVENTS_RETENTION_DAYS = int(os.getenv("EVENTS_RETENTION_DAYS", "30"))
+PREDICTIONS_RETENTION_DAYS = int(os.getenv("PREDICTIONS_RETENTION_DAYS", "30"))
+# Daily rollups are much smaller than the raw history; 0 keeps them forever
+ROLLUP_RETENTION_DAYS = int(os.getenv("ROLLUP_RETENTION_DAYS", "0"))
+# Days re-aggregated on every pass when raw predictions are kept forever; otherwise all retained days are
+ROLLUP_WINDOW_DAYS = int(os.getenv("ROLLUP_WINDOW_DAYS", "30"))
+
+_PARTITION_SUFFIX = re.compile(r'_p(\d{8})$')
+
+def utc_today():
+    return datetime.now(timezone.utc).date()
+
+def partition_name(table, day):
+    return f"{table}_p{day:%Y%m%d}"
+
+def _day_bound(day):
+    return f"{day.isoformat()} 00:00:00+00"
+
+def create_partitioned_table(cursor, table):
+    """
+    Creates a table range-partitioned by day on its timestamp column, with a DEFAULT partition
+    that catches rows for days no partition has been created for yet (so writes never fail).
+    """
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} ({TABLE_COLUMNS[table]}) PARTITION BY RANGE ({PARTITIONED_TABLES[table]});
+        CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT;
+    """)
+
+def create_table_indexes(cursor, table):
+    cursor.execute(TABLE_INDEXES[table])
+
+def create_rollup_table(cursor):
+    """Per-user daily aggregates of 'predictions', kept after the raw rows are dropped."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS prediction_daily (
+            user_id VARCHAR(255) NOT NULL, day DATE NOT NULL,
+            predictions INT NOT NULL, avg_probability FLOAT NOT NULL,
+            min_probability FLOAT NOT NULL, max_probability FLOAT NOT NULL,
+            last_probability FLOAT NOT NULL,
+            PRIMARY KEY (user_id, day)
+        );
+        CREATE INDEX IF NOT EXISTS idx_prediction_daily_day ON prediction_daily (day);
+    """)
+
+def is_partitioned(cursor, table):
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (table,))
+    row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+def list_partitions(cursor, table):
+    """Returns {day: partition name} for the table's daily partitions (the DEFAULT partition excluded)."""
+    cursor.execute("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = %s;
+    """, (table,))
+    partitions = {}
+    for (name,) in cursor.fetchall():
+        match = _PARTITION_SUFFIX.search(name)
+        if match:
+            partitions[datetime.strptime(match.group(1), '%Y%m%d').date()] = name
+    return partitions
+
+def create_partition(cursor, table, day):
+    """
+    Creates the partition for one UTC day. Rows for that day that already landed in the DEFAULT
+    partition are moved into it, which Postgres requires before the new bounds can be attached.
+    """
+    column = PARTITIONED_TABLES[table]
+    name = partition_name(table, day)
+    start, end = _day_bound(day), _day_bound(day + timedelta(days=1))
+    cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table}_default WHERE {column} >= %s AND {column} < %s);", (start, end))
+    if not cursor.fetchone()[0]:
+        cursor.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s);", (start, end))
+        return name
+
+    cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {table}_default;")
+    cursor.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s);", (start, end))
+    cursor.execute(f"""
+        WITH moved AS (
+            DELETE FROM {table}_default WHERE {column} >= %s AND {column} < %s RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved;
+    """, (start, end))
+    print(f"  Moved {cursor.rowcount} rows from {table}_default into {name}.")
+    cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {table}_default DEFAULT;")
+    return name
+
+def ensure_partitions(cursor, table, days_ahead=PARTITION_DAYS_AHEAD, start_day=None):
+    """Creates the daily partitions from start_day (default: today, UTC) through days_ahead days from now."""
+    existing = list_partitions(cursor, table)
+    start_day = start_day or utc_today()
+    created = []
+    day = start_day
+    while day <= utc_today() + timedelta(days=days_ahead):
+        if day not in existing:
+            created.append(create_partition(cursor, table, day))
+        day += timedelta(days=1)
+    return created
+
+def rollup_predictions(cursor, through_day=None, window_days=ROLLUP_WINDOW_DAYS):
+    """
+    Aggregates raw predictions into prediction_daily for every complete UTC day up to through_day
+    (default: yesterday). Rolling up is idempotent: the last window_days days are recomputed on
+    every pass, so rows that land late for an earlier day are counted before retention drops
+    them, along with any older day not rolled up yet. Returns the number of (user, day) rows written.
+    """
+    through_day = through_day or utc_today() - timedelta(days=1)
+    cursor.execute("SELECT MIN(prediction_timestamp) FROM predictions;")
+    first = cursor.fetchone()[0]
+    if first is None:
+        return 0
+    first_day = first.astimezone(timezone.utc).date()
+    cursor.execute("SELECT MAX(day) FROM prediction_daily;")
+    last_rolled = cursor.fetchone()[0]
+    start_day = through_day - timedelta(days=max(window_days, 1) - 1)
+    if last_rolled is None:
+        start_day = first_day
+    elif last_rolled < start_day:
+        start_day = last_rolled
+    start_day = max(start_day, first_day)
+    if start_day > through_day:
+        return 0
+
+    cursor.execute("""
+        INSERT INTO prediction_daily (user_id, day, predictions, avg_probability, min_probability, max_probability, last_probability)
+        SELECT user_id, (prediction_timestamp AT TIME ZONE 'UTC')::date AS day,
+               COUNT(*), AVG(churn_probability), MIN(churn_probability), MAX(churn_probability),
+               (ARRAY_AGG(churn_probability ORDER BY prediction_timestamp DESC))[1]
+        FROM predictions
+        WHERE prediction_timestamp >= %s AND prediction_timestamp < %s AND churn_probability IS NOT NULL
+        GROUP BY user_id, day
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            predictions = EXCLUDED.predictions, avg_probability = EXCLUDED.avg_probability,
+            min_probability = EXCLUDED.min_probability, max_probability = EXCLUDED.max_probability,
+            last_probability = EXCLUDED.last_probability;
+    """, (_day_bound(start_day), _day_bound(through_day + timedelta(days=1))))
+    return cursor.rowcount
+
+def drop_expired_partitions(cursor, table, retention_days):
+    """
+    Drops the daily partitions that end on or before the retention cutoff, and deletes expired
+    rows that landed in the DEFAULT partition. Returns the names of the dropped partitions.
+    """
+    if retention_days <= 0:
+        return []
+    cutoff = utc_today() - timedelta(days=retention_days)
+    dropped = []
+    for day, name in sorted(list_partitions(cursor, table).items()):
+        if day + timedelta(days=1) <= cutoff:
+            cursor.execute(f"DROP TABLE {name};")
+            dropped.append(name)
+    column = PARTITIONED_TABLES[table]
+    cursor.execute(f"DELETE FROM {table}_default WHERE {column} < %s;", (_day_bound(cutoff),))
+    return dropped
+
+def partition_existing_table(cursor, table):
+    """
+    Converts a plain (pre-partitioning) table into the partitioned layout: the old table is renamed,
+    a partitioned one is created with partitions for every day it has data, the rows are copied
+    across and the ID sequence carries on from the old maximum. Runs in the caller's transaction.
+    """
+    column = PARTITIONED_TABLES[table]
+    id_column = 'event_id' if table == 'events' else 'prediction_id'
+    legacy = f"{table}_unpartitioned"
+    print(f"Converting '{table}' to a partitioned table...")
+    cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy};")
+    # The old table's SERIAL sequence and primary key keep their names; free them for the new table
+    cursor.execute(f"ALTER SEQUENCE IF EXISTS {table}_{id_column}_seq RENAME TO {legacy}_{id_column}_seq;")
+    cursor.execute(f"ALTER INDEX IF EXISTS {table}_pkey RENAME TO {legacy}_pkey;")
+    create_partitioned_table(cursor, table)
+    if table == 'predictions':
+        cursor.execute(f"ALTER TABLE {legacy} ADD COLUMN IF NOT EXISTS top_features JSONB;")
+    else:
+        cursor.execute(f"ALTER TABLE {legacy} ADD COLUMN IF NOT EXISTS payload BYTEA;")
+
+    cursor.execute(f"SELECT MIN({column}), MAX({column}), MAX({id_column}) FROM {legacy};")
+    first, last, max_id = cursor.fetchone()
+    if first is not None:
+        ensure_partitions(cursor, table, start_day=first.astimezone(timezone.utc).date())
+    columns = 'event_id, user_id, event_type, event_timestamp, event_data, payload' if table == 'events' else \
+        'prediction_id, user_id, churn_probability, prediction_timestamp, top_features'
+    cursor.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {legacy} WHERE {column} IS NOT NULL;")
+    print(f"  Copied {cursor.rowcount} rows into the partitioned '{table}'.")
+    create_table_indexes(cursor, table)
+    if max_id is not None:
+        cursor.execute("SELECT setval(pg_get_serial_sequence(%s, %s), %s);", (table, id_column, max_id))
+    cursor.execute(f"DROP TABLE {legacy};")
+
+def run_maintenance(conn, days_ahead=PARTITION_DAYS_AHEAD, events_retention_days=EVENTS_RETENTION_DAYS,
+                    predictions_retention_days=PREDICTIONS_RETENTION_DAYS, rollup_retention_days=ROLLUP_RETENTION_DAYS,
+                    migrate=False):
+    """
+    One maintenance pass: creates upcoming partitions, rolls completed days of predictions up into
+    prediction_daily, then drops raw partitions (and old rollups) past their retention.
+    Each step commits on its own so a failure part-way keeps the earlier steps.
+    """
+    started = time.monotonic()
+    with conn.cursor() as cursor:
+        create_rollup_table(cursor)
+        for table in PARTITIONED_TABLES:
+            if not is_partitioned(cursor, table):
+                if not migrate:
+                    raise RuntimeError(f"'{table}' is not partitioned. Rerun with --migrate to convert it.")
+                partition_existing_table(cursor, table)
+            conn.commit()
+
+        for table in PARTITIONED_TABLES:
+            created = ensure_partitions(cursor, table, days_ahead)
+            conn.commit()
+            if created:
+                print(f"Created {len(created)} partitions for '{table}' ({created[0]} .. {created[-1]}).")
+
+        # Every day still held raw is re-aggregated, so late rows are in the rollup before they expire
+        window_days = predictions_retention_days if predictions_retention_days > 0 else ROLLUP_WINDOW_DAYS
+        rolled = rollup_predictions(cursor, window_days=window_days)
+        conn.commit()
+        print(f"Rolled up {rolled} user-days of predictions into prediction_daily.")
+
+        retention = {'events': events_retention_days, 'predictions': predictions_retention_days}
+        for table, retention_days in retention.items():
+            dropped = drop_expired_partitions(cursor, table, retention_days)
+            conn.commit()
+            if dropped:
+                print(f"Dropped {len(dropped)} expired partitions of '{table}' ({dropped[0]} .. {dropped[-1]}).")
+
+        if rollup_retention_days > 0:
+            cursor.execute("DELETE FROM prediction_daily WHERE day < %s;", (utc_today() - timedelta(days=rollup_retention_days),))
+            conn.commit()
+    print(f"Maintenance finished in {time.monotonic() - started:.1f}s.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Partition upkeep, retention and daily rollups for 'events' and 'predictions'.")
+    parser.add_argument("--days-ahead", type=int, default=PARTITION_DAYS_AHEAD, help="Daily partitions to create in advance.")
+    parser.add_argument("--events-retention-days", type=int, default=EVENTS_RETENTION_DAYS, help="0 keeps events forever.")
+    parser.add_argument("--predictions-retention-days", type=int, default=PREDICTIONS_RETENTION_DAYS,
+                        help="Raw predictions older than this are dropped after being rolled up (0 keeps them).")
+    parser.add_argument("--rollup-retention-days", type=int, default=ROLLUP_RETENTION_DAYS, help="0 keeps daily rollups forever.")
+    parser.add_argument("--migrate", action="store_true", help="Convert existing unpartitioned tables in place.")
+    parser.add_argument("--interval", type=float, default=0,
+                        help="Keep running, one pass every INTERVAL seconds (default: a single pass, e.g. from cron).")
+    args = parser.parse_args()
+
+    while True:
+        conn = get_db_connection()
+        try:
+            run_maintenance(conn, args.days_ahead, args.events_retention_days, args.predictions_retention_days,
+                            args.rollup_retention_days, args.migrate)
+        except Exception as e:
+            conn.rollback()
+            print(f"An error occurred during maintenance: {e}")
+            if not args.interval:
+                raise
+        finally:
+            conn.close()
+        if not args.interval:
+            break
+        time.sleep(args.interval)
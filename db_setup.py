@@ -1,14 +1,165 @@
 import os
+import io
+import csv
+import time
+import argparse
 import pandas as pd
-import psycopg2
 from dotenv import load_dotenv
+from common.db import get_db_connection
+from common.risk_queries import refresh_current_risk_from_predictions
+from common.watchlist import create_watchlist_indexes
+from db_maintenance import (
+    PARTITIONED_TABLES, create_partitioned_table, create_rollup_table, create_table_indexes, ensure_partitions,
+)
 
 load_dotenv()
 
-def setup_database():
+DEFAULT_DATA_PATH = 'ml_model/WA_Fn-UseC_-Telco-Customer-Churn.csv'
+DEFAULT_CHUNK_SIZE = 50000
+
+USERS_COLUMNS = [
+    'customerID', 'gender', 'SeniorCitizen', 'Partner', 'Dependents', 'tenure', 'PhoneService',
+    'MultipleLines', 'InternetService', 'OnlineSecurity', 'OnlineBackup', 'DeviceProtection',
+    'TechSupport', 'StreamingTV', 'StreamingMovies', 'Contract', 'PaperlessBilling',
+    'PaymentMethod', 'MonthlyCharges', 'TotalCharges'
+]
+
+def create_users_table(cursor):
+    cursor.execute("""
+        CREATE TABLE users (
+            customerID VARCHAR(255),
+            gender VARCHAR(10), SeniorCitizen INT, Partner VARCHAR(3), Dependents VARCHAR(3),
+            tenure INT, PhoneService VARCHAR(3), MultipleLines VARCHAR(20),
+            InternetService VARCHAR(20), OnlineSecurity VARCHAR(20), OnlineBackup VARCHAR(20),
+            DeviceProtection VARCHAR(20), TechSupport VARCHAR(20), StreamingTV VARCHAR(20),
+            StreamingMovies VARCHAR(20), Contract VARCHAR(20), PaperlessBilling VARCHAR(3),
+            PaymentMethod VARCHAR(50), MonthlyCharges FLOAT, TotalCharges FLOAT,
+            feature_version BIGINT NOT NULL DEFAULT 0
+        );
+    """)
+
+def create_current_risk_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS current_risk (
+            user_id VARCHAR(255) PRIMARY KEY, churn_probability FLOAT NOT NULL,
+            prediction_timestamp TIMESTAMPTZ NOT NULL, top_features JSONB, contract VARCHAR(20)
+        );
+    """)
+
+def create_tables(cursor):
+    """Drops and recreates all tables. Indexes are left to create_indexes so they are built after the bulk load."""
+    # Drop tables in reverse order of dependency
+    cursor.execute("DROP TABLE IF EXISTS intervention_log, prediction_daily, current_risk, events, predictions, users;")
+
+    create_users_table(cursor)
+    create_current_risk_table(cursor)
+    cursor.execute("""
+        CREATE TABLE intervention_log (
+            log_id SERIAL PRIMARY KEY,
+            customer_id VARCHAR(255) NOT NULL,
+            action_taken TEXT NOT NULL,
+            log_timestamp TIMESTAMPTZ DEFAULT NOW(),
+            agent_id VARCHAR(255) DEFAULT 'System'
+        );
+    """)
+
+    # events and predictions are partitioned by day; db_maintenance.py keeps partitions ahead and applies retention
+    for table in PARTITIONED_TABLES:
+        create_partitioned_table(cursor, table)
+        ensure_partitions(cursor, table)
+    create_rollup_table(cursor)
+
+def create_indexes(cursor):
+    """Creates the keys and indexes the processor and dashboard rely on. Safe to run repeatedly."""
+    cursor.execute("""
+        SELECT 1 FROM information_schema.table_constraints
+        WHERE table_name = 'users' AND constraint_type = 'PRIMARY KEY';
+    """)
+    if cursor.fetchone() is None:
+        print("Adding primary key on users(customerID)...")
+        cursor.execute("ALTER TABLE users ADD PRIMARY KEY (customerID);")
+
+    # Added after the first release; older databases get it here
+    cursor.execute("ALTER TABLE predictions ADD COLUMN IF NOT EXISTS top_features JSONB;")
+    # Incremented by every simulator UPDATE and sent with its event, for the processor's feature cache
+    cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS feature_version BIGINT NOT NULL DEFAULT 0;")
+    # The processor writes events' compact payload here; event_data only holds rows written before it
+    cursor.execute("ALTER TABLE events ADD COLUMN IF NOT EXISTS payload BYTEA;")
+
+    # current_risk holds each customer's latest score; the processor upserts it alongside 'predictions'
+    create_current_risk_table(cursor)
+    # Added after the first release; older rows take the contract from 'users'
+    cursor.execute("ALTER TABLE current_risk ADD COLUMN IF NOT EXISTS contract VARCHAR(20);")
+    cursor.execute("""
+        UPDATE current_risk cr SET contract = u.Contract
+        FROM users u WHERE u.customerID = cr.user_id AND cr.contract IS NULL;
+    """)
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM current_risk);")
+    if not cursor.fetchone()[0]:
+        seeded = refresh_current_risk_from_predictions(cursor)
+        if seeded:
+            print(f"Seeded current_risk with the latest score of {seeded} customers.")
+
+    print("Creating indexes on predictions, events, users, current_risk and intervention_log...")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_intervention_log_customer ON intervention_log (customer_id, log_timestamp DESC);")
+    create_watchlist_indexes(cursor)
+    for table in PARTITIONED_TABLES:
+        create_table_indexes(cursor, table)
+    cursor.execute("ANALYZE users;")
+    cursor.execute("ANALYZE current_risk;")
+
+def open_csv_after(data_path, skip_rows):
+    """Opens the CSV positioned just past its first skip_rows data rows. Returns (file, header columns)."""
+    f = open(data_path, 'r', newline='')
+    header = next(csv.reader([f.readline()]))
+    for _ in range(skip_rows):
+        if not f.readline():
+            break
+    return f, header
+
+def load_users_copy(conn, data_path, chunk_size=DEFAULT_CHUNK_SIZE, resume=False):
+    """
+    Streams the CSV into 'users' through COPY FROM STDIN, one chunk per transaction, so memory
+    stays bounded by chunk_size. With resume=True, rows already in the table are skipped,
+    which continues an interrupted load from the last committed chunk.
+    """
+    with conn.cursor() as cursor:
+        skip_rows = 0
+        if resume:
+            cursor.execute("SELECT COUNT(*) FROM users;")
+            skip_rows = cursor.fetchone()[0]
+            if skip_rows:
+                print(f"Resuming load: {skip_rows} rows already in 'users', skipping them.")
+
+        f, header = open_csv_after(data_path, skip_rows)
+        copy_sql = f"COPY users ({', '.join(USERS_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+        loaded = 0
+        started = time.monotonic()
+        try:
+            for chunk in pd.read_csv(f, names=header, header=None, chunksize=chunk_size, dtype={'customerID': str}):
+                chunk['TotalCharges'] = pd.to_numeric(chunk['TotalCharges'], errors='coerce').fillna(0.0)
+                buffer = io.StringIO()
+                chunk[USERS_COLUMNS].to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+                cursor.copy_expert(copy_sql, buffer)
+                conn.commit()
+
+                loaded += len(chunk)
+                elapsed = time.monotonic() - started
+                print(f"  {skip_rows + loaded} rows loaded ({loaded / elapsed:,.0f} rows/sec)")
+        finally:
+            f.close()
+
+    elapsed = time.monotonic() - started
+    rate = loaded / elapsed if elapsed > 0 else 0.0
+    print(f"Loaded {loaded} rows into 'users' in {elapsed:.1f}s ({rate:,.0f} rows/sec).")
+    return loaded
+
+def setup_database(data_path=DEFAULT_DATA_PATH, chunk_size=DEFAULT_CHUNK_SIZE, resume=False):
     """
     Connects to the Supabase PostgreSQL database, creates/recreates all tables,
-    and populates the 'users' table from the Kaggle dataset.
+    and populates the 'users' table from the Kaggle dataset (or a larger synthetic CSV
+    with the same columns). With resume=True the tables are kept and the load continues.
     """
     POSTGRES_URI = os.getenv("POSTGRES_URI")
     if not POSTGRES_URI:
@@ -17,60 +168,25 @@ def setup_database():
     conn = None
     try:
         print("Connecting to the Supabase database...")
-        conn = psycopg2.connect(POSTGRES_URI)
+        conn = get_db_connection(POSTGRES_URI)
         cursor = conn.cursor()
         print("Connection successful.")
 
-        print("Creating tables: users, events, predictions, and intervention_log...")
-        # Drop tables in reverse order of dependency
-        cursor.execute("DROP TABLE IF EXISTS intervention_log, events, predictions, users;")
-
-        cursor.execute("""
-            CREATE TABLE users (
-                customerID VARCHAR(255) PRIMARY KEY,
-                gender VARCHAR(10), SeniorCitizen INT, Partner VARCHAR(3), Dependents VARCHAR(3),
-                tenure INT, PhoneService VARCHAR(3), MultipleLines VARCHAR(20),
-                InternetService VARCHAR(20), OnlineSecurity VARCHAR(20), OnlineBackup VARCHAR(20),
-                DeviceProtection VARCHAR(20), TechSupport VARCHAR(20), StreamingTV VARCHAR(20),
-                StreamingMovies VARCHAR(20), Contract VARCHAR(20), PaperlessBilling VARCHAR(3),
-                PaymentMethod VARCHAR(50), MonthlyCharges FLOAT, TotalCharges FLOAT
-            );
-
-            CREATE TABLE events (
-                event_id SERIAL PRIMARY KEY, user_id VARCHAR(255), event_type VARCHAR(255),
-                event_timestamp TIMESTAMPTZ, event_data JSONB
-            );
-
-            CREATE TABLE predictions (
-                prediction_id SERIAL PRIMARY KEY, user_id VARCHAR(255),
-                churn_probability FLOAT, prediction_timestamp TIMESTAMPTZ
-            );
-
-            CREATE TABLE intervention_log (
-                log_id SERIAL PRIMARY KEY,
-                customer_id VARCHAR(255) NOT NULL,
-                action_taken TEXT NOT NULL,
-                log_timestamp TIMESTAMPTZ DEFAULT NOW(),
-                agent_id VARCHAR(255) DEFAULT 'System'
-            );
-        """)
-        conn.commit()
-        print("Tables created successfully.")
-
-        print("Populating 'users' table...")
-        data_path = 'ml_model/WA_Fn-UseC_-Telco-Customer-Churn.csv'
-        df = pd.read_csv(data_path)
-        
-        df['TotalCharges'] = pd.to_numeric(df['TotalCharges'], errors='coerce').fillna(0.0)
-        df_cleaned = df.drop('Churn', axis=1)
-
-        values = [cursor.mogrify("(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)", tuple(row)).decode('utf-8') for index, row in df_cleaned.iterrows()]
-        
-        cursor.execute("INSERT INTO users VALUES " + ",".join(values))
-        
+        if not resume:
+            print("Creating tables: users, events, predictions, current_risk and intervention_log...")
+            create_tables(cursor)
+            conn.commit()
+            print("Tables created successfully.")
+
+        print(f"Populating 'users' table from {data_path}...")
+        load_users_copy(conn, data_path, chunk_size, resume)
+
+        create_indexes(cursor)
         conn.commit()
-        print(f"Successfully inserted {len(df)} records into the 'users' table.")
+        print("Indexes created successfully.")
 
+    except KeyboardInterrupt:
+        print("\nLoad interrupted. Committed chunks are kept; rerun with --resume to continue.")
     except Exception as e:
         print(f"An error occurred: {e}")
     finally:
@@ -78,5 +194,9 @@ def setup_database():
             conn.close()
 
 if __name__ == "__main__":
-    setup_database()
-
+    parser = argparse.ArgumentParser(description="Create the database schema and load the users table.")
+    parser.add_argument("--data-path", default=DEFAULT_DATA_PATH, help="CSV with the Telco customer columns.")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Rows per COPY transaction.")
+    parser.add_argument("--resume", action="store_true", help="Keep existing tables and continue an interrupted load.")
+    args = parser.parse_args()
+    setup_database(args.data_path, args.chunk_size, args.resume)
@@ -1,20 +1,56 @@
 import os
+import sys
 import json
+import argparse
 import random
 import time
-from kafka import KafkaProducer
+from collections import defaultdict
 from dotenv import load_dotenv
-import psycopg2
-from psycopg2.extras import RealDictCursor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.db import Database, execute_prepared, register_statements
+from common.transport import create_producer
 
 # Load environment variables from the root .env file
 load_dotenv(dotenv_path='../.env')
 
-def get_db_connection():
-    """Establishes a connection to the Supabase PostgreSQL database."""
-    POSTGRES_URI = os.getenv("POSTGRES_URI")
-    if not POSTGRES_URI: raise ValueError("POSTGRES_URI not found.")
-    return psycopg2.connect(POSTGRES_URI)
+register_statements({
+    'contract_downgrade': "UPDATE users SET Contract = 'Month-to-month', feature_version = feature_version + 1 WHERE customerID = %s AND Contract != 'Month-to-month' RETURNING feature_version",
+    'service_removal': "UPDATE users SET OnlineSecurity = 'No', MonthlyCharges = MonthlyCharges - 5, feature_version = feature_version + 1 WHERE customerID = %s AND OnlineSecurity = 'Yes' RETURNING feature_version",
+    'cancel_autopay': "UPDATE users SET PaymentMethod = 'Mailed check', feature_version = feature_version + 1 WHERE customerID = %s AND PaymentMethod LIKE '%%(automatic)%%' RETURNING feature_version",
+    'contract_upgrade': "UPDATE users SET Contract = 'One year', feature_version = feature_version + 1 WHERE customerID = %s AND Contract = 'Month-to-month' RETURNING feature_version",
+    'add_service': "UPDATE users SET TechSupport = 'Yes', MonthlyCharges = MonthlyCharges + 5, feature_version = feature_version + 1 WHERE customerID = %s AND TechSupport = 'No' RETURNING feature_version",
+    'enable_autopay': "UPDATE users SET PaymentMethod = 'Credit card (automatic)', feature_version = feature_version + 1 WHERE customerID = %s AND PaymentMethod NOT LIKE '%%(automatic)%%' RETURNING feature_version",
+    'tenure_increase': "UPDATE users SET tenure = tenure + 1, TotalCharges = TotalCharges + MonthlyCharges, feature_version = feature_version + 1 WHERE customerID = %s RETURNING feature_version",
+    # Batched forms of the statements above, used by the load generator
+    'contract_downgrade_many': "UPDATE users SET Contract = 'Month-to-month', feature_version = feature_version + 1 WHERE customerID = ANY(%s) AND Contract != 'Month-to-month' RETURNING customerID, feature_version",
+    'service_removal_many': "UPDATE users SET OnlineSecurity = 'No', MonthlyCharges = MonthlyCharges - 5, feature_version = feature_version + 1 WHERE customerID = ANY(%s) AND OnlineSecurity = 'Yes' RETURNING customerID, feature_version",
+    'cancel_autopay_many': "UPDATE users SET PaymentMethod = 'Mailed check', feature_version = feature_version + 1 WHERE customerID = ANY(%s) AND PaymentMethod LIKE '%%(automatic)%%' RETURNING customerID, feature_version",
+    'contract_upgrade_many': "UPDATE users SET Contract = 'One year', feature_version = feature_version + 1 WHERE customerID = ANY(%s) AND Contract = 'Month-to-month' RETURNING customerID, feature_version",
+    'add_service_many': "UPDATE users SET TechSupport = 'Yes', MonthlyCharges = MonthlyCharges + 5, feature_version = feature_version + 1 WHERE customerID = ANY(%s) AND TechSupport = 'No' RETURNING customerID, feature_version",
+    'enable_autopay_many': "UPDATE users SET PaymentMethod = 'Credit card (automatic)', feature_version = feature_version + 1 WHERE customerID = ANY(%s) AND PaymentMethod NOT LIKE '%%(automatic)%%' RETURNING customerID, feature_version",
+    'tenure_increase_many': "UPDATE users SET tenure = tenure + 1, TotalCharges = TotalCharges + MonthlyCharges, feature_version = feature_version + 1 WHERE customerID = ANY(%s) RETURNING customerID, feature_version",
+})
+
+# Event types in the order of simulate_event's handlers
+EVENT_TYPES = [
+    'contract_downgrade', 'removed_online_security', 'cancelled_autopay',
+    'contract_upgrade', 'added_tech_support', 'enabled_autopay',
+    'monthly_anniversary',
+]
+# Adjust weights to make negative events more common for demonstration
+EVENT_WEIGHTS = [0.25, 0.20, 0.15, 0.10, 0.10, 0.10, 0.10]
+
+# event_type -> (batched UPDATE statement, details), matching the _handle_* functions
+BATCH_EVENT_UPDATES = {
+    'contract_downgrade': ('contract_downgrade_many', 'Switched to Month-to-month'),
+    'removed_online_security': ('service_removal_many', 'Cancelled Online Security'),
+    'cancelled_autopay': ('cancel_autopay_many', 'Switched to Mailed check'),
+    'contract_upgrade': ('contract_upgrade_many', 'Upgraded to One year contract'),
+    'added_tech_support': ('add_service_many', 'Subscribed to Tech Support'),
+    'enabled_autopay': ('enable_autopay_many', 'Switched to Credit card (automatic)'),
+    'monthly_anniversary': ('tenure_increase_many', 'Tenure increased by 1 month'),
+}
 
 def get_user_ids_from_db(conn):
     """Fetches a list of valid customer IDs from the database."""
@@ -25,26 +61,11 @@ def get_user_ids_from_db(conn):
     print(f"Found {len(user_ids)} users.")
     return user_ids
 
-def create_kafka_producer(service_uri):
-    """Creates a Kafka producer for Aiven."""
-    print("Connecting to Aiven Kafka...")
-    while True:
-        try:
-            producer = KafkaProducer(
-                bootstrap_servers=service_uri,
-                security_protocol="SSL", ssl_cafile="../ca.pem",
-                ssl_certfile="../service.cert", ssl_keyfile="../service.key",
-                value_serializer=lambda v: json.dumps(v).encode('utf-8'),
-                request_timeout_ms=120000
-            )
-            print("Event simulator connected to Aiven Kafka!")
-            return producer
-        except Exception as e:
-            print(f"Failed to connect to Aiven Kafka: {e}. Retrying...")
-            time.sleep(5)
-
 def simulate_event(conn, user_id):
-    """Selects a random event, applies the change to the database, and returns the event details."""
+    """
+    Selects a random event, applies the change to the database, and returns the event details.
+    The caller owns the transaction.
+    """
     event_handlers = [
         # Churn-increasing events (higher probability)
         _handle_contract_downgrade,
@@ -57,125 +78,281 @@ def simulate_event(conn, user_id):
         # Neutral event
         _handle_tenure_increase,
     ]
-    # Adjust weights to make negative events more common for demonstration
-    weights = [0.25, 0.20, 0.15, 0.10, 0.10, 0.10, 0.10]
-    
-    handler = random.choices(event_handlers, weights=weights, k=1)[0]
+    handler = random.choices(event_handlers, weights=EVENT_WEIGHTS, k=1)[0]
     return handler(conn, user_id)
 
+def _applied_event(cursor, event):
+    """
+    Returns the event if its UPDATE changed the user's row, with the row's new feature_version so
+    the processor's feature cache can tell which changes it has already seen. None otherwise.
+    """
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    event['feature_version'] = row[0]
+    return event
+
 # --- CHURN-INCREASING EVENT HANDLERS ---
 
 def _handle_contract_downgrade(conn, user_id):
     """Simulates a user downgrading from a yearly to a month-to-month contract."""
-    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("UPDATE users SET Contract = 'Month-to-month' WHERE customerID = %s AND Contract != 'Month-to-month';", (user_id,))
-        if cursor.rowcount > 0:
-            conn.commit()
-            return {'event_type': 'contract_downgrade', 'user_id': user_id, 'details': 'Switched to Month-to-month'}
-    return None
+    with conn.cursor() as cursor:
+        execute_prepared(cursor, 'contract_downgrade', (user_id,))
+        return _applied_event(cursor, {'event_type': 'contract_downgrade', 'user_id': user_id, 'details': 'Switched to Month-to-month'})
 
 def _handle_service_removal(conn, user_id):
     """Simulates a user removing a service like OnlineSecurity."""
-    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("UPDATE users SET OnlineSecurity = 'No', MonthlyCharges = MonthlyCharges - 5 WHERE customerID = %s AND OnlineSecurity = 'Yes';", (user_id,))
-        if cursor.rowcount > 0:
-            conn.commit()
-            return {'event_type': 'removed_online_security', 'user_id': user_id, 'details': 'Cancelled Online Security'}
-    return None
+    with conn.cursor() as cursor:
+        execute_prepared(cursor, 'service_removal', (user_id,))
+        return _applied_event(cursor, {'event_type': 'removed_online_security', 'user_id': user_id, 'details': 'Cancelled Online Security'})
 
 def _handle_cancel_autopay(conn, user_id):
     """Simulates a user cancelling automatic payments."""
-    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("UPDATE users SET PaymentMethod = 'Mailed check' WHERE customerID = %s AND PaymentMethod LIKE '%%(automatic)%%';", (user_id,))
-        if cursor.rowcount > 0:
-            conn.commit()
-            return {'event_type': 'cancelled_autopay', 'user_id': user_id, 'details': 'Switched to Mailed check'}
-    return None
+    with conn.cursor() as cursor:
+        execute_prepared(cursor, 'cancel_autopay', (user_id,))
+        return _applied_event(cursor, {'event_type': 'cancelled_autopay', 'user_id': user_id, 'details': 'Switched to Mailed check'})
 
 # --- CHURN-DECREASING EVENT HANDLERS (NEW) ---
 
 def _handle_contract_upgrade(conn, user_id):
     """Simulates a user upgrading from a monthly to a one-year contract."""
-    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("UPDATE users SET Contract = 'One year' WHERE customerID = %s AND Contract = 'Month-to-month';", (user_id,))
-        if cursor.rowcount > 0:
-            conn.commit()
-            return {'event_type': 'contract_upgrade', 'user_id': user_id, 'details': 'Upgraded to One year contract'}
-    return None
+    with conn.cursor() as cursor:
+        execute_prepared(cursor, 'contract_upgrade', (user_id,))
+        return _applied_event(cursor, {'event_type': 'contract_upgrade', 'user_id': user_id, 'details': 'Upgraded to One year contract'})
 
 def _handle_add_service(conn, user_id):
     """Simulates a user adding a service like TechSupport."""
-    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("UPDATE users SET TechSupport = 'Yes', MonthlyCharges = MonthlyCharges + 5 WHERE customerID = %s AND TechSupport = 'No';", (user_id,))
-        if cursor.rowcount > 0:
-            conn.commit()
-            return {'event_type': 'added_tech_support', 'user_id': user_id, 'details': 'Subscribed to Tech Support'}
-    return None
+    with conn.cursor() as cursor:
+        execute_prepared(cursor, 'add_service', (user_id,))
+        return _applied_event(cursor, {'event_type': 'added_tech_support', 'user_id': user_id, 'details': 'Subscribed to Tech Support'})
 
 def _handle_enable_autopay(conn, user_id):
     """Simulates a user enabling automatic payments."""
-    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("UPDATE users SET PaymentMethod = 'Credit card (automatic)' WHERE customerID = %s AND PaymentMethod NOT LIKE '%%(automatic)%%';", (user_id,))
-        if cursor.rowcount > 0:
-            conn.commit()
-            return {'event_type': 'enabled_autopay', 'user_id': user_id, 'details': 'Switched to Credit card (automatic)'}
-    return None
+    with conn.cursor() as cursor:
+        execute_prepared(cursor, 'enable_autopay', (user_id,))
+        return _applied_event(cursor, {'event_type': 'enabled_autopay', 'user_id': user_id, 'details': 'Switched to Credit card (automatic)'})
 
 # --- NEUTRAL EVENT HANDLER ---
 
 def _handle_tenure_increase(conn, user_id):
     """Simulates a monthly anniversary for a user."""
-    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("UPDATE users SET tenure = tenure + 1, TotalCharges = TotalCharges + MonthlyCharges WHERE customerID = %s;", (user_id,))
-        conn.commit()
-        return {'event_type': 'monthly_anniversary', 'user_id': user_id, 'details': 'Tenure increased by 1 month'}
-    return None
+    with conn.cursor() as cursor:
+        execute_prepared(cursor, 'tenure_increase', (user_id,))
+        return _applied_event(cursor, {'event_type': 'monthly_anniversary', 'user_id': user_id, 'details': 'Tenure increased by 1 month'})
 
-def run_simulator(producer, topic_name, user_ids):
+def run_simulator(producer, topic_name, user_ids, db):
     """The main simulation loop."""
-    db_conn = get_db_connection()
-    if not db_conn:
-        raise Exception("Simulator could not connect to database.")
-        
     print("Starting advanced event simulation...")
     while True:
         try:
             user_id = random.choice(user_ids)
-            event = simulate_event(db_conn, user_id)
+            # db.run commits the UPDATE and retries on a fresh connection if the current one drops
+            event = db.run(simulate_event, user_id)
             
             if event:
                 event['timestamp'] = time.time()
                 print(f"SIMULATOR: Generating event -> {event}")
-                producer.send(topic_name, value=event)
+                # Keyed by user so all of a customer's events land on one partition, in order
+                producer.send(topic_name, value=event, key=user_id)
                 producer.flush()
                 
-        except (psycopg2.InterfaceError, psycopg2.OperationalError) as e:
-            print(f"Database connection lost: {e}. Reconnecting...")
-            if db_conn: db_conn.close()
-            db_conn = get_db_connection()
         except Exception as e:
             print(f"An error occurred in the simulation loop: {e}")
 
         time.sleep(random.uniform(3, 7)) # Simulate events every 3-7 seconds
 
+# --- LOAD GENERATOR ---
+
+def simulate_events_batch(conn, picks):
+    """
+    Applies a batch of (user_id, event_type) picks with one UPDATE ... WHERE customerID = ANY(...)
+    per event type, and returns the resulting events in the order they were applied.
+    A user picked more than once goes into successive waves, so each of their picks sees the
+    effect of the one before, as it would in the one-event-at-a-time loop. The caller owns the transaction.
+    """
+    waves = []
+    picks_so_far = defaultdict(int)
+    for user_id, event_type in picks:
+        wave = picks_so_far[user_id]
+        picks_so_far[user_id] += 1
+        if wave == len(waves):
+            waves.append(defaultdict(list))
+        waves[wave][event_type].append(user_id)
+
+    events = []
+    with conn.cursor() as cursor:
+        for wave in waves:
+            for event_type in EVENT_TYPES:
+                user_ids = wave.get(event_type)
+                if not user_ids:
+                    continue
+                statement, details = BATCH_EVENT_UPDATES[event_type]
+                execute_prepared(cursor, statement, (user_ids,))
+                for user_id, feature_version in cursor.fetchall():
+                    events.append({'event_type': event_type, 'user_id': user_id, 'details': details,
+                                   'feature_version': feature_version})
+    return events
+
+def zipf_sampler(user_ids, s, rng):
+    """
+    Returns a function k -> k user IDs drawn with Zipf(s) skew: the user at rank r is picked with
+    weight 1 / r**s over a shuffled ranking, so a few hot customers get most of the events. s=0 is uniform.
+    """
+    ranked = list(user_ids)
+    rng.shuffle(ranked)
+    if s <= 0:
+        return lambda k: rng.choices(ranked, k=k)
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, len(ranked) + 1):
+        total += 1.0 / rank ** s
+        cum_weights.append(total)
+    return lambda k: rng.choices(ranked, cum_weights=cum_weights, k=k)
+
+def parse_mix(spec):
+    """Parses 'contract_downgrade=0.5,monthly_anniversary=0.5' into {event_type: weight}."""
+    mix = {}
+    for part in filter(None, spec.split(',')):
+        event_type, weight = part.split('=')
+        if event_type not in BATCH_EVENT_UPDATES:
+            raise ValueError(f"Unknown event type '{event_type}'. Choose from: {', '.join(EVENT_TYPES)}")
+        mix[event_type] = float(weight)
+    return mix
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+def _latency_summary(values):
+    """Returns p50/p95/p99/max of a list of latencies in seconds, in milliseconds."""
+    values = sorted(values)
+    return {
+        "p50": round(_percentile(values, 0.50) * 1000, 2),
+        "p95": round(_percentile(values, 0.95) * 1000, 2),
+        "p99": round(_percentile(values, 0.99) * 1000, 2),
+        "max": round(values[-1] * 1000, 2) if values else 0.0,
+    }
+
+def run_load_generator(producer, topic_name, user_ids, db, rate, duration=None, batch_size=500,
+                       zipf_s=1.1, mix=None, report_interval=5.0, seed=None):
+    """
+    Open-loop load generator: events are scheduled at a fixed target rate regardless of how
+    long the database and producer take, and applied and sent in batches (one transaction and
+    one producer flush per batch). If it falls behind, it catches up with back-to-back batches,
+    and the lateness shows up in the schedule latency instead of silently lowering the rate.
+
+    Reports the achieved rate, schedule latency (scheduled time -> producer ack) and producer
+    latency (send -> ack) percentiles in milliseconds. Picks in batches whose transaction failed
+    are counted as failed and left out of the achieved rate. Returns the final report.
+    """
+    rng = random.Random(seed)
+    pick_users = zipf_sampler(user_ids, zipf_s, rng)
+    weights = dict(zip(EVENT_TYPES, EVENT_WEIGHTS))
+    weights.update(mix or {})
+    event_types = [event_type for event_type in EVENT_TYPES if weights.get(event_type, 0) > 0]
+    type_weights = [weights[event_type] for event_type in event_types]
+
+    print(f"Starting load generator: {rate} events/s target, batch size {batch_size}, Zipf s={zipf_s}, "
+          f"mix={dict(zip(event_types, type_weights))}")
+    interval = 1.0 / rate
+    started = time.monotonic()
+    scheduled = 0
+    failed = 0
+    sent = 0
+    schedule_latencies = []
+    producer_latencies = []
+    last_report, last_sent = started, 0
+
+    try:
+        while duration is None or time.monotonic() - started < duration:
+            now = time.monotonic()
+            due = int((now - started) * rate) - scheduled
+            if due <= 0:
+                time.sleep(started + (scheduled + 1) * interval - now)
+                continue
+
+            count = min(due, batch_size)
+            first_scheduled_at = started + scheduled * interval
+            scheduled += count
+            picks = list(zip(pick_users(count), rng.choices(event_types, weights=type_weights, k=count)))
+            try:
+                # One transaction for the whole batch; picks whose precondition doesn't hold produce no event
+                events = db.run(simulate_events_batch, picks)
+            except Exception as e:
+                # The schedule moves on regardless (open loop); these picks just never happened
+                failed += count
+                print(f"An error occurred in the load generator: {e}")
+                continue
+
+            committed_at = time.time()
+            send_times = []
+            for i, event in enumerate(events):
+                # Strictly increasing, so consumers can tell a user's events in the same batch apart
+                event['timestamp'] = committed_at + i * 1e-6
+                send_times.append(time.monotonic())
+                producer.send(topic_name, value=event, key=event['user_id'])
+            producer.flush()
+            acked = time.monotonic()
+
+            sent += len(events)
+            producer_latencies.extend(acked - send_time for send_time in send_times)
+            schedule_latencies.extend(acked - (first_scheduled_at + i * interval) for i in range(count))
+
+            if acked - last_report >= report_interval:
+                print(f"LOADGEN: {(sent - last_sent) / (acked - last_report):,.0f} events/s sent, "
+                      f"{len(picks)} picks in last batch, backlog {max(0, int((acked - started) * rate) - scheduled)} events")
+                last_report, last_sent = acked, sent
+    except KeyboardInterrupt:
+        print("\nLoad generator stopping.")
+
+    elapsed = time.monotonic() - started
+    report = {
+        "target_rate": rate,
+        "elapsed_s": round(elapsed, 2),
+        "scheduled": scheduled,
+        "failed": failed,
+        "sent": sent,
+        "achieved_schedule_rate": round((scheduled - failed) / elapsed, 1),
+        "achieved_send_rate": round(sent / elapsed, 1),
+        "schedule_latency_ms": _latency_summary(schedule_latencies),
+        "producer_latency_ms": _latency_summary(producer_latencies),
+    }
+    print(f"LOADGEN: Final report: {json.dumps(report)}")
+    return report
+
 if __name__ == "__main__":
-    AIVEN_SERVICE_URI = os.getenv("AIVEN_SERVICE_URI")
+    parser = argparse.ArgumentParser(description="Simulates customer events (demo pace by default, or as a load generator).")
+    parser.add_argument("--mode", choices=["demo", "load"], default="demo",
+                        help="demo: one event every 3-7s. load: batched events at --rate events/s.")
+    parser.add_argument("--rate", type=float, default=1000.0, help="Target events per second in load mode.")
+    parser.add_argument("--duration", type=float, default=None, help="Seconds to run in load mode (default: until Ctrl+C).")
+    parser.add_argument("--batch-size", type=int, default=500, help="Max events per database transaction and producer flush.")
+    parser.add_argument("--zipf-s", type=float, default=1.1, help="Hot-key skew over user IDs (0 = uniform).")
+    parser.add_argument("--mix", default="", help="Event weight overrides, e.g. 'contract_downgrade=0.5,monthly_anniversary=0.5'.")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducible load.")
+    args = parser.parse_args()
+
     KAFKA_TOPIC = "user_events_topic"
     
-    conn = get_db_connection()
-    if not conn: raise Exception("Initial database connection failed.")
-    
-    valid_user_ids = get_user_ids_from_db(conn)
-    conn.close() # Close connection after getting IDs
+    db = Database(maxconn=2)
+    with db.connection() as conn:
+        valid_user_ids = get_user_ids_from_db(conn)
 
     if not valid_user_ids:
         raise Exception("No user IDs found. Run db_setup.py first.")
         
-    kafka_producer = create_kafka_producer(AIVEN_SERVICE_URI)
+    kafka_producer = create_producer()
     
     try:
-        run_simulator(kafka_producer, KAFKA_TOPIC, valid_user_ids)
+        if args.mode == "load":
+            run_load_generator(kafka_producer, KAFKA_TOPIC, valid_user_ids, db, args.rate, args.duration,
+                               args.batch_size, args.zipf_s, parse_mix(args.mix), seed=args.seed)
+        else:
+            run_simulator(kafka_producer, KAFKA_TOPIC, valid_user_ids, db)
     except KeyboardInterrupt:
         print("\nSimulator shutting down.")
+    finally:
+        db.close()
 
 
@@ -0,0 +1,71 @@
+import os
+import csv
+import time
+import argparse
+import numpy as np
+from dotenv import load_dotenv
+from common.db import get_db_connection
+from common.interventions import INTERVENTIONS, rank_high_risk, summarize_ranking
+from common.risk_queries import HIGH_THRESHOLD
+from common.scorer import ChurnScorer
+
+# Load environment variables from the .env file in the root directory
+load_dotenv()
+
+MODEL_PATH = 'ml_model/churn_model_xgb.pkl'
+DEFAULT_OUTPUT_PATH = 'intervention_ranking.csv'
+
+def write_ranking(ranking, output_path):
+    """Writes one row per customer, the largest risk reduction first."""
+    order = np.argsort(-ranking['risk_reduction'], kind='stable')
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['customer_id', 'churn_probability', 'best_action', 'churn_probability_after', 'risk_reduction'])
+        for i in order.tolist():
+            probability = float(ranking['churn_probability'][i])
+            reduction = float(ranking['risk_reduction'][i])
+            writer.writerow([
+                ranking['customer_id'][i], f"{probability:.4f}", ranking['best_action'][i] or '',
+                f"{probability - reduction:.4f}", f"{reduction:.4f}",
+            ])
+
+def print_summary(ranking, elapsed):
+    summary = summarize_ranking(ranking, top=0)
+    customers = summary['customers']
+    print(f"Ranked interventions for {customers:,} customers in {elapsed:.2f}s "
+          f"({customers / max(elapsed, 1e-9):,.0f} customers/sec).")
+    for stage, seconds in ranking['timings'].items():
+        print(f"  {stage:>5}: {seconds:8.2f}s")
+    for entry in summary['by_action'].values():
+        print(f"  {entry['label']:<28} {entry['customers']:>9,} customers  mean reduction {entry['mean_risk_reduction']:.3f}")
+    print(f"  {'No action lowers the score':<28} {summary['no_helpful_action']:>9,} customers")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rank the best retention action for every high-risk customer.")
+    parser.add_argument("--min-risk", type=float, default=HIGH_THRESHOLD,
+                        help="Rank customers whose current churn probability is above this (default: the alert threshold).")
+    parser.add_argument("--actions", default=",".join(INTERVENTIONS),
+                        help=f"Comma-separated subset of: {', '.join(INTERVENTIONS)}.")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="Customers read and scored per model call.")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_PATH, help="CSV file to write the ranking to.")
+    args = parser.parse_args()
+
+    actions = [action for action in args.actions.split(',') if action]
+    unknown = [action for action in actions if action not in INTERVENTIONS]
+    if unknown:
+        parser.error(f"Unknown actions: {', '.join(unknown)}")
+
+    scorer = ChurnScorer(MODEL_PATH)
+    conn = get_db_connection()
+    if not conn:
+        raise Exception("Could not connect to the database.")
+    try:
+        started = time.monotonic()
+        ranking = rank_high_risk(conn, scorer, args.min_risk, actions, args.chunk_size)
+        elapsed = time.monotonic() - started
+    finally:
+        conn.close()
+
+    print_summary(ranking, elapsed)
+    write_ranking(ranking, args.output)
+    print(f"Ranking written to {os.path.abspath(args.output)}")
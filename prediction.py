@@ -1,25 +1,25 @@
 import os
+import io
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-import joblib
-import psycopg2
 from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 from datetime import datetime
+from common.db import get_db_connection
+from common.risk_queries import refresh_current_risk_from_predictions
+from common.scorer import ChurnScorer
 
 # Load environment variables from the .env file in the root directory
 load_dotenv()
 
-def get_db_connection():
-    """Establishes a connection to the Supabase PostgreSQL database."""
-    POSTGRES_URI = os.getenv("POSTGRES_URI")
-    if not POSTGRES_URI:
-        raise ValueError("POSTGRES_URI not found in .env file.")
-    try:
-        conn = psycopg2.connect(POSTGRES_URI)
-        return conn
-    except Exception as e:
-        print(f"Database connection error: {e}")
-        return None
+MODEL_PATH = 'ml_model/churn_model_xgb.pkl'
+DEFAULT_CHUNK_SIZE = 50000
+
+# Each backfill worker process loads its own copy of the model once
+_worker_scorer = None
 
 def backfill_initial_predictions():
     """
@@ -29,12 +29,11 @@ def backfill_initial_predictions():
     """
     print("Starting initial predictions backfill process...")
 
-    MODEL_PATH = 'ml_model/churn_model_xgb.pkl'
     DATA_PATH = 'ml_model/WA_Fn-UseC_-Telco-Customer-Churn.csv'
 
     # 1. Load the trained model
     try:
-        model = joblib.load(MODEL_PATH)
+        scorer = ChurnScorer(MODEL_PATH)
         print("Successfully loaded XGBoost model.")
     except FileNotFoundError:
         raise Exception(f"Model file not found at {MODEL_PATH}. Please run train_model.py first.")
@@ -51,8 +50,7 @@ def backfill_initial_predictions():
 
     # 3. Calculate churn probabilities for the entire dataset
     print("Calculating initial churn probabilities for all users...")
-    # The second column [:, 1] is the probability of the "positive" class (Churn='Yes')
-    probabilities = model.predict_proba(X.drop('customerID', axis=1))[:, 1]
+    probabilities = scorer.score_columns(X)
     
     # 4. Prepare data for database insertion
     customer_ids = X['customerID'].tolist()
@@ -79,6 +77,7 @@ def backfill_initial_predictions():
                 "INSERT INTO predictions (user_id, churn_probability, prediction_timestamp) VALUES %s",
                 predictions_data
             )
+            refresh_current_risk_from_predictions(cursor, since=timestamp)
             conn.commit()
             print(f"Successfully inserted {len(predictions_data)} initial predictions.")
     except Exception as e:
@@ -88,7 +87,108 @@ def backfill_initial_predictions():
             conn.close()
             print("Database connection closed.")
 
+def _init_backfill_worker(model_path):
+    """Process-pool initializer: loads the scorer once per worker, single-threaded so workers don't oversubscribe cores."""
+    global _worker_scorer
+    _worker_scorer = ChurnScorer(model_path, nthread=1)
+
+def _score_users_chunk(rows):
+    """Scores a chunk of 'users' rows (customerID first, then the model's input columns). Returns (ids, probabilities, seconds)."""
+    started = time.perf_counter()
+    columns = list(zip(*rows))
+    customer_ids = columns[0]
+    features = dict(zip(_worker_scorer.input_columns, columns[1:]))
+    probabilities = _worker_scorer.score_columns(features)
+    return customer_ids, probabilities, time.perf_counter() - started
+
+def copy_predictions_to_db(cursor, customer_ids, probabilities, timestamp):
+    """Streams one chunk of predictions into the 'predictions' table with COPY."""
+    ts = timestamp.isoformat()
+    buffer = io.StringIO()
+    buffer.writelines(f"{customer_id}\t{probability!r}\t{ts}\n" for customer_id, probability in zip(customer_ids, probabilities.tolist()))
+    buffer.seek(0)
+    cursor.copy_expert("COPY predictions (user_id, churn_probability, prediction_timestamp) FROM STDIN", buffer)
+
+def backfill_from_users_table(chunk_size=DEFAULT_CHUNK_SIZE, workers=None, model_path=MODEL_PATH):
+    """
+    Scores every customer in the live 'users' table and writes the results to 'predictions'.
+
+    Rows are read with a server-side cursor in fixed-size chunks, scored across a process pool
+    and streamed back through COPY, with at most two chunks per worker in flight so memory
+    stays flat regardless of table size. Prints per-stage throughput for read, score and write.
+    """
+    workers = workers or os.cpu_count() or 1
+    print(f"Starting users-table backfill (chunk_size={chunk_size}, workers={workers})...")
+
+    read_conn = get_db_connection()
+    write_conn = get_db_connection()
+    if not read_conn or not write_conn:
+        raise Exception("Could not connect to the database.")
+
+    input_columns = ChurnScorer(model_path).input_columns
+    timestamp = datetime.now()
+    stage_seconds = {'read': 0.0, 'score': 0.0, 'write': 0.0}
+    total_rows = 0
+    started = time.monotonic()
+
+    def write_result(future):
+        nonlocal total_rows
+        customer_ids, probabilities, score_seconds = future.result()
+        stage_seconds['score'] += score_seconds
+        write_started = time.perf_counter()
+        copy_predictions_to_db(write_cursor, customer_ids, probabilities, timestamp)
+        stage_seconds['write'] += time.perf_counter() - write_started
+        total_rows += len(customer_ids)
+        elapsed = time.monotonic() - started
+        print(f"  {total_rows} predictions written ({total_rows / elapsed:,.0f} rows/sec overall)")
+
+    try:
+        with read_conn.cursor(name='backfill_users') as read_cursor, write_conn.cursor() as write_cursor, \
+                ProcessPoolExecutor(max_workers=workers, initializer=_init_backfill_worker, initargs=(model_path,)) as pool:
+            read_cursor.itersize = chunk_size
+            read_cursor.execute(f"SELECT customerID, {', '.join(input_columns)} FROM users;")
+            in_flight = deque()
+            while True:
+                read_started = time.perf_counter()
+                rows = read_cursor.fetchmany(chunk_size)
+                stage_seconds['read'] += time.perf_counter() - read_started
+                if not rows:
+                    break
+                in_flight.append(pool.submit(_score_users_chunk, rows))
+                while len(in_flight) >= workers * 2:
+                    write_result(in_flight.popleft())
+            while in_flight:
+                write_result(in_flight.popleft())
+            refresh_current_risk_from_predictions(write_cursor, since=timestamp)
+        write_conn.commit()
+    except Exception as e:
+        write_conn.rollback()
+        print(f"An error occurred during the backfill: {e}")
+        raise
+    finally:
+        read_conn.close()
+        write_conn.close()
+        print("Database connections closed.")
+
+    elapsed = time.monotonic() - started
+    print(f"Backfilled {total_rows} predictions in {elapsed:.1f}s ({total_rows / max(elapsed, 1e-9):,.0f} rows/sec).")
+    for stage, seconds in stage_seconds.items():
+        rate = total_rows / seconds if seconds > 0 else float('inf')
+        # Scoring time is summed across workers, so its rate is per worker
+        print(f"  {stage:>5}: {seconds:8.2f}s  {rate:,.0f} rows/sec")
+    return total_rows
+
 if __name__ == "__main__":
-    backfill_initial_predictions()
+    parser = argparse.ArgumentParser(description="Write initial churn predictions for every customer.")
+    parser.add_argument("--source", choices=["csv", "users"], default="csv",
+                        help="Score the Kaggle CSV (default) or stream the live 'users' table.")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Rows per chunk in 'users' mode.")
+    parser.add_argument("--workers", type=int, default=None, help="Scoring processes in 'users' mode (default: CPU count).")
+    args = parser.parse_args()
+
+    if args.source == "users":
+        backfill_from_users_table(args.chunk_size, args.workers)
+    else:
+        backfill_initial_predictions()
 
     
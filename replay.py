@@ -0,0 +1,360 @@
+import os
+import io
+import re
+import hashlib
+import sys
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from dotenv import load_dotenv
+from common.db import get_db_connection
+from common.risk_queries import HIGH_THRESHOLD
+from common.scorer import ChurnScorer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stream_processor'))
+from feature_store import EVENT_FIELD_UPDATES
+
+# Load environment variables from the .env file in the root directory
+load_dotenv()
+
+MODEL_PATH = 'ml_model/churn_model_xgb.pkl'
+DEFAULT_CHUNK_SIZE = 100000
+_TABLE_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?$')
+
+# Each replay worker process loads its own copy of the model once
+_worker_scorer = None
+
+def create_replay_tables(cursor):
+    """
+    Replayed scores live apart from 'predictions', in replay_predictions, partitioned by version
+    (one partition per run); replay_runs keeps each run's report.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS replay_predictions (
+            version VARCHAR(64) NOT NULL, event_id BIGINT NOT NULL, user_id VARCHAR(255) NOT NULL,
+            event_timestamp TIMESTAMPTZ NOT NULL, churn_probability FLOAT NOT NULL
+        ) PARTITION BY LIST (version);
+        CREATE INDEX IF NOT EXISTS idx_replay_predictions_user_time ON replay_predictions (user_id, event_timestamp DESC);
+        CREATE TABLE IF NOT EXISTS replay_runs (
+            version VARCHAR(64) PRIMARY KEY, created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            model_path TEXT NOT NULL, snapshot TEXT NOT NULL, since TIMESTAMPTZ, until TIMESTAMPTZ,
+            threshold FLOAT NOT NULL, report JSONB NOT NULL
+        );
+    """)
+
+def version_partition(version):
+    """The name of a version's partition of replay_predictions; any text can be a version name."""
+    return f"replay_predictions_{hashlib.md5(version.encode('utf-8')).hexdigest()[:16]}"
+
+def create_version_partition(cursor, version):
+    """
+    Creates an empty, unattached table for a version's scores, dropping an earlier run's. It is
+    loaded without indexes and attached by attach_version_partition once it is complete.
+    """
+    partition = version_partition(version)
+    cursor.execute(f"DROP TABLE IF EXISTS {partition};")
+    cursor.execute(f"CREATE TABLE {partition} (LIKE replay_predictions);")
+    # COPY leaves the version out of every row
+    cursor.execute(f"ALTER TABLE {partition} ALTER COLUMN version SET DEFAULT %s;", (version,))
+    return partition
+
+def attach_version_partition(cursor, version):
+    partition = version_partition(version)
+    cursor.execute(f"CREATE INDEX ON {partition} (user_id, event_timestamp DESC);")
+    cursor.execute(f"ALTER TABLE replay_predictions ATTACH PARTITION {partition} FOR VALUES IN (%s);", (version,))
+
+def _window(since, until, column):
+    conditions, params = [], []
+    if since:
+        conditions.append(f"{column} >= %s")
+        params.append(since)
+    if until:
+        conditions.append(f"{column} < %s")
+        params.append(until)
+    return (f"WHERE {' AND '.join(conditions)}" if conditions else ""), params
+
+def load_snapshot(conn, snapshot, input_columns, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reads the starting feature state: {customerID: tuple of input column values} for every row of
+    the snapshot table. Repeated text values share one string, so each user costs little more than
+    its tuple.
+    """
+    shared = {}
+    users = {}
+    with conn.cursor(name='replay_snapshot') as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(f"SELECT customerID, {', '.join(input_columns)} FROM {snapshot};")
+        for row in cursor:
+            users[row[0]] = tuple(shared.setdefault(value, value) if isinstance(value, str) else value for value in row[1:])
+    conn.commit()
+    return users
+
+def iter_event_chunks(conn, since=None, until=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields chunks of (event_id, user_id, event_type, event_timestamp as text) in timestamp order,
+    read through a server-side cursor. The timestamp stays text: it is only copied back out.
+    """
+    where, params = _window(since, until, 'event_timestamp')
+    with conn.cursor(name='replay_events') as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(f"""
+            SELECT event_id, user_id, event_type, event_timestamp::text FROM events {where}
+            ORDER BY event_timestamp, event_id;
+        """, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    conn.commit()
+
+def apply_events(events, users, input_columns, counters):
+    """
+    Applies a chunk of events, in order, to the users' feature state with the processor's
+    EVENT_FIELD_UPDATES rules. Returns the events that were scored and each one's feature values
+    just after it. An event whose rule doesn't hold for the state (the snapshot isn't from before
+    it) leaves the state as it is and is counted as drifted.
+    """
+    scored = []
+    features = []
+    for event in events:
+        user_id = event[1]
+        values = users.get(user_id)
+        if values is None:
+            counters['unknown_users'] += 1
+            continue
+        rule = EVENT_FIELD_UPDATES.get(event[2])
+        if rule is not None:
+            row = dict(zip(input_columns, values))
+            if rule(row):
+                values = users[user_id] = tuple(row.values())
+            else:
+                counters['drifted'] += 1
+        scored.append(event)
+        features.append(values)
+    return scored, features
+
+def _init_replay_worker(model_path):
+    """Process-pool initializer: loads the scorer once per worker, single-threaded so workers don't oversubscribe cores."""
+    global _worker_scorer
+    _worker_scorer = ChurnScorer(model_path, nthread=1)
+
+def _score_features_chunk(features):
+    """Scores a chunk of feature value tuples in the model's input column order. Returns (probabilities, seconds)."""
+    started = time.perf_counter()
+    probabilities = _worker_scorer.score_columns(dict(zip(_worker_scorer.input_columns, zip(*features))))
+    return probabilities, time.perf_counter() - started
+
+def copy_replay_predictions(cursor, partition, events, probabilities):
+    """Streams one chunk of replayed scores into a version's partition with COPY."""
+    buffer = io.StringIO()
+    buffer.writelines(
+        f"{event_id}\t{user_id}\t{timestamp}\t{probability!r}\n"
+        for (event_id, user_id, _, timestamp), probability in zip(events, probabilities.tolist())
+    )
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {partition} (event_id, user_id, event_timestamp, churn_probability) FROM STDIN", buffer)
+
+def fetch_live_scores(conn, since=None, until=None, threshold=HIGH_THRESHOLD):
+    """
+    The live side of the comparison, from 'predictions' in the same window: (predictions, alerts,
+    {user_id: latest probability}). Live predictions are stamped when they were processed, a
+    moment after their event.
+    """
+    where, params = _window(since, until, 'prediction_timestamp')
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT COUNT(*), COUNT(*) FILTER (WHERE churn_probability > %s) FROM predictions {where};",
+                       [threshold] + params)
+        predictions, alerts = cursor.fetchone()
+        cursor.execute(f"""
+            SELECT DISTINCT ON (user_id) user_id, churn_probability FROM predictions {where}
+            ORDER BY user_id, prediction_timestamp DESC;
+        """, params)
+        latest = dict(cursor.fetchall())
+    conn.commit()
+    return predictions, alerts, latest
+
+def compare_alerts(replayed, replay_alerts, replay_latest, live, live_alerts, live_latest, threshold):
+    """The alert-rate difference between a replay and the live scores, per scored event and per user's latest score."""
+    replay_users = {user_id for user_id, probability in replay_latest.items() if probability > threshold}
+    live_users = {user_id for user_id, probability in live_latest.items() if probability > threshold and user_id in replay_latest}
+    replay_rate = replay_alerts / replayed if replayed else 0.0
+    live_rate = live_alerts / live if live else 0.0
+    return {
+        "threshold": threshold,
+        "replay_scores": replayed,
+        "replay_alerts": replay_alerts,
+        "replay_alert_rate": replay_rate,
+        "live_scores": live,
+        "live_alerts": live_alerts,
+        "live_alert_rate": live_rate,
+        "alert_rate_difference": replay_rate - live_rate,
+        "users": len(replay_latest),
+        "users_alerting_replay": len(replay_users),
+        "users_alerting_live": len(live_users),
+        "users_newly_alerting": len(replay_users - live_users),
+        "users_no_longer_alerting": len(live_users - replay_users),
+    }
+
+def replay(version, model_path=MODEL_PATH, snapshot='users', since=None, until=None, threshold=HIGH_THRESHOLD,
+           chunk_size=DEFAULT_CHUNK_SIZE, workers=None, write=True):
+    """
+    Re-scores the events between since and until with model_path, as of each event.
+
+    The feature state starts from the snapshot table, which should be a copy of 'users' taken
+    before the first replayed event, and is rolled forward event by event in timestamp order.
+    Chunks of events are scored across a process pool, at most two per worker in flight, and
+    copied into a new partition of replay_predictions for version, attached in the same
+    transaction and replacing any earlier run of that version. The live tables are only read.
+    Returns the comparison report.
+    """
+    workers = workers or os.cpu_count() or 1
+    print(f"Replaying events as version '{version}' (model={model_path}, snapshot={snapshot}, "
+          f"chunk_size={chunk_size}, workers={workers})...")
+
+    read_conn = get_db_connection()
+    write_conn = get_db_connection()
+    if not read_conn or not write_conn:
+        raise Exception("Could not connect to the database.")
+
+    input_columns = ChurnScorer(model_path).input_columns
+    stage_seconds = {'snapshot': 0.0, 'read': 0.0, 'apply': 0.0, 'score': 0.0, 'write': 0.0}
+    counters = {'events': 0, 'unknown_users': 0, 'drifted': 0}
+    replayed = replay_alerts = 0
+    replay_latest = {}
+    first_timestamp = last_timestamp = None
+    started = time.monotonic()
+
+    def record_result(future, events):
+        nonlocal replayed, replay_alerts
+        probabilities, score_seconds = future.result()
+        stage_seconds['score'] += score_seconds
+        replayed += len(events)
+        replay_alerts += int((probabilities > threshold).sum())
+        replay_latest.update(zip([event[1] for event in events], probabilities.tolist()))
+        if write:
+            write_started = time.perf_counter()
+            copy_replay_predictions(write_cursor, partition, events, probabilities)
+            stage_seconds['write'] += time.perf_counter() - write_started
+        elapsed = time.monotonic() - started
+        print(f"  {replayed} events re-scored ({replayed / elapsed:,.0f} events/sec overall)")
+
+    try:
+        snapshot_started = time.perf_counter()
+        users = load_snapshot(read_conn, snapshot, input_columns, chunk_size)
+        stage_seconds['snapshot'] = time.perf_counter() - snapshot_started
+        print(f"Loaded {len(users)} users from '{snapshot}' in {stage_seconds['snapshot']:.1f}s.")
+
+        with write_conn.cursor() as write_cursor, \
+                ProcessPoolExecutor(max_workers=workers, initializer=_init_replay_worker, initargs=(model_path,)) as pool:
+            if write:
+                create_replay_tables(write_cursor)
+                partition = create_version_partition(write_cursor, version)
+            in_flight = deque()
+            read_started = time.perf_counter()
+            for events in iter_event_chunks(read_conn, since, until, chunk_size):
+                apply_started = time.perf_counter()
+                stage_seconds['read'] += apply_started - read_started
+                counters['events'] += len(events)
+                first_timestamp = first_timestamp or events[0][3]
+                last_timestamp = events[-1][3]
+                scored, features = apply_events(events, users, input_columns, counters)
+                stage_seconds['apply'] += time.perf_counter() - apply_started
+                if scored:
+                    in_flight.append((pool.submit(_score_features_chunk, features), scored))
+                while len(in_flight) >= workers * 2:
+                    record_result(*in_flight.popleft())
+                read_started = time.perf_counter()
+            while in_flight:
+                record_result(*in_flight.popleft())
+
+            live, live_alerts, live_latest = fetch_live_scores(read_conn, since, until, threshold)
+            report = compare_alerts(replayed, replay_alerts, replay_latest, live, live_alerts, live_latest, threshold)
+            elapsed = time.monotonic() - started
+            span = 0.0
+            if first_timestamp is not None:
+                # Postgres prints offsets as '+00', which datetime.fromisoformat only reads from Python 3.11
+                with read_conn.cursor() as cursor:
+                    cursor.execute("SELECT EXTRACT(EPOCH FROM %s::timestamptz - %s::timestamptz)::float8;",
+                                   (last_timestamp, first_timestamp))
+                    span = cursor.fetchone()[0]
+                read_conn.commit()
+            report.update({
+                "events": counters['events'],
+                "unknown_user_events": counters['unknown_users'],
+                "drifted_events": counters['drifted'],
+                "first_event": first_timestamp,
+                "last_event": last_timestamp,
+                "seconds": elapsed,
+                "events_per_second": counters['events'] / max(elapsed, 1e-9),
+                "times_real_time": span / max(elapsed, 1e-9),
+            })
+            if write:
+                attach_version_partition(write_cursor, version)
+                write_cursor.execute("""
+                    INSERT INTO replay_runs (version, model_path, snapshot, since, until, threshold, report)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (version) DO UPDATE SET
+                        created_at = NOW(), model_path = EXCLUDED.model_path, snapshot = EXCLUDED.snapshot,
+                        since = EXCLUDED.since, until = EXCLUDED.until, threshold = EXCLUDED.threshold, report = EXCLUDED.report;
+                """, (version, model_path, snapshot, since, until, threshold, json.dumps(report)))
+        write_conn.commit()
+    except Exception as e:
+        write_conn.rollback()
+        print(f"An error occurred during the replay: {e}")
+        raise
+    finally:
+        read_conn.close()
+        write_conn.close()
+
+    print_report(report, stage_seconds)
+    return report
+
+def print_report(report, stage_seconds):
+    events = report['events']
+    print(f"Replayed {events} events in {report['seconds']:.1f}s ({report['events_per_second']:,.0f} events/sec, "
+          f"{report['times_real_time']:,.0f}x real time).")
+    for stage, seconds in stage_seconds.items():
+        # Scoring time is summed across workers, so its rate is per worker
+        rate = f"{events / seconds:,.0f} events/sec" if seconds > 0 and stage != 'snapshot' else ""
+        print(f"  {stage:>8}: {seconds:8.2f}s  {rate}")
+    if report['unknown_user_events'] or report['drifted_events']:
+        print(f"  {report['unknown_user_events']} events were for users missing from the snapshot, and "
+              f"{report['drifted_events']} didn't apply to the snapshot's state (is it from before the first event?).")
+    threshold = report['threshold']
+    print(f"Alert rate at {threshold:.2f}: replay {report['replay_alert_rate']:.2%} of {report['replay_scores']} scores, "
+          f"live {report['live_alert_rate']:.2%} of {report['live_scores']} ({report['alert_rate_difference']:+.2%}).")
+    print(f"Users above {threshold:.2f} on their latest score: replay {report['users_alerting_replay']}, "
+          f"live {report['users_alerting_live']} ({report['users_newly_alerting']} newly alerting, "
+          f"{report['users_no_longer_alerting']} no longer alerting).")
+
+def _timestamp(value):
+    datetime.fromisoformat(value)
+    return value
+
+def _table_name(value):
+    if not _TABLE_NAME.match(value):
+        raise argparse.ArgumentTypeError(f"'{value}' is not a table name")
+    return value
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-score historical events with a model, as of each event, into a separate predictions version.")
+    parser.add_argument("--model-path", default=MODEL_PATH, help="The model to re-score with.")
+    parser.add_argument("--version", default=None,
+                        help="Name the scores are stored under in replay_predictions (default: <model file>-<timestamp>).")
+    parser.add_argument("--snapshot", type=_table_name, default='users',
+                        help="Table with the users' features from before the first replayed event, e.g. a copy of 'users'.")
+    parser.add_argument("--since", type=_timestamp, default=None, help="Replay events at or after this ISO timestamp.")
+    parser.add_argument("--until", type=_timestamp, default=None, help="Replay events before this ISO timestamp.")
+    parser.add_argument("--threshold", type=float, default=HIGH_THRESHOLD, help="Alert cutoff for the comparison with the live scores.")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Events read and scored per chunk.")
+    parser.add_argument("--workers", type=int, default=None, help="Scoring processes (default: CPU count).")
+    parser.add_argument("--no-write", action="store_true", help="Only report; don't store the replayed scores.")
+    args = parser.parse_args()
+
+    version = args.version or f"{os.path.splitext(os.path.basename(args.model_path))[0]}-{datetime.now():%Y%m%d-%H%M%S}"
+    replay(version, args.model_path, args.snapshot, args.since, args.until, args.threshold, args.chunk_size, args.workers,
+           write=not args.no_write)
@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import metrics
+
+class BroadcastClient:
+    """
+    Sends processor -> backend notifications from a background thread so the scoring loop
+    never waits on the dashboard.
+
+    Messages go into two queues: 'churn_alert' messages are never dropped (and are retried
+    until the backend accepts them), while 'new_event' messages live in a bounded queue that
+    discards the oldest entry when full. 'kpi_update' deltas are never dropped either: the unsent
+    ones are merged into a single pending update, which is retried like an alert. Queued messages are coalesced into one POST to
+    /api/broadcast-events over a pooled keep-alive session; a lone message uses the original
+    /api/broadcast-event endpoint.
+    """
+
+    def __init__(self, base_url="http://localhost:8000", max_queue_size=10000, max_batch_size=100,
+                 timeout=2.0, pool_size=4, retry_backoff=0.5, latency_window=1024):
+        self.base_url = base_url.rstrip('/')
+        self.max_queue_size = max_queue_size
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.retry_backoff = retry_backoff
+
+        self._alerts = deque()
+        self._events = deque()
+        # The merged kpi_update not yet accepted by the backend
+        self._kpi_update = None
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self.published = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self._latencies_ms = deque(maxlen=latency_window)
+
+    def start(self):
+        """Starts the background sender thread."""
+        self._thread = threading.Thread(target=self._run, name='broadcast-client', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        """Flushes what can be sent within timeout seconds, then stops the sender thread."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._session.close()
+
+    def publish(self, message):
+        """Queues a broadcast message without blocking. Returns False if a new_event had to be dropped."""
+        with self._cond:
+            self.published += 1
+            accepted = True
+            if message.get('type') == 'churn_alert':
+                self._alerts.append(message)
+            elif message.get('type') == 'kpi_update':
+                self._merge_kpi_update(message)
+            else:
+                if len(self._events) >= self.max_queue_size:
+                    # Back-pressure: the live feed only cares about recent events, so shed the oldest
+                    self._events.popleft()
+                    self.dropped += 1
+                    accepted = False
+                self._events.append(message)
+            self._cond.notify()
+        return accepted
+
+    def _merge_kpi_update(self, message):
+        """Folds a kpi_update into the pending one; the later message's values and version win. Call with _cond held."""
+        if self._kpi_update is not None:
+            message = {**message, "payload": {**self._kpi_update["payload"], **message["payload"]}}
+        self._kpi_update = message
+
+    def _take_batch(self):
+        """
+        Removes up to max_batch_size messages: the pending kpi_update and alerts first.
+        Returns ([kpi_update and alerts], [events]).
+        """
+        alerts = []
+        if self._kpi_update is not None:
+            alerts.append(self._kpi_update)
+            self._kpi_update = None
+        while self._alerts and len(alerts) < self.max_batch_size:
+            alerts.append(self._alerts.popleft())
+        events = []
+        while self._events and len(alerts) + len(events) < self.max_batch_size:
+            events.append(self._events.popleft())
+        return alerts, events
+
+    def _post(self, batch):
+        if len(batch) == 1:
+            response = self._session.post(f"{self.base_url}/api/broadcast-event", json=batch[0], timeout=self.timeout)
+        else:
+            response = self._session.post(f"{self.base_url}/api/broadcast-events", json=batch, timeout=self.timeout)
+        response.raise_for_status()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._alerts and not self._events and self._kpi_update is None and not self._stopping:
+                    self._cond.wait()
+                if self._stopping and not self._alerts and not self._events and self._kpi_update is None:
+                    return
+                alerts, events = self._take_batch()
+
+            started = time.perf_counter()
+            try:
+                self._post(alerts + events)
+            except Exception as e:
+                with self._cond:
+                    self.failed += len(alerts) + len(events)
+                    # Alerts go back to the front of the queue in their original order, and the KPI
+                    # delta under any newer one; events are let go
+                    if alerts and alerts[0].get('type') == 'kpi_update':
+                        pending, self._kpi_update = self._kpi_update, alerts[0]
+                        if pending is not None:
+                            self._merge_kpi_update(pending)
+                        self._alerts.extendleft(reversed(alerts[1:]))
+                    else:
+                        self._alerts.extendleft(reversed(alerts))
+                    stopping = self._stopping
+                print(f"BROADCAST: Failed to send {len(alerts) + len(events)} messages: {e}")
+                if stopping:
+                    return
+                time.sleep(self.retry_backoff)
+                continue
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            metrics.observe('broadcast_send', elapsed_ms / 1000)
+            # Simulator timestamp -> accepted by the backend, for every message in the batch
+            metrics.observe_lag('end_to_end', [message['payload'] for message in alerts + events])
+            with self._cond:
+                self.sent += len(alerts) + len(events)
+                self.batches += 1
+                self._latencies_ms.append(elapsed_ms)
+
+    def metrics(self):
+        """Returns queue depth, delivery counters and recent send latency percentiles (ms)."""
+        with self._cond:
+            latencies = sorted(self._latencies_ms)
+            metrics = {
+                "alert_queue_depth": len(self._alerts),
+                "event_queue_depth": len(self._events),
+                "kpi_update_pending": self._kpi_update is not None,
+                "published": self.published,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "batches": self.batches,
+            }
+        if latencies:
+            metrics["send_latency_ms_p50"] = latencies[len(latencies) // 2]
+            metrics["send_latency_ms_p95"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            metrics["send_latency_ms_max"] = latencies[-1]
+        return metrics
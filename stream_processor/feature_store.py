@@ -0,0 +1,214 @@
+import time
+from collections import OrderedDict
+
+from common.db import execute_prepared, register_statements
+
+# Maps the lowercase column names Postgres returns to the names the model was trained on
+COLUMN_MAPPING = {
+    'customerid': 'customerID', 'gender': 'gender', 'seniorcitizen': 'SeniorCitizen',
+    'partner': 'Partner', 'dependents': 'Dependents', 'tenure': 'tenure',
+    'phoneservice': 'PhoneService', 'multiplelines': 'MultipleLines',
+    'internetservice': 'InternetService', 'onlinesecurity': 'OnlineSecurity',
+    'onlinebackup': 'OnlineBackup', 'deviceprotection': 'DeviceProtection',
+    'techsupport': 'TechSupport', 'streamingtv': 'StreamingTV',
+    'streamingmovies': 'StreamingMovies', 'contract': 'Contract',
+    'paperlessbilling': 'PaperlessBilling', 'paymentmethod': 'PaymentMethod',
+    'monthlycharges': 'MonthlyCharges', 'totalcharges': 'TotalCharges'
+}
+
+register_statements({
+    'users_lookup_many': "SELECT * FROM users WHERE customerID = ANY(%s)",
+})
+
+# Model input columns, in training order (everything except the ID)
+FEATURE_COLUMNS = [name for name in COLUMN_MAPPING.values() if name != 'customerID']
+
+# --- EVENT FIELD UPDATES ---
+# Each rule mirrors the UPDATE statement of the matching _handle_* function in
+# event_simulator/simulator.py. A rule returns False when the cached row does not
+# satisfy the handler's WHERE clause, which means the cache has drifted from Postgres.
+
+def _apply_contract_downgrade(row):
+    if row['Contract'] == 'Month-to-month':
+        return False
+    row['Contract'] = 'Month-to-month'
+    return True
+
+def _apply_service_removal(row):
+    if row['OnlineSecurity'] != 'Yes':
+        return False
+    row['OnlineSecurity'] = 'No'
+    row['MonthlyCharges'] -= 5
+    return True
+
+def _apply_cancel_autopay(row):
+    if '(automatic)' not in row['PaymentMethod']:
+        return False
+    row['PaymentMethod'] = 'Mailed check'
+    return True
+
+def _apply_contract_upgrade(row):
+    if row['Contract'] != 'Month-to-month':
+        return False
+    row['Contract'] = 'One year'
+    return True
+
+def _apply_add_service(row):
+    if row['TechSupport'] != 'No':
+        return False
+    row['TechSupport'] = 'Yes'
+    row['MonthlyCharges'] += 5
+    return True
+
+def _apply_enable_autopay(row):
+    if '(automatic)' in row['PaymentMethod']:
+        return False
+    row['PaymentMethod'] = 'Credit card (automatic)'
+    return True
+
+def _apply_tenure_increase(row):
+    row['tenure'] += 1
+    row['TotalCharges'] += row['MonthlyCharges']
+    return True
+
+EVENT_FIELD_UPDATES = {
+    'contract_downgrade': _apply_contract_downgrade,
+    'removed_online_security': _apply_service_removal,
+    'cancelled_autopay': _apply_cancel_autopay,
+    'contract_upgrade': _apply_contract_upgrade,
+    'added_tech_support': _apply_add_service,
+    'enabled_autopay': _apply_enable_autopay,
+    'monthly_anniversary': _apply_tenure_increase,
+}
+
+class FeatureStore:
+    """
+    A bounded, LRU-evicted in-memory copy of the 'users' feature table.
+
+    Rows are kept fresh by replaying the field changes each simulator event describes
+    instead of re-reading Postgres. Events that can't be applied (unknown type, or a
+    cached row that doesn't match the handler's precondition) fall back to re-reading the row.
+
+    Each users row has a feature_version that the simulator's UPDATE increments and sends
+    with the event, so the cache can tell which of a row's changes it already holds.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._rows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.applied_events = 0
+        self.refreshes = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, user_id):
+        return user_id in self._rows
+
+    def _put(self, row):
+        user_id = row['customerID']
+        self._rows[user_id] = row
+        self._rows.move_to_end(user_id)
+        while len(self._rows) > self.max_size:
+            self._rows.popitem(last=False)
+            self.evictions += 1
+
+    def _fetch(self, conn, user_ids):
+        """Reads rows for the given users from Postgres and caches them. Returns {user_id: row}."""
+        with conn.cursor() as cursor:
+            execute_prepared(cursor, 'users_lookup_many', (list(user_ids),))
+            db_columns = [COLUMN_MAPPING.get(desc[0].lower(), desc[0]) for desc in cursor.description]
+            rows = [dict(zip(db_columns, values)) for values in cursor.fetchall()]
+        for row in rows:
+            self._put(row)
+        return {row['customerID']: row for row in rows}
+
+    def load(self, conn, chunk_size=10000):
+        """Warms the cache with up to max_size users at startup."""
+        print(f"Loading up to {self.max_size} users into the feature cache...")
+        started = time.monotonic()
+        with conn.cursor(name='feature_store_warmup') as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute("SELECT * FROM users LIMIT %s;", (self.max_size,))
+            db_columns = None
+            for values in cursor:
+                if db_columns is None:
+                    db_columns = [COLUMN_MAPPING.get(desc[0].lower(), desc[0]) for desc in cursor.description]
+                self._put(dict(zip(db_columns, values)))
+        conn.commit()
+        print(f"Feature cache loaded {len(self._rows)} users in {time.monotonic() - started:.2f}s.")
+
+    def get(self, conn, user_id):
+        """Returns the feature row for a user, reading it from Postgres on a miss. None if the user doesn't exist."""
+        row = self._rows.get(user_id)
+        if row is not None:
+            self.hits += 1
+            self._rows.move_to_end(user_id)
+            return row
+        self.misses += 1
+        return self._fetch(conn, [user_id]).get(user_id)
+
+    def get_many(self, conn, user_ids):
+        """Returns {user_id: row} for the given users, fetching all misses in a single query."""
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            row = self._rows.get(user_id)
+            if row is not None:
+                self.hits += 1
+                self._rows.move_to_end(user_id)
+                found[user_id] = row
+            else:
+                self.misses += 1
+                missing.append(user_id)
+        if missing:
+            found.update(self._fetch(conn, missing))
+        return found
+
+    def refresh(self, conn, user_id):
+        """Re-reads a single row from Postgres, replacing whatever is cached."""
+        self.refreshes += 1
+        self._rows.pop(user_id, None)
+        return self._fetch(conn, [user_id]).get(user_id)
+
+    def apply_event(self, conn, event):
+        """
+        Applies the field changes an event describes to the cached row, if the user is cached.
+        Only the row's next change (feature_version one above the cached row's) is applied; an
+        event the row already reflects is skipped, and a gap or an event without a version
+        re-reads the row.
+        """
+        user_id = event.get('user_id')
+        row = self._rows.get(user_id)
+        if row is None:
+            # Not cached: the next get() reads the already-updated row from Postgres
+            return
+        version = event.get('feature_version')
+        cached_version = row.get('feature_version')
+        known = version is not None and cached_version is not None
+        if known and version <= cached_version:
+            return
+
+        rule = EVENT_FIELD_UPDATES.get(event.get('event_type'))
+        if known and version == cached_version + 1 and rule is not None and rule(row):
+            row['feature_version'] = version
+            self.applied_events += 1
+        else:
+            self.refresh(conn, user_id)
+
+    def stats(self):
+        """Returns hit/miss counters and the current hit rate."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "applied_events": self.applied_events,
+            "refreshes": self.refreshes,
+        }
@@ -0,0 +1,233 @@
+import threading
+import time
+from collections import Counter
+
+from common.risk_queries import HIGH_THRESHOLD, risk_tier
+
+TIER_KEYS = {
+    'Critical': 'critical_risk_customers',
+    'High': 'high_risk_customers',
+    'Medium': 'medium_risk_customers',
+    'Low': 'low_risk_customers',
+}
+
+class KpiAggregator:
+    """
+    Dashboard KPIs maintained incrementally from the processor's own predictions.
+
+    Keeps each scored customer's latest (probability, contract, monthly charges) and the running
+    totals derived from them: customers per risk tier, MRR at risk, the average probability and
+    the high-risk count per contract. Each update subtracts the customer's previous contribution
+    and adds the new one, so applying the same prediction twice is harmless. Totals are rebuilt
+    from SQL at startup and on every reconcile() to correct drift (e.g. from scores written by
+    other processes, or float error in the running sums).
+
+    Only the thread that calls update() and maybe_reconcile() changes the totals. The periodic
+    reconcile reads SQL on a background thread and hands its result back to that thread.
+    """
+
+    def __init__(self, reconcile_interval=300.0, broadcast_interval=1.0):
+        self.reconcile_interval = reconcile_interval
+        self.broadcast_interval = broadcast_interval
+        self._customers = {}
+        self.total_customers = 0
+        self._reset_totals()
+        self._last_sent = {}
+        self._last_broadcast = 0.0
+        self._last_reconcile = 0.0
+        self.version = 0
+        self.updates = 0
+        self.reconciles = 0
+        # A reconcile in progress: updates applied since it started are journaled and replayed
+        # onto its result, which the background thread leaves in _rebuilt under _lock
+        self._lock = threading.Lock()
+        self._rebuild_thread = None
+        self._rebuilt = None
+        self._journal = None
+
+    def _reset_totals(self):
+        self.tier_counts = Counter({tier: 0 for tier in TIER_KEYS})
+        self.segment_counts = Counter()
+        self.mrr_at_risk = 0.0
+        self.probability_sum = 0.0
+
+    def _add(self, probability, contract, monthly_charges, sign):
+        self.tier_counts[risk_tier(probability)] += sign
+        self.probability_sum += sign * probability
+        if probability > HIGH_THRESHOLD:
+            self.segment_counts[contract] += sign
+            self.mrr_at_risk += sign * monthly_charges
+
+    def update(self, user_id, probability, contract, monthly_charges):
+        """Records a customer's latest score and the contract and charges it was computed from."""
+        state = (float(probability), contract, float(monthly_charges or 0.0))
+        previous = self._customers.get(user_id)
+        if previous == state:
+            return
+        if previous is not None:
+            self._add(*previous, -1)
+        self._add(*state, 1)
+        self._customers[user_id] = state
+        self.updates += 1
+        if self._journal is not None:
+            self._journal.append((user_id, probability, contract, monthly_charges))
+
+    def apply(self, updates):
+        """Applies (user_id, probability, contract, monthly_charges) tuples, in order."""
+        for update in updates:
+            self.update(*update)
+
+    def snapshot(self):
+        """Returns the KPIs in the /api/dashboard-kpis format."""
+        scored = len(self._customers)
+        kpis = {
+            "total_active_customers": self.total_customers,
+            **{key: self.tier_counts[tier] for tier, key in TIER_KEYS.items()},
+            "mrr_at_risk": round(self.mrr_at_risk, 2),
+            "overall_avg_churn_probability": self.probability_sum / scored if scored else 0.0,
+            "churn_by_segment": [
+                {"contract": contract, "count": count}
+                for contract, count in self.segment_counts.most_common() if count > 0
+            ],
+        }
+        return kpis
+
+    def take_delta(self):
+        """Returns the KPIs that changed since the last call, or None if nothing did."""
+        kpis = self.snapshot()
+        delta = {key: value for key, value in kpis.items() if self._last_sent.get(key) != value}
+        if not delta:
+            return None
+        self._last_sent = kpis
+        self.version += 1
+        return delta
+
+    def latest(self):
+        """
+        The KPIs as of the last take_delta(), with their version. Safe to call from another thread
+        (e.g. the metrics HTTP server), since it only reads a dict that is replaced, never mutated.
+        """
+        return {**self._last_sent, "version": self.version}
+
+    def load(self, conn, chunk_size=10000):
+        """Rebuilds every total from 'users' and 'current_risk'. Returns the new snapshot."""
+        customers = {}
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM users;")
+            total_customers = cursor.fetchone()[0]
+        with conn.cursor(name='kpi_reconcile') as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute("""
+                SELECT cr.user_id, cr.churn_probability, u.Contract, u.MonthlyCharges
+                FROM current_risk cr JOIN users u ON u.customerID = cr.user_id;
+            """)
+            for user_id, probability, contract, monthly_charges in cursor:
+                customers[user_id] = (float(probability), contract, float(monthly_charges or 0.0))
+        conn.commit()
+
+        self._customers = customers
+        self.total_customers = total_customers
+        self._reset_totals()
+        for state in customers.values():
+            self._add(*state, 1)
+        self._last_reconcile = time.monotonic()
+        return self.snapshot()
+
+    def _take_state(self, other):
+        """Replaces this aggregator's customers and totals with other's."""
+        self._customers = other._customers
+        self.total_customers = other.total_customers
+        self.tier_counts = other.tier_counts
+        self.segment_counts = other.segment_counts
+        self.mrr_at_risk = other.mrr_at_risk
+        self.probability_sum = other.probability_sum
+
+    def _replace(self, fresh):
+        """Swaps in totals rebuilt from SQL. Returns {kpi: (running, sql)} for the KPIs that had drifted."""
+        before = self.snapshot()
+        after = fresh.snapshot()
+        self._take_state(fresh)
+        self._last_reconcile = time.monotonic()
+        self.reconciles += 1
+        drift = {}
+        for key, value in after.items():
+            running = before[key]
+            if isinstance(value, float):
+                if abs(running - value) > 1e-6 * max(1.0, abs(value)):
+                    drift[key] = (running, value)
+            elif running != value:
+                drift[key] = (running, value)
+        return drift
+
+    def reconcile(self, conn):
+        """
+        Recomputes the totals from SQL and replaces the running ones. Returns {kpi: (running, sql)}
+        for the KPIs that had drifted; the delta they cause goes out with the next broadcast.
+        """
+        fresh = KpiAggregator()
+        fresh.load(conn)
+        return self._replace(fresh)
+
+    def _rebuild(self, db):
+        fresh = KpiAggregator()
+        try:
+            with db.connection() as conn:
+                fresh.load(conn)
+        except Exception as e:
+            print(f"KPIS: Reconcile failed: {e}")
+            fresh = None
+        with self._lock:
+            self._rebuilt = (fresh,)
+
+    def _finish_reconcile(self):
+        """Swaps in a finished background reconcile, with the updates applied while it ran replayed on top."""
+        with self._lock:
+            result, self._rebuilt = self._rebuilt, None
+        if result is None:
+            return None
+        self._rebuild_thread = None
+        journal, self._journal = self._journal, None
+        fresh = result[0]
+        if fresh is None:
+            # Try again after another interval rather than on every call
+            self._last_reconcile = time.monotonic()
+            return None
+        fresh.apply(journal)
+        return self._replace(fresh)
+
+    def maybe_reconcile(self, db):
+        """
+        Reconciles against SQL if reconcile_interval has passed (0 disables it). The scan runs on a
+        background thread with its own connection from db, so the caller never waits for it; its
+        result is swapped in by a later call. Returns the drift once a reconcile has been applied.
+        """
+        drift = self._finish_reconcile()
+        if drift:
+            print(f"KPIS: Reconciled against SQL, corrected drift in {drift}")
+        if self._rebuild_thread is None and self.reconcile_interval \
+                and time.monotonic() - self._last_reconcile >= self.reconcile_interval:
+            self._journal = []
+            self._rebuild_thread = threading.Thread(target=self._rebuild, args=(db,), name='kpi-reconcile', daemon=True)
+            self._rebuild_thread.start()
+        return drift
+
+    def maybe_publish(self, broadcaster, force=False):
+        """Broadcasts the changed KPIs as a 'kpi_update' message, at most once per broadcast_interval."""
+        now = time.monotonic()
+        if not force and now - self._last_broadcast < self.broadcast_interval:
+            return None
+        self._last_broadcast = now
+        delta = self.take_delta()
+        if delta is None:
+            return None
+        message = {"type": "kpi_update", "payload": {**delta, "version": self.version}}
+        broadcaster.publish(message)
+        return message
+
+    def stats(self):
+        return {
+            "customers": len(self._customers),
+            "updates": self.updates,
+            "reconciles": self.reconciles,
+            "version": self.version,
+        }
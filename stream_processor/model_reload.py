@@ -0,0 +1,210 @@
+import os
+import queue
+import random
+import threading
+import time
+
+import numpy as np
+
+from common import metrics
+from common.scorer import ChurnScorer
+
+class ModelReloader:
+    """
+    Keeps a ChurnScorer loaded from model_path and replaces it when the file changes, without
+    stopping the consumer. A background thread polls the file every poll_interval seconds; once a
+    change has stayed put for one poll (so a copy in progress isn't read), the new model is loaded,
+    warmed up with one prediction and swapped in as self.scorer. Callers read self.scorer once per
+    event or batch, so each one is scored by a single model. A file that fails to load is logged
+    and skipped, and the current model stays in use.
+
+    With required=False the file may not exist yet, and self.scorer is None until it does.
+    """
+
+    def __init__(self, model_path, poll_interval=5.0, nthread=None, warmup_rows=256, required=True):
+        self.model_path = model_path
+        self.poll_interval = poll_interval
+        self.nthread = nthread
+        self.warmup_rows = warmup_rows
+        self._stat = self._file_stat()
+        self._seen = self._stat
+        self.scorer = self._load() if self._stat is not None or required else None
+        self.version = 0 if self.scorer is None else 1
+        self.loaded_at = time.time() if self.scorer is not None else None
+        self.reloads = 0
+        self.failed_reloads = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _file_stat(self):
+        try:
+            stat = os.stat(self.model_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _load(self):
+        scorer = ChurnScorer(self.model_path, nthread=self.nthread)
+        # The first prediction pays for XGBoost's lazy setup; do it here rather than on a live batch
+        probabilities = scorer.predict_encoded(scorer.new_buffer(self.warmup_rows))
+        if not np.all(np.isfinite(probabilities)):
+            raise ValueError("the model returned non-finite probabilities")
+        return scorer
+
+    def check(self):
+        """Loads the model file if it has changed and settled. Returns True if a new model was swapped in."""
+        stat = self._file_stat()
+        if stat is None or stat == self._stat or stat != self._seen:
+            self._seen = stat
+            return False
+        started = time.monotonic()
+        try:
+            scorer = self._load()
+        except Exception as e:
+            # Not retried until the file changes again
+            self._stat = stat
+            self.failed_reloads += 1
+            print(f"MODEL: Could not load {self.model_path} ({e}); keeping version {self.version}.")
+            return False
+        self._stat = stat
+        self.scorer = scorer
+        self.version += 1
+        self.reloads += 1
+        self.loaded_at = time.time()
+        print(f"MODEL: Loaded version {self.version} of {self.model_path} in {time.monotonic() - started:.2f}s.")
+        return True
+
+    def _run(self):
+        while not self._stopping.wait(self.poll_interval):
+            self.check()
+
+    def start(self):
+        """Starts the polling thread. A poll_interval of 0 leaves reloading to explicit check() calls."""
+        if self.poll_interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='model-reloader', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+
+    def stats(self):
+        return {
+            "model_path": self.model_path,
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "reloads": self.reloads,
+            "failed_reloads": self.failed_reloads,
+        }
+
+class ShadowScorer:
+    """
+    Scores a sampled fraction of live traffic with a candidate model and records how its scores
+    differ from the live model's. The comparison runs on a background thread from copies of the
+    sampled feature rows, so it never delays a batch or changes what is broadcast; samples that
+    arrive while max_queue batches are waiting are dropped and counted.
+
+    Both models encode and score the same sampled rows there, timed into the 'model_live' and
+    'model_shadow' histograms. Score differences are kept as counters, which add up across workers.
+    """
+
+    def __init__(self, candidate, sample_rate=0.1, max_queue=100, alert_threshold=0.70, seed=None):
+        # A ModelReloader for the candidate file, so a new candidate is picked up like a new model
+        self.candidate = candidate
+        self.sample_rate = sample_rate
+        self.alert_threshold = alert_threshold
+        self._queue = queue.Queue(max_queue)
+        self._random = random.Random(seed)
+        self._thread = None
+        self.sampled = 0
+        self.compared = 0
+        self.dropped = 0
+        self.errors = 0
+        self.sum_abs_delta = 0.0
+        self.max_abs_delta = 0.0
+        self.over_0_05 = 0
+        self.over_0_10 = 0
+        # Rows only one of the two models would have raised a churn alert for
+        self.alerts_live_only = 0
+        self.alerts_shadow_only = 0
+
+    def submit(self, scorer, rows, scores):
+        """Samples from {user_id: feature row} and the live model's {user_id: probability} for comparison."""
+        if self.candidate.scorer is None:
+            return
+        sample = [(dict(rows[user_id]), score) for user_id, score in scores.items() if self._random.random() < self.sample_rate]
+        if not sample:
+            return
+        self.sampled += len(sample)
+        try:
+            self._queue.put_nowait((scorer, sample))
+        except queue.Full:
+            self.dropped += len(sample)
+
+    def _compare(self, scorer, sample):
+        candidate = self.candidate.scorer
+        features = [row for row, _ in sample]
+        live = np.array([score for _, score in sample], dtype=np.float64)
+
+        started = time.perf_counter()
+        scorer.predict_encoded(scorer.encode_rows(features))
+        metrics.observe('model_live', time.perf_counter() - started)
+        started = time.perf_counter()
+        shadow = candidate.predict_encoded(candidate.encode_rows(features)).astype(np.float64)
+        metrics.observe('model_shadow', time.perf_counter() - started)
+
+        deltas = np.abs(shadow - live)
+        live_alerts = live > self.alert_threshold
+        shadow_alerts = shadow > self.alert_threshold
+        self.compared += len(sample)
+        self.sum_abs_delta += float(deltas.sum())
+        self.max_abs_delta = max(self.max_abs_delta, float(deltas.max()))
+        self.over_0_05 += int((deltas > 0.05).sum())
+        self.over_0_10 += int((deltas > 0.10).sum())
+        self.alerts_live_only += int((live_alerts & ~shadow_alerts).sum())
+        self.alerts_shadow_only += int((shadow_alerts & ~live_alerts).sum())
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            try:
+                self._compare(*task)
+            except Exception as e:
+                self.errors += 1
+                print(f"SHADOW: Comparison failed: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self.candidate.start()
+            self._thread = threading.Thread(target=self._run, name='shadow-scorer', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self.candidate.stop()
+        if self._thread is not None:
+            try:
+                self._queue.put(None, timeout=5)
+            except queue.Full:
+                return
+            self._thread.join(timeout=5)
+
+    def stats(self):
+        return {
+            "candidate_path": self.candidate.model_path,
+            "candidate_version": self.candidate.version,
+            "sample_rate": self.sample_rate,
+            "sampled": self.sampled,
+            "compared": self.compared,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "sum_abs_delta": self.sum_abs_delta,
+            "mean_abs_delta": self.sum_abs_delta / self.compared if self.compared else 0.0,
+            "max_abs_delta": self.max_abs_delta,
+            "over_0_05": self.over_0_05,
+            "over_0_10": self.over_0_10,
+            "alerts_live_only": self.alerts_live_only,
+            "alerts_shadow_only": self.alerts_shadow_only,
+        }
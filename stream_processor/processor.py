@@ -1,33 +1,49 @@
 import os
+import sys
 import json
-import joblib
+import numpy as np
 import pandas as pd
-from kafka import KafkaConsumer
 from dotenv import load_dotenv
-import requests
 import time
-import psycopg2
+from psycopg2.extras import execute_values
 from datetime import datetime
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import metrics
+from common.db import CONNECTION_ERRORS, Database, execute_prepared, register_statements
+from common.event_codec import encode_payload
+from common.risk_queries import upsert_current_risk, upsert_current_risk_batch
+from common.transport import TopicPartition, create_consumer, is_broker_error, seek, subscribe
+from feature_store import FeatureStore, COLUMN_MAPPING
+from broadcaster import BroadcastClient
+from kpi_aggregator import KpiAggregator
+from score_cache import ScoreCache
+from model_reload import ModelReloader, ShadowScorer
+
 # Load environment variables from the root .env file
 load_dotenv(dotenv_path='../.env')
 
-def get_db_connection():
-    """Establishes a connection to the Supabase PostgreSQL database."""
-    POSTGRES_URI = os.getenv("POSTGRES_URI")
-    if not POSTGRES_URI:
-        raise ValueError("POSTGRES_URI not found in .env file.")
-    try:
-        conn = psycopg2.connect(POSTGRES_URI)
-        return conn
-    except Exception as e:
-        print(f"Database connection error: {e}")
-        return None
+ALERT_THRESHOLD = 0.70
+# Top-k feature attributions attached to churn alerts (scores above ALERT_THRESHOLD only); 0 turns them off
+EXPLAIN_TOP_K = int(os.getenv("EXPLAIN_TOP_K", "3"))
+# Exact TreeSHAP costs ~0.3 ms per alert; EXPLAIN_APPROX=1 switches to XGBoost's far cheaper approximation
+EXPLAIN_APPROX = os.getenv("EXPLAIN_APPROX", "0") == "1"
+# Also store them in predictions.top_features (the column db_setup.py creates)
+STORE_EXPLANATIONS = os.getenv("STORE_EXPLANATIONS", "0") == "1"
+
+register_statements({
+    'user_lookup': "SELECT * FROM users WHERE customerID = %s",
+    'insert_event': "INSERT INTO events (user_id, event_type, event_timestamp, payload) VALUES (%s, %s, %s, %s)",
+    'insert_prediction': "INSERT INTO predictions (user_id, churn_probability, prediction_timestamp) VALUES (%s, %s, %s)",
+    'insert_prediction_explained': (
+        "INSERT INTO predictions (user_id, churn_probability, prediction_timestamp, top_features) VALUES (%s, %s, %s, %s)"
+    ),
+})
 
 def get_user_features(conn, user_id):
     """Fetches a user's complete feature set from the database and maps columns to match the model's expectations."""
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE customerID = %s;", (user_id,))
+    execute_prepared(cursor, 'user_lookup', (user_id,))
     user_data = cursor.fetchone()
     
     if not user_data:
@@ -39,137 +55,609 @@ def get_user_features(conn, user_id):
     
     user_df = pd.DataFrame([user_data], columns=db_columns)
 
-    column_mapping = {
-        'customerid': 'customerID', 'gender': 'gender', 'seniorcitizen': 'SeniorCitizen', 
-        'partner': 'Partner', 'dependents': 'Dependents', 'tenure': 'tenure', 
-        'phoneservice': 'PhoneService', 'multiplelines': 'MultipleLines', 
-        'internetservice': 'InternetService', 'onlinesecurity': 'OnlineSecurity', 
-        'onlinebackup': 'OnlineBackup', 'deviceprotection': 'DeviceProtection', 
-        'techsupport': 'TechSupport', 'streamingtv': 'StreamingTV', 
-        'streamingmovies': 'StreamingMovies', 'contract': 'Contract', 
-        'paperlessbilling': 'PaperlessBilling', 'paymentmethod': 'PaymentMethod', 
-        'monthlycharges': 'MonthlyCharges', 'totalcharges': 'TotalCharges'
-    }
-    user_df.rename(columns=column_mapping, inplace=True)
+    user_df.rename(columns=COLUMN_MAPPING, inplace=True)
     
     return user_df
 
+def get_users_features_batch(conn, user_ids):
+    """Fetches the feature sets for many users in a single query. Returns {customerID: feature dict}."""
+    with conn.cursor() as cursor:
+        execute_prepared(cursor, 'users_lookup_many', (list(user_ids),))
+        db_columns = [COLUMN_MAPPING.get(desc[0].lower(), desc[0]) for desc in cursor.description]
+        rows = [dict(zip(db_columns, values)) for values in cursor.fetchall()]
+    return {row['customerID']: row for row in rows}
+
 def log_event_to_db(conn, event):
-    """Logs a raw event to the 'events' table."""
+    """
+    Logs a raw event to the 'events' table: its typed columns, plus a payload for whatever they
+    don't hold (usually just the feature_version; see common/event_codec.py). The caller owns the transaction.
+    """
     with conn.cursor() as cursor:
-        cursor.execute(
-            "INSERT INTO events (user_id, event_type, event_timestamp, event_data) VALUES (%s, %s, %s, %s)",
-            (event.get('user_id'), event.get('event_type'), datetime.fromtimestamp(event.get('timestamp')), json.dumps(event))
+        execute_prepared(
+            cursor, 'insert_event',
+            (event.get('user_id'), event.get('event_type'), datetime.fromtimestamp(event.get('timestamp')), encode_payload(event))
         )
-        conn.commit()
 
-def log_prediction_to_db(conn, user_id, probability):
-    """Logs a new prediction score to the 'predictions' table."""
+def log_prediction_to_db(conn, user_id, probability, top_features=None, contract=None):
+    """
+    Logs a new prediction score to the 'predictions' history and makes it the user's row in
+    current_risk, along with the contract it was computed with. The caller owns the transaction.
+    """
+    timestamp = datetime.now()
+    with conn.cursor() as cursor:
+        if STORE_EXPLANATIONS:
+            execute_prepared(
+                cursor, 'insert_prediction_explained',
+                (user_id, probability, timestamp, None if top_features is None else json.dumps(top_features))
+            )
+        else:
+            execute_prepared(cursor, 'insert_prediction', (user_id, probability, timestamp))
+        upsert_current_risk(cursor, user_id, probability, timestamp, top_features, contract)
+
+def log_events_to_db_batch(conn, events):
+    """Bulk-inserts raw events into the 'events' table. The caller owns the transaction."""
+    rows = [
+        (event.get('user_id'), event.get('event_type'), datetime.fromtimestamp(event.get('timestamp')), encode_payload(event))
+        for event in events
+    ]
     with conn.cursor() as cursor:
-        cursor.execute(
-            "INSERT INTO predictions (user_id, churn_probability, prediction_timestamp) VALUES (%s, %s, %s)",
-            (user_id, probability, datetime.now())
+        execute_values(
+            cursor,
+            "INSERT INTO events (user_id, event_type, event_timestamp, payload) VALUES %s",
+            rows
         )
-        conn.commit()
 
-def create_kafka_consumer(service_uri, topic_name):
-    """Creates a Kafka consumer for Aiven with a group_id."""
-    print("Connecting to Aiven Kafka for stream processing...")
-    while True:
-        try:
-            consumer = KafkaConsumer(
-                topic_name,
-                bootstrap_servers=service_uri,
-                security_protocol="SSL",
-                ssl_cafile="../ca.pem",
-                ssl_certfile="../service.cert",
-                ssl_keyfile="../service.key",
-                auto_offset_reset='earliest',
-                value_deserializer=lambda x: json.loads(x.decode('utf-8')),
-                request_timeout_ms=120000,
-                group_id='churn_processor_group_v2' # Use a new group_id to reset offset
+def log_predictions_to_db_batch(conn, predictions):
+    """
+    Bulk-inserts (user_id, probability, timestamp, top_features, contract) tuples into 'predictions'
+    and upserts each user's latest one into current_risk. top_features is only written to the history
+    when STORE_EXPLANATIONS is on. The caller owns the transaction.
+    """
+    with conn.cursor() as cursor:
+        if STORE_EXPLANATIONS:
+            execute_values(
+                cursor,
+                "INSERT INTO predictions (user_id, churn_probability, prediction_timestamp, top_features) VALUES %s",
+                [(user_id, probability, timestamp, None if top_features is None else json.dumps(top_features))
+                 for user_id, probability, timestamp, top_features, *_ in predictions]
             )
-            print("Stream processor connected to Aiven Kafka!")
-            return consumer
-        except Exception as e:
-            print(f"Failed to connect: {e}. Retrying...")
-            time.sleep(5)
+        else:
+            execute_values(
+                cursor,
+                "INSERT INTO predictions (user_id, churn_probability, prediction_timestamp) VALUES %s",
+                [prediction[:3] for prediction in predictions]
+            )
+        upsert_current_risk_batch(cursor, predictions)
+
+def format_contributions(features, contributions):
+    """Turns scorer.top_contributions output for one user into the payload's top_features list."""
+    top_features = []
+    for column, contribution in contributions:
+        value = features[column]
+        # Rows built through pandas carry NumPy scalars, which json can't encode
+        if isinstance(value, np.generic):
+            value = value.item()
+        top_features.append({"feature": column, "value": value, "contribution": round(contribution, 4)})
+    return top_features
+
+def build_broadcast_message(event, risk_score, top_features=None):
+    """Wraps an event and its score in the message format the dashboard expects."""
+    payload = {**event, "churn_probability": risk_score}
+    if top_features is not None:
+        payload["top_features"] = top_features
+    # Using the > 0.70 threshold for a high-risk "alert"
+    message_type = "churn_alert" if risk_score > ALERT_THRESHOLD else "new_event"
+    return {"type": message_type, "payload": payload}
 
-def process_stream(consumer, model, db_conn):
-    """Consumes events, fetches the updated user state, predicts, and logs."""
+def get_user_features_cached(feature_store, conn, event):
+    """Applies an event to the feature cache and returns the user's feature dict."""
+    feature_store.apply_event(conn, event)
+    return feature_store.get(conn, event.get('user_id'))
+
+def kpi_update(user_id, risk_score, features):
+    """The (user_id, probability, contract, monthly_charges) tuple KpiAggregator.apply takes."""
+    return (user_id, risk_score, features['Contract'], features['MonthlyCharges'])
+
+def handle_event(conn, event, scorer, feature_store=None, kpi_updates=None, score_cache=None, shadow=None):
+    """
+    Logs one event, scores its user and logs the prediction, all in the caller's transaction.
+    Returns the broadcast message, or None if the user doesn't exist or score_cache suppressed it.
+    The KPI update for the new score is appended to kpi_updates, if given, for the caller to apply
+    once the transaction commits. Features score_cache has already seen are not re-scored; the
+    caller commits or discards its stored predictions along with the transaction.
+    shadow is an optional ShadowScorer that may also score the user with a candidate model.
+    """
+    user_id = event.get('user_id')
+    with metrics.timer('db_write'):
+        log_event_to_db(conn, event)
+    with metrics.timer('feature_fetch'):
+        if feature_store is not None:
+            features = get_user_features_cached(feature_store, conn, event)
+        else:
+            user_df = get_user_features(conn, user_id)
+            features = None if user_df is None else user_df.to_dict('records')[0]
+    if features is None:
+        print(f"Warning: User {user_id} not found. Skipping.")
+        return None
+
+    with metrics.timer('score'):
+        encoded = scorer.encode_row(features)
+        fingerprint = cached = None
+        if score_cache is not None:
+            fingerprint = score_cache.fingerprint(encoded)
+            cached = score_cache.get(fingerprint)
+        if cached is None:
+            risk_score = float(scorer.predict_encoded(encoded)[0])
+    if cached is not None:
+        risk_score, top_features = cached
+    else:
+        top_features = None
+        if EXPLAIN_TOP_K and risk_score > ALERT_THRESHOLD:
+            with metrics.timer('explain'):
+                top_features = format_contributions(features, scorer.top_contributions(encoded, EXPLAIN_TOP_K, EXPLAIN_APPROX)[0])
+        if score_cache is not None:
+            score_cache.put(fingerprint, risk_score, top_features)
+    if shadow is not None:
+        shadow.submit(scorer, {user_id: features}, {user_id: risk_score})
+
+    unchanged = score_cache is not None and score_cache.is_unchanged(user_id, fingerprint)
+    if unchanged:
+        score_cache.unchanged += 1
+    if unchanged and score_cache.skip_unchanged_writes:
+        score_cache.skipped_writes += 1
+    else:
+        with metrics.timer('db_write'):
+            log_prediction_to_db(conn, user_id, risk_score, top_features, features['Contract'])
+        if score_cache is not None:
+            score_cache.stored(user_id, fingerprint)
+    if kpi_updates is not None:
+        kpi_updates.append(kpi_update(user_id, risk_score, features))
+    if unchanged and score_cache.skip_unchanged_broadcasts:
+        score_cache.skipped_broadcasts += 1
+        return None
+    return build_broadcast_message(event, risk_score, top_features)
+
+def current_scorer(scorer, models, score_cache=None):
+    """
+    The scorer for the next event or batch: models' latest version if hot reload is on, else scorer.
+    Scores cached from the previous model are dropped when it changes.
+    """
+    if models is None or models.scorer is scorer:
+        return scorer
+    if score_cache is not None:
+        score_cache.clear()
+    return models.scorer
+
+def update_kpis(kpis, updates, db, broadcaster):
+    """Applies committed predictions to the KPI aggregator, then reconciles and broadcasts when they are due."""
+    if kpis is None:
+        return
+    kpis.apply(updates)
+    if db is not None:
+        kpis.maybe_reconcile(db)
+    kpis.maybe_publish(broadcaster)
+
+def process_stream(consumer, scorer, db, broadcaster, feature_store=None, kpis=None, score_cache=None, models=None,
+                   shadow=None):
+    """
+    Consumes events, fetches the updated user state, predicts, and logs.
+    kpis is an optional loaded KpiAggregator to keep current and broadcast from.
+    score_cache is an optional ScoreCache that skips re-scoring unchanged features.
+    models is an optional ModelReloader whose current model replaces scorer as new versions load;
+    shadow an optional ShadowScorer comparing a candidate model on sampled traffic.
+    """
     print("Stream processor started. Listening for user events...")
     for message in consumer:
         event = message.value
         user_id = event.get('user_id')
+        metrics.observe_lag('consume_lag', [event])
         print(f"PROCESSOR: Received event '{event.get('event_type')}' for user {user_id}")
 
         try:
-            log_event_to_db(db_conn, event)
-            user_df = get_user_features(db_conn, user_id)
-            if user_df is None:
-                print(f"Warning: User {user_id} not found. Skipping.")
-                continue
-
-            prediction_df = user_df.drop('customerID', axis=1, errors='ignore')
-            churn_probability = model.predict_proba(prediction_df)[:, 1][0]
-            risk_score = float(churn_probability)
-
-            log_prediction_to_db(db_conn, user_id, risk_score)
-            
-            # Create a combined payload for broadcasting all events
-            # broadcast_payload = {**event, "churn_probability": risk_score}
-            # requests.post("http://localhost:8000/api/broadcast-event", json=broadcast_payload)
-            # Prepare the core data payload
-            payload = {**event, "churn_probability": risk_score}
-
-# Determine the event type based on the risk score
-# Using the > 0.70 threshold for a high-risk "alert"
-            if risk_score > 0.70:
-                broadcast_data = {
-                "type": "churn_alert",
-                "payload": payload
-                }
-                print(f"PROCESSOR: Identified high-risk alert for user {user_id} (Score: {risk_score:.2f})")
-            else:
-                broadcast_data = {
-                "type": "new_event",
-                "payload": payload
-                }
-
-
-            requests.post("http://localhost:8000/api/broadcast-event", json=broadcast_data)
-            
-        except (psycopg2.InterfaceError, psycopg2.OperationalError) as e:
-            print(f"Database connection lost: {e}. Reconnecting...")
-            if db_conn: db_conn.close()
-            db_conn = get_db_connection()
+            # db.run retries on a fresh connection if the current one drops mid-event
+            # Applied only once db.run has committed; an update appended twice by a retry is a no-op
+            updates = []
+            scorer = current_scorer(scorer, models, score_cache)
+            with metrics.timer('transaction'):
+                broadcast_data = db.run(
+                    handle_event, event, scorer, feature_store, updates if kpis else None, score_cache, shadow
+                )
+            if score_cache is not None:
+                score_cache.commit()
+            if broadcast_data is not None:
+                if broadcast_data["type"] == "churn_alert":
+                    risk_score = broadcast_data["payload"]["churn_probability"]
+                    print(f"PROCESSOR: Identified high-risk alert for user {user_id} (Score: {risk_score:.2f})")
+                broadcaster.publish(broadcast_data)
+            update_kpis(kpis, updates, db, broadcaster)
         except Exception as e:
+            if score_cache is not None:
+                score_cache.discard()
             print(f"An error occurred processing event for {user_id}: {e}")
 
+def poll_batch(consumer, max_batch_size, max_linger_ms):
+    """
+    Pulls up to max_batch_size messages from the consumer, waiting at most max_linger_ms
+    after the first message arrives. Returns a (possibly empty) list of messages.
+    """
+    messages = []
+    deadline = None
+    while len(messages) < max_batch_size:
+        if deadline is None:
+            timeout_ms = max_linger_ms
+        else:
+            timeout_ms = int((deadline - time.monotonic()) * 1000)
+            if timeout_ms <= 0:
+                break
+        records = consumer.poll(timeout_ms=timeout_ms, max_records=max_batch_size - len(messages))
+        for partition_messages in records.values():
+            messages.extend(partition_messages)
+        if messages and deadline is None:
+            deadline = time.monotonic() + max_linger_ms / 1000.0
+        elif not messages:
+            break
+    return messages
+
+def rewind_batch(consumer, messages):
+    """Seeks every partition in the batch back to its first uncommitted message so it is redelivered."""
+    first_offsets = {}
+    for message in messages:
+        tp = TopicPartition(message.topic, message.partition)
+        first_offsets[tp] = min(first_offsets.get(tp, message.offset), message.offset)
+    for tp, offset in first_offsets.items():
+        seek(consumer, tp, offset)
+
+def process_batch(conn, messages, scorer, feature_store=None, buffer=None, kpi_updates=None, score_cache=None,
+                  shadow=None):
+    """Runs process_events over the values of a batch of consumer messages."""
+    return process_events(conn, [message.value for message in messages], scorer, feature_store, buffer, kpi_updates,
+                          score_cache, shadow)
+
+def score_with_cache(scorer, encoded, user_ids, score_cache):
+    """
+    Scores the rows of an encoded matrix, sending only those score_cache hasn't seen to the model.
+    Returns (probabilities, fingerprints, {user_id: cached top_features}, mask of the rows the model scored).
+    """
+    fingerprints = [score_cache.fingerprint(row) for row in encoded]
+    probabilities = np.empty(len(fingerprints), dtype=np.float32)
+    scored = np.zeros(len(fingerprints), dtype=bool)
+    cached_explanations = {}
+    for index, (user_id, fingerprint) in enumerate(zip(user_ids, fingerprints)):
+        cached = score_cache.get(fingerprint)
+        if cached is None:
+            scored[index] = True
+        else:
+            probabilities[index], cached_explanations[user_id] = cached
+    if scored.any():
+        probabilities[scored] = scorer.predict_encoded(encoded[scored])
+    return probabilities, fingerprints, cached_explanations, scored
+
+def process_events(conn, events, scorer, feature_store=None, buffer=None, kpi_updates=None, score_cache=None,
+                   shadow=None):
+    """
+    Scores a batch of events with one query and one model call, then writes all events
+    and predictions in the caller's transaction. Returns the broadcast messages.
+    buffer is an optional preallocated scorer.new_buffer() to encode features into.
+    One KPI update per scored user is appended to kpi_updates, if given.
+    With a score_cache, users whose features it has already scored skip the model, and the
+    caller commits or discards its stored predictions along with the transaction.
+    A sample of the scored users goes to shadow, if given, for comparison with a candidate model.
+    """
+    user_ids = {event.get('user_id') for event in events}
+
+    with metrics.timer('feature_fetch'):
+        if feature_store is not None:
+            for event in events:
+                feature_store.apply_event(conn, event)
+            rows = feature_store.get_many(conn, user_ids)
+        else:
+            rows = get_users_features_batch(conn, user_ids)
+    user_ids = list(rows.keys())
+    fingerprints = None
+    explanations = {}
+    with metrics.timer('score'):
+        encoded = scorer.encode_rows(list(rows.values()), out=buffer)
+        if score_cache is not None:
+            probabilities, fingerprints, explanations, scored = score_with_cache(scorer, encoded, user_ids, score_cache)
+        else:
+            probabilities = scorer.predict_encoded(encoded) if rows else np.empty(0, dtype=np.float32)
+            scored = np.ones(len(user_ids), dtype=bool)
+    scores = dict(zip(user_ids, probabilities.tolist()))
+    if shadow is not None:
+        shadow.submit(scorer, rows, scores)
+
+    # Contributions are computed from the already-encoded rows, and only for the high-risk users
+    if EXPLAIN_TOP_K:
+        alert_rows = np.flatnonzero((probabilities > ALERT_THRESHOLD) & scored)
+        if len(alert_rows):
+            with metrics.timer('explain'):
+                top = scorer.top_contributions(encoded[alert_rows], EXPLAIN_TOP_K, EXPLAIN_APPROX)
+                for index, contributions in zip(alert_rows.tolist(), top):
+                    explanations[user_ids[index]] = format_contributions(rows[user_ids[index]], contributions)
+    if score_cache is not None:
+        for index in np.flatnonzero(scored).tolist():
+            score_cache.put(fingerprints[index], scores[user_ids[index]], explanations.get(user_ids[index]))
+        fingerprints = dict(zip(user_ids, fingerprints))
+
+    prediction_time = datetime.now()
+    predictions = []
+    broadcasts = []
+    # Users given a prediction earlier in this batch; a second one would repeat it
+    predicted = set()
+    for event in events:
+        user_id = event.get('user_id')
+        if user_id not in scores:
+            print(f"Warning: User {user_id} not found. Skipping.")
+            continue
+        risk_score = scores[user_id]
+        top_features = explanations.get(user_id)
+        unchanged = score_cache is not None and (
+            user_id in predicted or score_cache.is_unchanged(user_id, fingerprints[user_id])
+        )
+        if unchanged:
+            score_cache.unchanged += 1
+        if unchanged and score_cache.skip_unchanged_writes:
+            score_cache.skipped_writes += 1
+        else:
+            predictions.append((user_id, risk_score, prediction_time, top_features, rows[user_id]['Contract']))
+            predicted.add(user_id)
+            if score_cache is not None:
+                score_cache.stored(user_id, fingerprints[user_id])
+        if unchanged and score_cache.skip_unchanged_broadcasts:
+            score_cache.skipped_broadcasts += 1
+            continue
+        broadcast_data = build_broadcast_message(event, risk_score, top_features)
+        if broadcast_data["type"] == "churn_alert":
+            print(f"PROCESSOR: Identified high-risk alert for user {user_id} (Score: {risk_score:.2f})")
+        broadcasts.append(broadcast_data)
+
+    with metrics.timer('db_write'):
+        log_events_to_db_batch(conn, events)
+        if predictions:
+            log_predictions_to_db_batch(conn, predictions)
+    if kpi_updates is not None:
+        kpi_updates.extend(kpi_update(user_id, score, rows[user_id]) for user_id, score in scores.items())
+    return broadcasts
+
+def is_transient(error):
+    """Whether an error is worth retrying as is: a lost database connection or a broker failure, not a bad event."""
+    return isinstance(error, CONNECTION_ERRORS) or is_broker_error(error)
+
+def process_events_one_by_one(db, events, scorer, feature_store=None, buffer=None, kpi_updates=None, score_cache=None,
+                              shadow=None):
+    """
+    Fallback for a batch that failed for a reason other than a transient error: runs process_events
+    on each event in its own transaction, so only the events that fail on their own are skipped (and
+    logged). Stops at the first transient error. Returns (broadcast messages, number of events
+    stored or skipped, number skipped, the transient error or None); the events after that count
+    are left for the caller to retry.
+    """
+    broadcasts = []
+    skipped = 0
+    for index, event in enumerate(events):
+        updates = [] if kpi_updates is not None else None
+        try:
+            broadcasts.extend(db.run(process_events, [event], scorer, feature_store, buffer, updates, score_cache, shadow))
+        except Exception as e:
+            if score_cache is not None:
+                score_cache.discard()
+            if is_transient(e):
+                return broadcasts, index, skipped, e
+            skipped += 1
+            print(f"PROCESSOR: Skipping event for user {event.get('user_id')} that can't be processed: {e!r}. Event: {event}")
+            continue
+        if score_cache is not None:
+            score_cache.commit()
+        if kpi_updates is not None:
+            kpi_updates.extend(updates)
+    return broadcasts, len(events), skipped, None
+
+def process_stream_batched(consumer, scorer, db, broadcaster, max_batch_size=500, max_linger_ms=200, feature_store=None,
+                           kpis=None, score_cache=None, models=None, shadow=None):
+    """
+    Micro-batched variant of process_stream. Offsets are committed only after the whole
+    batch has been written to the database, so a crash mid-batch replays it instead of losing it.
+    A batch that hits a transient error is redelivered; one that fails any other way is retried
+    an event at a time, and the events that still fail are logged and skipped.
+    The consumer must be created with enable_auto_commit=False.
+    models and shadow work as in process_stream.
+    """
+    print(f"Stream processor started in batch mode (max_batch_size={max_batch_size}, max_linger_ms={max_linger_ms}).")
+    # A batch never holds more distinct users than messages, so one buffer fits every batch
+    buffer = scorer.new_buffer(max_batch_size)
+    while True:
+        messages = poll_batch(consumer, max_batch_size, max_linger_ms)
+        if not messages:
+            # Idle streams still reconcile, which picks up scores written by other processes
+            update_kpis(kpis, (), db, broadcaster)
+            continue
+        metrics.observe_lag('consume_lag', [message.value for message in messages])
+
+        try:
+            started = time.monotonic()
+            updates = []
+            scorer = current_scorer(scorer, models, score_cache)
+            if buffer.shape[1] != scorer.n_features:
+                buffer = scorer.new_buffer(max_batch_size)
+            with metrics.timer('transaction'):
+                broadcasts = db.run(
+                    process_batch, messages, scorer, feature_store, buffer, updates if kpis else None, score_cache, shadow
+                )
+            if score_cache is not None:
+                score_cache.commit()
+            with metrics.timer('offset_commit'):
+                consumer.commit()
+            elapsed = time.monotonic() - started
+            print(f"PROCESSOR: Processed batch of {len(messages)} events in {elapsed * 1000:.1f} ms")
+            if feature_store is not None:
+                print(f"PROCESSOR: Feature cache stats {feature_store.stats()}")
+            if score_cache is not None:
+                print(f"PROCESSOR: Score cache stats {score_cache.stats()}")
+            print(f"PROCESSOR: Broadcast stats {broadcaster.metrics()}")
+        except Exception as e:
+            if score_cache is not None:
+                score_cache.discard()
+            if is_transient(e):
+                print(f"An error occurred processing a batch of {len(messages)} events: {e}. Retrying it...")
+                rewind_batch(consumer, messages)
+                time.sleep(1)
+                continue
+            # The same error would come back on every retry; store the events one at a time instead
+            print(f"An error occurred processing a batch of {len(messages)} events: {e!r}. Retrying them one at a time...")
+            updates = []
+            broadcasts, done, skipped, error = process_events_one_by_one(
+                db, [message.value for message in messages], scorer, feature_store, buffer, updates if kpis else None,
+                score_cache, shadow
+            )
+            if error is None:
+                try:
+                    with metrics.timer('offset_commit'):
+                        consumer.commit()
+                except Exception as e:
+                    # Positions are past the batch already; the next commit covers it
+                    print(f"Failed to commit offsets: {e}")
+                print(f"PROCESSOR: Stored {done - skipped} of {len(messages)} events one at a time, skipped {skipped}")
+            else:
+                print(f"An error occurred retrying events one at a time: {error}. Retrying the rest...")
+                rewind_batch(consumer, messages[done:])
+                time.sleep(1)
+
+        for broadcast_data in broadcasts:
+            broadcaster.publish(broadcast_data)
+        update_kpis(kpis, updates, db, broadcaster)
+
 if __name__ == "__main__":
     MODEL_PATH = '../ml_model/churn_model_xgb.pkl'
     KAFKA_TOPIC = "user_events_topic"
-    AIVEN_SERVICE_URI = os.getenv("AIVEN_SERVICE_URI")
+    KAFKA_GROUP_ID = "churn_processor_group_v2"
+    PROCESSOR_MODE = os.getenv("PROCESSOR_MODE", "single")
+    BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "500"))
+    BATCH_MAX_LINGER_MS = int(os.getenv("BATCH_MAX_LINGER_MS", "200"))
+    FEATURE_CACHE_SIZE = int(os.getenv("FEATURE_CACHE_SIZE", "100000"))
+    BROADCAST_BASE_URL = os.getenv("BROADCAST_BASE_URL", "http://localhost:8000")
+    BROADCAST_QUEUE_SIZE = int(os.getenv("BROADCAST_QUEUE_SIZE", "10000"))
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+    PROCESSOR_WORKERS = int(os.getenv("PROCESSOR_WORKERS", str(os.cpu_count() or 1)))
+    # Attempts per batch, while the database is unreachable, before a worker gives up and the pool stops (0: retry forever)
+    WORKER_MAX_BATCH_ATTEMPTS = int(os.getenv("WORKER_MAX_BATCH_ATTEMPTS", "10"))
+    # How long a rebalance waits for in-flight batches; keep it well under max.poll.interval.ms (300 s)
+    WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", "150"))
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+    METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "60"))
+    # Dashboard KPIs kept current from the stream; KPI_AGGREGATOR=0 leaves them to the API's SQL
+    KPI_AGGREGATOR = os.getenv("KPI_AGGREGATOR", "1") == "1"
+    KPI_RECONCILE_INTERVAL = float(os.getenv("KPI_RECONCILE_INTERVAL", "300"))
+    KPI_BROADCAST_INTERVAL = float(os.getenv("KPI_BROADCAST_INTERVAL", "1.0"))
+    # Scores remembered by feature fingerprint; 0 sends every event to the model
+    SCORE_CACHE_SIZE = int(os.getenv("SCORE_CACHE_SIZE", "100000"))
+    # Drop the prediction rows / broadcasts of events that leave a user's features unchanged
+    SCORE_CACHE_SKIP_WRITES = os.getenv("SCORE_CACHE_SKIP_WRITES", "0") == "1"
+    SCORE_CACHE_SKIP_BROADCASTS = os.getenv("SCORE_CACHE_SKIP_BROADCASTS", "0") == "1"
+    # Seconds between checks for a new model file; 0 keeps the model loaded at startup
+    MODEL_RELOAD_INTERVAL = float(os.getenv("MODEL_RELOAD_INTERVAL", "5"))
+    # A candidate model scored on SHADOW_SAMPLE_RATE of the traffic for comparison only; unset turns shadowing off
+    SHADOW_MODEL_PATH = os.getenv("SHADOW_MODEL_PATH", "")
+    SHADOW_SAMPLE_RATE = float(os.getenv("SHADOW_SAMPLE_RATE", "0.1"))
+
+    # Stage latency histograms; METRICS_ENABLED=0 turns recording off but still serves /kpis and the other endpoints
+    metrics.start_http_server(METRICS_PORT)
+    metrics.start_log_reporter(METRICS_LOG_INTERVAL)
 
-    if not AIVEN_SERVICE_URI:
-        raise ValueError("AIVEN_SERVICE_URI not found in .env file.")
+    def start_kpis(db):
+        """Loads the KPI aggregator from SQL and serves its snapshot at /kpis on the metrics port."""
+        if not KPI_AGGREGATOR:
+            return None
+        kpis = KpiAggregator(KPI_RECONCILE_INTERVAL, KPI_BROADCAST_INTERVAL)
+        with db.connection() as conn:
+            kpis.load(conn)
+        kpis.take_delta()
+        metrics.register_endpoint('/kpis', kpis.latest)
+        print(f"KPI aggregator loaded: {kpis.stats()}")
+        return kpis
 
-    churn_model = joblib.load(MODEL_PATH)
+    if PROCESSOR_MODE == "workers":
+        # Imported here because worker_pool imports this module
+        from worker_pool import WorkerPool, DrainOnRevoke, run_worker_pool
+
+        broadcaster = BroadcastClient(BROADCAST_BASE_URL, max_queue_size=BROADCAST_QUEUE_SIZE).start()
+        # The parent's only connection, for loading and reconciling the KPIs
+        db = Database(maxconn=1) if KPI_AGGREGATOR else None
+        kpis = start_kpis(db) if db is not None else None
+        # Each worker loads the model, its own DB connection and its shard of the feature cache
+        pool = WorkerPool(
+            PROCESSOR_WORKERS, MODEL_PATH, BATCH_MAX_SIZE, FEATURE_CACHE_SIZE, kpis=kpis,
+            score_cache_size=SCORE_CACHE_SIZE, skip_unchanged_writes=SCORE_CACHE_SKIP_WRITES,
+            skip_unchanged_broadcasts=SCORE_CACHE_SKIP_BROADCASTS, model_reload_interval=MODEL_RELOAD_INTERVAL,
+            shadow_model_path=SHADOW_MODEL_PATH, shadow_sample_rate=SHADOW_SAMPLE_RATE,
+            max_batch_attempts=WORKER_MAX_BATCH_ATTEMPTS,
+        ).start()
+        metrics.register_endpoint('/score-cache', pool.score_cache_stats)
+        metrics.register_endpoint('/model', pool.model_stats)
+        metrics.register_endpoint('/shadow', pool.shadow_stats)
+        kafka_consumer = create_consumer(KAFKA_TOPIC, KAFKA_GROUP_ID, enable_auto_commit=False)
+        subscribe(kafka_consumer, [KAFKA_TOPIC], DrainOnRevoke(pool, kafka_consumer, broadcaster, WORKER_DRAIN_TIMEOUT))
+        try:
+            run_worker_pool(kafka_consumer, pool, broadcaster, BATCH_MAX_SIZE, BATCH_MAX_LINGER_MS, db=db)
+        finally:
+            kafka_consumer.close()
+            broadcaster.stop()
+            print(f"Broadcast client stopped: {broadcaster.metrics()}")
+            if db is not None:
+                db.close()
+        sys.exit(0)
+
+    models = ModelReloader(MODEL_PATH, MODEL_RELOAD_INTERVAL).start()
+    churn_scorer = models.scorer
+    metrics.register_endpoint('/model', models.stats)
     print("Successfully loaded XGBoost model.")
 
-    db_connection = get_db_connection()
-    if not db_connection:
-        raise Exception("Could not connect to the database. Exiting.")
+    shadow = None
+    if SHADOW_MODEL_PATH:
+        shadow = ShadowScorer(ModelReloader(SHADOW_MODEL_PATH, MODEL_RELOAD_INTERVAL, required=False), SHADOW_SAMPLE_RATE,
+                              alert_threshold=ALERT_THRESHOLD).start()
+        metrics.register_endpoint('/shadow', shadow.stats)
+
+    db = Database(maxconn=DB_POOL_SIZE)
+
+    # A cache size of 0 disables the feature cache and reads every user from Postgres
+    feature_store = None
+    if FEATURE_CACHE_SIZE > 0:
+        feature_store = FeatureStore(max_size=FEATURE_CACHE_SIZE)
+        with db.connection() as conn:
+            feature_store.load(conn)
+
+    kpis = start_kpis(db)
 
-    kafka_consumer = create_kafka_consumer(AIVEN_SERVICE_URI, KAFKA_TOPIC)
+    score_cache = None
+    if SCORE_CACHE_SIZE > 0:
+        score_cache = ScoreCache(SCORE_CACHE_SIZE, SCORE_CACHE_SKIP_WRITES, SCORE_CACHE_SKIP_BROADCASTS)
+        metrics.register_endpoint('/score-cache', score_cache.stats)
+
+    broadcaster = BroadcastClient(BROADCAST_BASE_URL, max_queue_size=BROADCAST_QUEUE_SIZE).start()
+
+    batch_mode = PROCESSOR_MODE == "batch"
+    kafka_consumer = create_consumer(KAFKA_TOPIC, KAFKA_GROUP_ID, enable_auto_commit=not batch_mode)
     
     try:
-        process_stream(kafka_consumer, churn_model, db_connection)
+        if batch_mode:
+            process_stream_batched(
+                kafka_consumer, churn_scorer, db, broadcaster, BATCH_MAX_SIZE, BATCH_MAX_LINGER_MS, feature_store, kpis,
+                score_cache, models, shadow
+            )
+        else:
+            process_stream(kafka_consumer, churn_scorer, db, broadcaster, feature_store, kpis, score_cache, models, shadow)
     except KeyboardInterrupt:
         print("\nShutting down processor...")
     finally:
-        if db_connection:
-            db_connection.close()
-            print("Database connection closed.")
+        models.stop()
+        if score_cache is not None:
+            print(f"Score cache stats: {score_cache.stats()}")
+        if shadow is not None:
+            shadow.stop()
+            print(f"Shadow scoring stats: {shadow.stats()}")
+        broadcaster.stop()
+        print(f"Broadcast client stopped: {broadcaster.metrics()}")
+        db.close()
+        print("Database connections closed.")
 
 
@@ -0,0 +1,97 @@
+import hashlib
+from collections import OrderedDict
+
+class ScoreCache:
+    """
+    A bounded, LRU-evicted map from a fingerprint of an encoded feature vector to the score (and
+    alert explanation) the model gave it. Many events leave a customer's model inputs exactly as
+    they were, and those are answered from here instead of the model.
+
+    It also remembers the fingerprint of each user's last stored prediction, so the processor can
+    tell when a new prediction would repeat it. Those are only recorded once the transaction that
+    wrote them commits (stored() then commit()), so a rolled-back prediction is never mistaken for
+    the user's current state.
+    """
+
+    def __init__(self, max_size=100000, skip_unchanged_writes=False, skip_unchanged_broadcasts=False):
+        self.max_size = max_size
+        # Whether predictions and broadcasts that repeat the user's last stored prediction are dropped
+        self.skip_unchanged_writes = skip_unchanged_writes
+        self.skip_unchanged_broadcasts = skip_unchanged_broadcasts
+        # fingerprint -> (probability, top_features)
+        self._scores = OrderedDict()
+        # user_id -> fingerprint of their last committed prediction
+        self._last = OrderedDict()
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.unchanged = 0
+        self.skipped_writes = 0
+        self.skipped_broadcasts = 0
+
+    def __len__(self):
+        return len(self._scores)
+
+    @staticmethod
+    def fingerprint(encoded_row):
+        """A 128-bit digest of one encoded row (a 1-D float32 array)."""
+        return hashlib.blake2b(encoded_row.tobytes(), digest_size=16).digest()
+
+    def get(self, fingerprint):
+        """Returns (probability, top_features) for a fingerprint, or None if it hasn't been scored."""
+        entry = self._scores.get(fingerprint)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._scores.move_to_end(fingerprint)
+        return entry
+
+    def put(self, fingerprint, probability, top_features=None):
+        self._scores[fingerprint] = (probability, top_features)
+        self._scores.move_to_end(fingerprint)
+        while len(self._scores) > self.max_size:
+            self._scores.popitem(last=False)
+            self.evictions += 1
+
+    def is_unchanged(self, user_id, fingerprint):
+        """True if the user's last committed prediction was made from exactly these features."""
+        return self._last.get(user_id) == fingerprint
+
+    def stored(self, user_id, fingerprint):
+        """Records a prediction written in the current transaction; it counts once commit() is called."""
+        self._pending[user_id] = fingerprint
+
+    def commit(self):
+        for user_id, fingerprint in self._pending.items():
+            self._last[user_id] = fingerprint
+            self._last.move_to_end(user_id)
+        self._pending.clear()
+        while len(self._last) > self.max_size:
+            self._last.popitem(last=False)
+
+    def discard(self):
+        """Forgets the predictions of a transaction that failed."""
+        self._pending.clear()
+
+    def clear(self):
+        """Drops every cached score, e.g. after the model changes."""
+        self._scores.clear()
+        self._last.clear()
+        self._pending.clear()
+
+    def stats(self):
+        """Returns hit/miss counters and how much work the cache avoided."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._scores),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "unchanged": self.unchanged,
+            "skipped_writes": self.skipped_writes,
+            "skipped_broadcasts": self.skipped_broadcasts,
+        }
@@ -0,0 +1,508 @@
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from collections import defaultdict
+
+from common import metrics
+from common.db import backoff_delays
+from common.transport import TopicPartition, commit_offsets, partition_for
+from processor import current_scorer, is_transient, poll_batch, process_events, process_events_one_by_one, update_kpis
+
+def shard_for(user_id, n_workers):
+    """Routes a user to a worker. Every event for one user goes to the same worker, in order."""
+    return partition_for(user_id, n_workers)
+
+def _worker_main(worker_id, tasks, results, config):
+    """Worker process: scores and stores the batches for its shard of users, strictly in arrival order."""
+    # The dispatcher owns shutdown; a Ctrl+C on the terminal must not kill workers mid-batch
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from common.db import Database
+    from feature_store import FeatureStore
+    from model_reload import ModelReloader, ShadowScorer
+    from score_cache import ScoreCache
+
+    db = config['db_factory']() if config.get('db_factory') else Database(maxconn=1)
+    # Every worker watches the model file itself and swaps in new versions between batches
+    models = ModelReloader(config['model_path'], config.get('model_reload_interval', 0), nthread=1).start()
+    scorer = models.scorer
+    buffer = scorer.new_buffer(config['max_batch_size'])
+    # Each worker only ever sees its own shard of users, so the caches don't overlap
+    feature_store = None
+    if config.get('feature_cache_size', 0) > 0:
+        feature_store = FeatureStore(max_size=config['feature_cache_size'])
+    score_cache = None
+    if config.get('score_cache_size', 0) > 0:
+        score_cache = ScoreCache(
+            config['score_cache_size'], config.get('skip_unchanged_writes', False),
+            config.get('skip_unchanged_broadcasts', False),
+        )
+    shadow = None
+    if config.get('shadow_model_path'):
+        candidate = ModelReloader(config['shadow_model_path'], config.get('model_reload_interval', 0), nthread=1, required=False)
+        shadow = ShadowScorer(candidate, config.get('shadow_sample_rate', 0.1)).start()
+    results.put(('ready', worker_id, None, None))
+
+    max_attempts = config.get('max_batch_attempts') or None
+    gave_up = False
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if gave_up:
+            # Later batches would overtake the one that failed; they are left for redelivery
+            continue
+        batch_id, events = task
+        broadcasts = []
+        kpi_updates = [] if config.get('kpi_updates') else None
+        skipped = 0
+        # A failed batch is retried here before the next task, so a user's later events never overtake it
+        delays = backoff_delays(base_delay=1.0, max_retries=max_attempts - 1 if max_attempts else None)
+        while events:
+            updates = [] if kpi_updates is not None else None
+            try:
+                scorer = current_scorer(scorer, models, score_cache)
+                if buffer.shape[1] != scorer.n_features:
+                    buffer = scorer.new_buffer(config['max_batch_size'])
+                with metrics.timer('transaction'):
+                    broadcasts.extend(db.run(process_events, events, scorer, feature_store, buffer, updates, score_cache, shadow))
+                if score_cache is not None:
+                    score_cache.commit()
+                if kpi_updates is not None:
+                    kpi_updates.extend(updates)
+                break
+            except Exception as e:
+                if score_cache is not None:
+                    score_cache.discard()
+                error = e
+            if not is_transient(error):
+                # Retrying the whole batch would fail the same way; isolate the events that cause it
+                results.put(('failed', worker_id, batch_id, f"{error!r}; retrying its events one at a time"))
+                stored, done, skipped_now, error = process_events_one_by_one(
+                    db, events, scorer, feature_store, buffer, kpi_updates, score_cache, shadow
+                )
+                broadcasts.extend(stored)
+                skipped += skipped_now
+                events = events[done:]
+                if error is None:
+                    break
+            # Only a lost connection or broker gets here, and it may take a while to come back
+            delay = next(delays, None)
+            if delay is None:
+                results.put(('gave_up', worker_id, batch_id, f"{error!r}; giving up after {max_attempts} attempts"))
+                gave_up = True
+                break
+            results.put(('failed', worker_id, batch_id, f"{error!r}; retrying in {delay:.1f}s"))
+            time.sleep(delay)
+        if gave_up:
+            continue
+        # The worker's stage timings, KPI updates and model and cache stats travel back with the result
+        histograms = metrics.REGISTRY.take() if metrics.ENABLED else None
+        worker_stats = {
+            'model': models.stats(),
+            'score_cache': score_cache.stats() if score_cache is not None else None,
+            'shadow': shadow.stats() if shadow is not None else None,
+        }
+        results.put(('done', worker_id, batch_id, (broadcasts, histograms, kpi_updates, worker_stats, skipped)))
+    models.stop()
+    if shadow is not None:
+        shadow.stop()
+    db.close()
+
+class OffsetTracker:
+    """
+    Tracks which offsets of each partition are still being processed. The committable offset
+    of a partition is its lowest in-flight offset, so work that finishes out of order across
+    workers is never committed past an unfinished message.
+    """
+
+    def __init__(self):
+        self._in_flight = defaultdict(set)
+        self._next = {}
+        self._committed = {}
+
+    def add(self, tp, offset):
+        self._in_flight[tp].add(offset)
+        self._next[tp] = max(self._next.get(tp, 0), offset + 1)
+
+    def done(self, tp, offset):
+        self._in_flight[tp].discard(offset)
+
+    def take_committable(self):
+        """Returns {tp: offset} for partitions whose committable offset moved since the last call."""
+        offsets = {}
+        for tp, next_offset in self._next.items():
+            in_flight = self._in_flight[tp]
+            offset = min(in_flight) if in_flight else next_offset
+            if self._committed.get(tp) != offset:
+                offsets[tp] = offset
+        self._committed.update(offsets)
+        return offsets
+
+    def forget(self, tps):
+        """Drops partitions this consumer no longer owns."""
+        for tp in tps:
+            tp = TopicPartition(*tp)
+            self._in_flight.pop(tp, None)
+            self._next.pop(tp, None)
+            self._committed.pop(tp, None)
+
+class WorkerPool:
+    """
+    N worker processes fed by the consumer loop. Events are sharded by user_id, so one customer's
+    events are applied in order while different customers are scored in parallel. Batches that a
+    worker has not acknowledged stay pending: if the worker dies they are replayed on its
+    replacement, and their offsets are never committed until they finish. A batch that fails for
+    any reason but a lost connection or broker is retried an event at a time, and the events that
+    still fail are logged and skipped, so the batch finishes. A worker that can't reach the database
+    for max_batch_attempts tries of a batch (0: retry forever) gives up and skips the rest of its
+    queue; the pool then counts as stalled and its owner should stop, so the uncommitted events are
+    redelivered to the next run.
+
+    db_factory, if given, is called in each worker to create its database (default: a one-connection
+    common.db.Database). It is pickled to the worker processes, so it must be a module-level callable
+    or an instance of a module-level class.
+    """
+
+    def __init__(self, n_workers, model_path, max_batch_size=500, feature_cache_size=0, max_in_flight=4, kpis=None,
+                 score_cache_size=0, skip_unchanged_writes=False, skip_unchanged_broadcasts=False,
+                 model_reload_interval=0, shadow_model_path='', shadow_sample_rate=0.1, db_factory=None,
+                 max_batch_attempts=10):
+        self.n_workers = n_workers
+        self.max_in_flight = max_in_flight
+        # Optional KpiAggregator, fed with the scores of every finished batch
+        self.kpis = kpis
+        self.config = {
+            'model_path': model_path,
+            'max_batch_size': max_batch_size,
+            'feature_cache_size': feature_cache_size // max(n_workers, 1),
+            'kpi_updates': kpis is not None,
+            'score_cache_size': score_cache_size // max(n_workers, 1),
+            'skip_unchanged_writes': skip_unchanged_writes,
+            'skip_unchanged_broadcasts': skip_unchanged_broadcasts,
+            'model_reload_interval': model_reload_interval,
+            'shadow_model_path': shadow_model_path,
+            'shadow_sample_rate': shadow_sample_rate,
+            'db_factory': db_factory,
+            'max_batch_attempts': max_batch_attempts,
+        }
+        self.tracker = OffsetTracker()
+        self._ctx = multiprocessing.get_context('spawn')
+        self._results = self._ctx.Queue()
+        self._workers = {}
+        # batch_id -> (worker_id, [(tp, offset)], events), in dispatch order
+        self._pending = {}
+        self._next_batch_id = 0
+        self.completed_batches = 0
+        self.failed_batches = 0
+        # Events the workers logged and skipped because they failed on their own
+        self.skipped_events = 0
+        self.restarts = 0
+        # worker_id -> the error of the batch that worker gave up on
+        self.stalled = {}
+        # worker_id -> the latest model, score cache and shadow stats reported by that worker
+        self._worker_stats = {}
+
+    def _spawn(self, worker_id):
+        tasks = self._ctx.Queue()
+        process = self._ctx.Process(
+            target=_worker_main, args=(worker_id, tasks, self._results, self.config),
+            name=f'churn-worker-{worker_id}', daemon=True
+        )
+        process.start()
+        self._workers[worker_id] = (process, tasks)
+
+    def _wait_ready(self, worker_ids, timeout=120):
+        """
+        Waits for the given workers to load the model. Returns the broadcast messages of batches that
+        finished meanwhile. Raises RuntimeError if one of them exits first or isn't ready within timeout.
+        """
+        broadcasts = []
+        waiting = set(worker_ids)
+        deadline = time.monotonic() + timeout
+        while waiting:
+            try:
+                status, worker_id, batch_id, payload = self._results.get(timeout=0.5)
+            except queue.Empty:
+                for worker_id in sorted(waiting):
+                    process = self._workers[worker_id][0]
+                    if not process.is_alive():
+                        raise RuntimeError(f"Worker {worker_id} exited with code {process.exitcode} before it was ready")
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"Workers {sorted(waiting)} weren't ready after {timeout}s")
+                continue
+            if status == 'ready':
+                waiting.discard(worker_id)
+            else:
+                self._handle_result(status, worker_id, batch_id, payload, broadcasts)
+        return broadcasts
+
+    def start(self):
+        """Spawns the workers and waits until each has loaded the model."""
+        for worker_id in range(self.n_workers):
+            self._spawn(worker_id)
+        self._wait_ready(range(self.n_workers))
+        print(f"WORKERS: {self.n_workers} workers ready.")
+        return self
+
+    def in_flight(self, worker_id=None):
+        if worker_id is None:
+            return len(self._pending)
+        return sum(1 for owner, _, _ in self._pending.values() if owner == worker_id)
+
+    def _outstanding(self):
+        """Pending batches that can still finish, i.e. not queued behind a batch a worker gave up on."""
+        return sum(1 for owner, _, _ in self._pending.values() if owner not in self.stalled)
+
+    def dispatch(self, messages):
+        """Splits messages into one ordered sub-batch per worker and queues them."""
+        shards = defaultdict(list)
+        for message in messages:
+            shards[shard_for(message.value.get('user_id'), self.n_workers)].append(message)
+        for worker_id, shard in shards.items():
+            batch_id = self._next_batch_id
+            self._next_batch_id += 1
+            offsets = [(TopicPartition(message.topic, message.partition), message.offset) for message in shard]
+            events = [message.value for message in shard]
+            for tp, offset in offsets:
+                self.tracker.add(tp, offset)
+            self._pending[batch_id] = (worker_id, offsets, events)
+            self._workers[worker_id][1].put((batch_id, events))
+
+    def _handle_result(self, status, worker_id, batch_id, payload, broadcasts):
+        if status == 'ready' or batch_id not in self._pending:
+            return
+        if status == 'gave_up':
+            # Its offsets stay uncommitted, and so do those of everything behind it on that worker
+            self.failed_batches += 1
+            self.stalled[worker_id] = payload
+            _, offsets, _ = self._pending[batch_id]
+            print(f"WORKERS: Worker {worker_id} gave up on a batch of {len(offsets)} events: {payload}")
+            return
+        if status != 'done':
+            # The worker retries the batch itself; it stays pending, so its offsets aren't committed
+            self.failed_batches += 1
+            _, offsets, _ = self._pending[batch_id]
+            print(f"WORKERS: Worker {worker_id} failed a batch of {len(offsets)} events: {payload}")
+            return
+        _, offsets, _ = self._pending.pop(batch_id)
+        for tp, offset in offsets:
+            self.tracker.done(tp, offset)
+        self.completed_batches += 1
+        batch_broadcasts, histograms, kpi_updates, worker_stats, skipped = payload
+        broadcasts.extend(batch_broadcasts)
+        self.skipped_events += skipped
+        self._worker_stats[worker_id] = worker_stats
+        if histograms:
+            metrics.REGISTRY.merge(histograms)
+        if kpi_updates and self.kpis is not None:
+            self.kpis.apply(kpi_updates)
+
+    def collect(self, timeout=0.0):
+        """Gathers finished batches, waiting up to timeout for the first one. Returns their broadcast messages."""
+        broadcasts = []
+        try:
+            result = self._results.get(timeout=timeout) if timeout > 0 else self._results.get_nowait()
+        except queue.Empty:
+            return broadcasts
+        self._handle_result(*result, broadcasts)
+        while True:
+            try:
+                result = self._results.get_nowait()
+            except queue.Empty:
+                return broadcasts
+            self._handle_result(*result, broadcasts)
+
+    def check_workers(self):
+        """
+        Replaces workers that died and replays their unacknowledged batches in order. Returns the
+        broadcast messages of batches that finished while a replacement started.
+        """
+        broadcasts = []
+        for worker_id, (process, _) in list(self._workers.items()):
+            if process.is_alive():
+                continue
+            print(f"WORKERS: Worker {worker_id} exited with code {process.exitcode}; restarting it.")
+            self.restarts += 1
+            self._spawn(worker_id)
+            broadcasts.extend(self._wait_ready([worker_id]))
+            tasks = self._workers[worker_id][1]
+            for batch_id, (owner, _, events) in sorted(self._pending.items()):
+                if owner == worker_id:
+                    tasks.put((batch_id, events))
+        return broadcasts
+
+    def wait_for_capacity(self):
+        """Blocks while any worker already has max_in_flight batches queued. Returns broadcasts collected meanwhile."""
+        broadcasts = []
+        while not self.stalled and any(self.in_flight(worker_id) >= self.max_in_flight for worker_id in self._workers):
+            broadcasts.extend(self.collect(timeout=0.1))
+            broadcasts.extend(self.check_workers())
+        return broadcasts
+
+    def drain(self, timeout=None):
+        """
+        Waits for every pending batch to finish, or for timeout seconds. Batches queued on a worker
+        that gave up are not waited for. Returns the broadcast messages of the batches that finished.
+        """
+        broadcasts = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._outstanding() and (deadline is None or time.monotonic() < deadline):
+            broadcasts.extend(self.collect(timeout=0.1))
+            broadcasts.extend(self.check_workers())
+        return broadcasts
+
+    def resize(self, n_workers):
+        """
+        Changes the number of workers. In-flight work is drained first because the user -> worker
+        mapping changes, and a user's old and new worker must never run at the same time.
+        """
+        if self.stalled:
+            raise RuntimeError(f"Can't resize a pool whose workers gave up: {self.stalled}")
+        broadcasts = self.drain()
+        for worker_id in range(n_workers, self.n_workers):
+            process, tasks = self._workers.pop(worker_id)
+            tasks.put(None)
+            process.join()
+        new_ids = list(range(self.n_workers, n_workers))
+        self.n_workers = n_workers
+        for worker_id in new_ids:
+            self._spawn(worker_id)
+        broadcasts.extend(self._wait_ready(new_ids))
+        print(f"WORKERS: Resized pool to {n_workers} workers.")
+        return broadcasts
+
+    def stop(self, timeout=30):
+        """Drains pending work, then shuts every worker down. Returns the final broadcast messages."""
+        broadcasts = self.drain(timeout)
+        for process, tasks in self._workers.values():
+            tasks.put(None)
+        for process, _ in self._workers.values():
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._workers.clear()
+        return broadcasts
+
+    def score_cache_stats(self):
+        """The workers' score cache counters summed, or None if the cache is off. A restarted worker starts from zero."""
+        reports = [stats['score_cache'] for stats in self._worker_stats.values() if stats['score_cache'] is not None]
+        if not reports:
+            return None
+        totals = {key: sum(report[key] for report in reports) for key in reports[0] if key != 'hit_rate'}
+        lookups = totals['hits'] + totals['misses']
+        totals['hit_rate'] = totals['hits'] / lookups if lookups else 0.0
+        return totals
+
+    def model_stats(self):
+        """{worker_id: ModelReloader.stats()} as of each worker's latest batch."""
+        return {worker_id: stats['model'] for worker_id, stats in sorted(self._worker_stats.items())}
+
+    def shadow_stats(self):
+        """The workers' shadow scoring counters combined, or None if shadowing is off."""
+        reports = [stats['shadow'] for stats in self._worker_stats.values() if stats['shadow'] is not None]
+        if not reports:
+            return None
+        totals = dict(reports[0])
+        for key in ('sampled', 'compared', 'dropped', 'errors', 'sum_abs_delta', 'over_0_05', 'over_0_10',
+                    'alerts_live_only', 'alerts_shadow_only'):
+            totals[key] = sum(report[key] for report in reports)
+        totals['candidate_version'] = max(report['candidate_version'] for report in reports)
+        totals['max_abs_delta'] = max(report['max_abs_delta'] for report in reports)
+        totals['mean_abs_delta'] = totals['sum_abs_delta'] / totals['compared'] if totals['compared'] else 0.0
+        return totals
+
+    def stats(self):
+        return {
+            "workers": self.n_workers,
+            "in_flight_batches": len(self._pending),
+            "completed_batches": self.completed_batches,
+            "failed_batches": self.failed_batches,
+            "skipped_events": self.skipped_events,
+            "restarts": self.restarts,
+            "stalled_workers": sorted(self.stalled),
+            "score_cache": self.score_cache_stats(),
+        }
+
+class DrainOnRevoke:
+    """
+    Consumer rebalance listener for the worker pool: before partitions move to another
+    consumer in the group, finish the work already dispatched for them and commit it,
+    so the new owner neither skips nor re-applies those events. Pass it to
+    common.transport.subscribe, which adapts it for kafka-python.
+
+    The drain is bounded by drain_timeout seconds, which must stay well under the consumer's
+    max.poll.interval.ms (300 s by default) or the group drops this consumer anyway. Work that
+    hasn't finished by then is not committed, so the new owner gets those events again.
+    """
+
+    def __init__(self, pool, consumer, broadcaster, drain_timeout=150.0):
+        self.pool = pool
+        self.consumer = consumer
+        self.broadcaster = broadcaster
+        self.drain_timeout = drain_timeout
+
+    def on_partitions_revoked(self, revoked):
+        for broadcast_data in self.pool.drain(self.drain_timeout):
+            self.broadcaster.publish(broadcast_data)
+        # Only ever commits up to the first unfinished offset of each partition
+        commit_offsets(self.consumer, self.pool.tracker.take_committable())
+        self.pool.tracker.forget(revoked)
+        unfinished = self.pool.in_flight()
+        if unfinished:
+            print(f"WORKERS: Partitions revoked with {unfinished} batches unfinished; their events will be redelivered: {sorted(revoked)}")
+        else:
+            print(f"WORKERS: Partitions revoked, committed completed work: {sorted(revoked)}")
+
+    def on_partitions_assigned(self, assigned):
+        print(f"WORKERS: Partitions assigned: {sorted(assigned)}")
+
+def run_worker_pool(consumer, pool, broadcaster, max_batch_size=500, max_linger_ms=200, commit_interval=1.0, db=None,
+                    stopping=None):
+    """
+    Multi-worker variant of process_stream. The consumer must be created with
+    enable_auto_commit=False; offsets are committed only up to work the workers have finished.
+    SIGINT/SIGTERM, or setting the optional stopping Event, stop polling, drain the workers and
+    commit before returning. db is the parent's own Database, used to reconcile pool.kpis against SQL.
+    Raises RuntimeError, after committing the work that finished, if a worker gave up on a batch.
+    """
+    if stopping is None:
+        stopping = threading.Event()
+
+    def request_stop(signum, frame):
+        print("\nWORKERS: Shutdown requested, draining in-flight work...")
+        stopping.set()
+
+    previous_handlers = {sig: signal.signal(sig, request_stop) for sig in (signal.SIGINT, signal.SIGTERM)}
+    print(f"Stream processor started with {pool.n_workers} workers (max_batch_size={max_batch_size}).")
+    last_commit = time.monotonic()
+    try:
+        while not stopping.is_set():
+            for broadcast_data in pool.check_workers() + pool.collect() + pool.wait_for_capacity():
+                broadcaster.publish(broadcast_data)
+            if pool.stalled:
+                raise RuntimeError(f"Workers gave up on their batches, stopping so they are redelivered: {pool.stalled}")
+
+            messages = poll_batch(consumer, max_batch_size, max_linger_ms)
+            if messages:
+                metrics.observe_lag('consume_lag', [message.value for message in messages])
+                pool.dispatch(messages)
+
+            # Finished batches have already been applied to pool.kpis by collect()
+            update_kpis(pool.kpis, (), db, broadcaster)
+
+            if time.monotonic() - last_commit >= commit_interval:
+                with metrics.timer('offset_commit'):
+                    commit_offsets(consumer, pool.tracker.take_committable())
+                last_commit = time.monotonic()
+    finally:
+        for broadcast_data in pool.stop():
+            broadcaster.publish(broadcast_data)
+        if pool.kpis is not None:
+            pool.kpis.maybe_publish(broadcaster, force=True)
+        commit_offsets(consumer, pool.tracker.take_committable())
+        for sig, handler in previous_handlers.items():
+            signal.signal(sig, handler)
+        print(f"WORKERS: Stopped. {pool.stats()}")